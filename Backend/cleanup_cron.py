@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+# For expiry within seconds instead of per cron interval, run the resident
+# daemon instead: python manage.py cleanup_files --daemon
 
 import os
 import sys
@@ -0,0 +1,254 @@
+"""
+Admission control for uploads and downloads.
+
+Transfers are admitted against limits on the requests in flight and,
+for uploads, on the bytes they declared in Content-Length. Each limit
+applies per process and, when ADMISSION_NODE_DIR is set, across every
+process on the node that shares that directory. A request over any
+limit is turned away with Retry-After before its body is read, so a
+spike of uploads cannot take the disk and database down for everyone,
+and downloads keep their own capacity.
+
+The node-wide counts live in a small ledger file holding one entry per
+process, updated under an exclusive flock. Entries of processes that
+died without releasing their slots are dropped on the next update.
+"""
+import fcntl
+import json
+import os
+import threading
+from django.conf import settings
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+KINDS = (UPLOAD, DOWNLOAD)
+
+# Limit scopes, reported with rejections
+SCOPE_PROCESS = 'process'
+SCOPE_NODE = 'node'
+
+LEDGER_NAME = 'admission.json'
+
+
+def _limit(name):
+    """A configured limit, or None when it is unset or 0"""
+    return getattr(settings, name, 0) or None
+
+
+def get_limits(kind):
+    """(requests, bytes) limits per process and per node for one kind of transfer"""
+    prefix = kind.upper()
+    return {
+        SCOPE_PROCESS: (_limit(f'{prefix}_MAX_IN_FLIGHT'), _limit(f'{prefix}_MAX_IN_FLIGHT_BYTES')),
+        SCOPE_NODE: (_limit(f'{prefix}_NODE_MAX_IN_FLIGHT'), _limit(f'{prefix}_NODE_MAX_IN_FLIGHT_BYTES')),
+    }
+
+
+def is_enabled():
+    """Whether any admission limit is configured"""
+    return any(
+        limit is not None
+        for kind in KINDS
+        for limits in get_limits(kind).values()
+        for limit in limits
+    )
+
+
+def get_node_dir():
+    """Directory shared by the processes of this node, or None for per-process limits only"""
+    return getattr(settings, 'ADMISSION_NODE_DIR', None) or None
+
+
+def get_retry_after():
+    """Seconds a rejected client is asked to wait"""
+    return getattr(settings, 'ADMISSION_RETRY_AFTER', 5)
+
+
+def get_reject_status():
+    """Status code of rejections: 503, or 429 to make clients back off per request"""
+    return getattr(settings, 'ADMISSION_REJECT_STATUS', 503)
+
+
+def _over(limits, in_flight, size):
+    """
+    Check whether one more request of ``size`` bytes exceeds the limits.
+    A lone request is always admitted, so a file larger than the byte
+    limit can still be sent once nothing else is in flight.
+    """
+    max_requests, max_bytes = limits
+    requests, in_flight_bytes = in_flight
+    if max_requests is not None and requests >= max_requests:
+        return True
+    return max_bytes is not None and requests > 0 and in_flight_bytes + size > max_bytes
+
+
+class _Ledger:
+    """The node-wide ledger file, opened once per process"""
+
+    def __init__(self, node_dir):
+        os.makedirs(node_dir, exist_ok=True)
+        self.fd = os.open(os.path.join(node_dir, LEDGER_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        self.pid = str(os.getpid())
+
+    def _read(self):
+        data = b''
+        while True:
+            block = os.pread(self.fd, 65536, len(data))
+            if not block:
+                break
+            data += block
+        try:
+            entries = json.loads(data) if data else {}
+        except ValueError:
+            entries = {}
+        # Drop processes that exited while holding slots
+        for pid in [pid for pid in entries if pid != self.pid]:
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                del entries[pid]
+            except (PermissionError, ValueError):
+                pass
+        return entries
+
+    def _write(self, entries):
+        data = json.dumps(entries, separators=(',', ':')).encode()
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, data, 0)
+
+    def update(self, kind, requests, size, limits=None):
+        """
+        Add ``requests`` and ``size`` bytes (negative to remove them) to
+        this process's entry. With ``limits``, nothing is added if one
+        more request of ``size`` bytes would put the node over them.
+        Returns whether the entry was updated.
+        """
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            entries = self._read()
+            if limits is not None:
+                totals = [0, 0]
+                for entry in entries.values():
+                    entry_requests, entry_bytes = entry.get(kind, (0, 0))
+                    totals[0] += entry_requests
+                    totals[1] += entry_bytes
+                if _over(limits, totals, size):
+                    return False
+            own = entries.setdefault(self.pid, {})
+            own_requests, own_bytes = own.get(kind, (0, 0))
+            own[kind] = (max(own_requests + requests, 0), max(own_bytes + size, 0))
+            self._write(entries)
+            return True
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def totals(self):
+        """Requests and bytes in flight on the node, by kind"""
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            entries = self._read()
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        totals = {kind: [0, 0] for kind in KINDS}
+        for entry in entries.values():
+            for kind in KINDS:
+                requests, in_flight_bytes = entry.get(kind, (0, 0))
+                totals[kind][0] += requests
+                totals[kind][1] += in_flight_bytes
+        return totals
+
+
+# Requests and bytes in flight in this process, by kind
+_in_flight = {kind: [0, 0] for kind in KINDS}
+_lock = threading.Lock()
+_ledger = None
+
+
+def _reset_after_fork():
+    """A forked child starts with nothing in flight and its own ledger handle"""
+    global _lock, _ledger
+    _lock = threading.Lock()
+    _ledger = None
+    for kind in KINDS:
+        _in_flight[kind] = [0, 0]
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get_ledger():
+    global _ledger
+    node_dir = get_node_dir()
+    if node_dir is None:
+        return None
+    if _ledger is None:
+        _ledger = _Ledger(node_dir)
+    return _ledger
+
+
+class Ticket:
+    """An admitted request's slot; released once its response is done"""
+
+    def __init__(self, kind, size, ledger):
+        self.kind = kind
+        self.size = size
+        self.ledger = ledger
+        self.released = False
+
+    def release(self):
+        with _lock:
+            if self.released:
+                return
+            self.released = True
+            in_flight = _in_flight[self.kind]
+            in_flight[0] -= 1
+            in_flight[1] -= self.size
+        if self.ledger is not None:
+            try:
+                self.ledger.update(self.kind, -1, -self.size)
+            except OSError:
+                pass
+
+
+def admit(kind, size=0):
+    """
+    Try to admit a transfer of ``size`` declared bytes. Returns a Ticket,
+    or the scope whose limit was reached ('process' or 'node').
+    """
+    limits = get_limits(kind)
+    with _lock:
+        in_flight = _in_flight[kind]
+        if _over(limits[SCOPE_PROCESS], in_flight, size):
+            return SCOPE_PROCESS
+        in_flight[0] += 1
+        in_flight[1] += size
+
+    node_limits = limits[SCOPE_NODE]
+    try:
+        ledger = _get_ledger()
+        admitted = ledger is None or ledger.update(kind, 1, size, node_limits if any(node_limits) else None)
+    except OSError:
+        # A broken ledger only loses the node-wide limit
+        admitted, ledger = True, None
+    if not admitted:
+        with _lock:
+            in_flight[0] -= 1
+            in_flight[1] -= size
+        return SCOPE_NODE
+    return Ticket(kind, size, ledger)
+
+
+def in_flight():
+    """
+    Requests and bytes in flight by kind: on the node when
+    ADMISSION_NODE_DIR is set, otherwise in this process
+    """
+    try:
+        ledger = _get_ledger()
+        if ledger is not None:
+            return ledger.totals()
+    except OSError:
+        pass
+    with _lock:
+        return {kind: list(values) for kind, values in _in_flight.items()}
@@ -0,0 +1,223 @@
+"""
+HTTP traffic generator used by the benchmark_http command.
+
+Drives a weighted mix of upload, file info and download requests
+against running servers using only the standard library, and keeps
+per-operation latencies, status codes and byte counts.
+"""
+import http.client
+import json
+import math
+import os
+import random
+import re
+import secrets
+import threading
+import time
+from collections import Counter, defaultdict
+
+OP_UPLOAD = 'upload'
+OP_INFO = 'info'
+OP_DOWNLOAD = 'download'
+OPERATIONS = (OP_UPLOAD, OP_INFO, OP_DOWNLOAD)
+
+# Size of the reads a download body is drained in
+READ_SIZE = 64 * 1024
+
+_SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+
+def parse_size(text):
+    """Parse a size such as 512, 64KB or 8MB into bytes"""
+    match = re.fullmatch(r'\s*(\d+)\s*([KMG]?B?)\s*', text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f'Invalid size: {text!r}')
+    return int(match.group(1)) * _SIZE_UNITS[match.group(2).upper()]
+
+
+def parse_weights(text, parse_key=str):
+    """Parse 'key:weight,key:weight' into a list of (key, weight) pairs"""
+    weights = []
+    for item in text.split(','):
+        key, _, weight = item.partition(':')
+        weights.append((parse_key(key.strip()), float(weight or 1)))
+    if not weights or any(weight < 0 for _, weight in weights) or not sum(w for _, w in weights):
+        raise ValueError(f'Invalid weights: {text!r}')
+    return weights
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class OperationStats:
+    """Samples collected for one operation"""
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        to_ms = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+        return {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'statuses': {str(code): count for code, count in sorted(self.statuses.items())},
+            'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+            'latency_ms': {
+                'p50': to_ms(percentile(latencies, 0.50)),
+                'p95': to_ms(percentile(latencies, 0.95)),
+                'p99': to_ms(percentile(latencies, 0.99)),
+                'mean': to_ms(sum(latencies) / len(latencies)) if latencies else None,
+                'max': to_ms(latencies[-1]) if latencies else None,
+            },
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
+
+
+class TrafficGenerator:
+    """
+    Runs ``concurrency`` client threads, each picking operations from
+    ``mix`` and upload sizes from ``sizes`` with its own seeded random
+    generator, so the same arguments replay the same sequence.
+
+    Downloads consume a shared code, just like real one-time links; a
+    download or info request with no code left to use becomes an upload.
+    """
+
+    def __init__(self, addresses, mix, sizes, concurrency, seed=0, timeout=60):
+        self.addresses = addresses
+        self.mix = mix
+        self.sizes = sizes
+        self.concurrency = concurrency
+        self.seed = seed
+        self.timeout = timeout
+
+        self.stats = defaultdict(OperationStats)
+        self._codes = []
+        self._lock = threading.Lock()
+        self._payload = os.urandom(max(size for size, _ in sizes))
+
+    def prefill(self, count):
+        """Upload ``count`` files before measuring, so reads have codes to use"""
+        rng = random.Random(self.seed - 1)
+        scratch = defaultdict(OperationStats)
+        for i in range(count):
+            self._upload(self.addresses[i % len(self.addresses)], rng, scratch)
+
+    def run(self, requests=None, duration=None):
+        """Send traffic until ``requests`` operations or ``duration`` seconds are done"""
+        remaining = [requests]
+        deadline = time.perf_counter() + duration if duration else None
+
+        def take_turn():
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+            if remaining[0] is None:
+                return True
+            with self._lock:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+                return True
+
+        def client(index):
+            rng = random.Random(self.seed + index)
+            address = self.addresses[index % len(self.addresses)]
+            operations, weights = zip(*self.mix)
+            while take_turn():
+                operation = rng.choices(operations, weights)[0]
+                getattr(self, f'_{operation}')(address, rng, self.stats)
+
+        threads = [
+            threading.Thread(target=client, args=(i,), name=f'benchmark-client-{i}')
+            for i in range(self.concurrency)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    def _request(self, address, operation, stats, method, path, body=None, headers=None):
+        """Send one request, drain the response and record it. Returns (status, body or None)"""
+        record = stats[operation]
+        connection = http.client.HTTPConnection(*address, timeout=self.timeout)
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            received = 0
+            content = b'' if response.getheader('Content-Type', '').startswith('application/json') else None
+            while True:
+                block = response.read(READ_SIZE)
+                if not block:
+                    break
+                received += len(block)
+                if content is not None:
+                    content += block
+        except (OSError, http.client.HTTPException):
+            with self._lock:
+                record.errors += 1
+            return None, None
+        finally:
+            connection.close()
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            record.latencies.append(elapsed)
+            record.statuses[response.status] += 1
+            record.bytes_sent += len(body or b'')
+            record.bytes_received += received
+        return response.status, content
+
+    def _upload(self, address, rng, stats):
+        size = rng.choices(*zip(*self.sizes))[0]
+        boundary = secrets.token_hex(16)
+        # A random prefix keeps uploads distinct when deduplication is on
+        content = rng.randbytes(16) + self._payload[:max(0, size - 16)]
+        body = b''.join([
+            f'--{boundary}\r\n'.encode(),
+            b'Content-Disposition: form-data; name="file"; filename="benchmark.bin"\r\n',
+            b'Content-Type: application/octet-stream\r\n\r\n',
+            content[:size],
+            f'\r\n--{boundary}--\r\n'.encode(),
+        ])
+        status, response = self._request(
+            address, OP_UPLOAD, stats, 'POST', '/api/upload/', body,
+            {'Content-Type': f'multipart/form-data; boundary={boundary}'},
+        )
+        if status == 201:
+            with self._lock:
+                self._codes.append(json.loads(response)['code'])
+
+    def _info(self, address, rng, stats):
+        with self._lock:
+            code = rng.choice(self._codes) if self._codes else None
+        if code is None:
+            return self._upload(address, rng, stats)
+        return self._get_info(address, code, stats)
+
+    def _get_info(self, address, code, stats):
+        status, response = self._request(address, OP_INFO, stats, 'GET', f'/api/file/{code}/')
+        return json.loads(response)['download_token'] if status == 200 else None
+
+    def _download(self, address, rng, stats):
+        with self._lock:
+            code = self._codes.pop(rng.randrange(len(self._codes))) if self._codes else None
+        if code is None:
+            return self._upload(address, rng, stats)
+        # The token comes from a file info request, as in the frontend
+        token = self._get_info(address, code, stats)
+        if token is not None:
+            self._request(address, OP_DOWNLOAD, stats, 'GET', f'/api/download/{code}/{token}/')
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import uuid
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .models import StoredBlob
+from .storage import media_path, resolve_path, upload_path_for
+
+
+# Size of the blocks read when hashing a file that is already on disk
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def dedup_enabled():
+    """Check if uploads are stored as content-addressed, deduplicated blobs"""
+    return getattr(settings, 'UPLOAD_DEDUPLICATE', False)
+
+
+def hash_file(full_path):
+    """SHA-256 of a file on disk"""
+    digest = hashlib.sha256()
+    with open(full_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _link_existing(digest, partial_path):
+    """
+    Take a reference on an existing blob. The increment is a single
+    conditional UPDATE, so it cannot race with the blob being released.
+    Returns the blob, or None if there is none to link.
+    """
+    blob = StoredBlob.objects.filter(digest=digest).first()
+    if blob is None:
+        return None
+    if not StoredBlob.objects.filter(id=blob.id, ref_count__gt=0).update(ref_count=F('ref_count') + 1):
+        return None
+
+    full_path = resolve_path(blob.file_path)
+    if os.path.exists(full_path):
+        os.remove(partial_path)
+    else:
+        # The content went missing on disk; restore it from this upload
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.replace(partial_path, full_path)
+    blob.ref_count += 1
+    return blob
+
+
+def store_blob(partial_path, digest, size):
+    """
+    Store a fully written partial file as a deduplicated blob. If the
+    digest is already known the partial file is dropped and the existing
+    blob gains a reference; otherwise the file is moved into place.
+    """
+    blob = _link_existing(digest, partial_path)
+    if blob is not None:
+        return blob
+
+    # Unique file name per blob row, so a released blob being unlinked
+    # can never remove the file of a newer blob with the same digest
+    relative_path = upload_path_for(f"{digest}-{uuid.uuid4().hex[:8]}")
+    full_path = media_path(relative_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    os.replace(partial_path, full_path)
+
+    try:
+        with transaction.atomic():
+            # Clear out a fully released row for this digest first, with its
+            # file, which would otherwise be left to the orphan scanner
+            released = StoredBlob.objects.filter(digest=digest, ref_count__lte=0).values_list('id', flat=True)
+            delete_unreferenced_blobs(list(released))
+            return StoredBlob.objects.create(
+                digest=digest, file_path=relative_path, size=size, ref_count=1
+            )
+    except IntegrityError:
+        # Another upload of the same content won the race; link to it instead
+        blob = _link_existing(digest, full_path)
+        if blob is None:
+            raise
+        return blob
+
+
+def release_blobs(blob_counts):
+    """
+    Drop references to blobs, given as {blob_id: count}. Run it in the
+    transaction that deletes the referencing rows, then remove what is
+    left unreferenced with delete_unreferenced_blobs once it commits.
+    """
+    for blob_id, count in blob_counts.items():
+        StoredBlob.objects.filter(id=blob_id).update(ref_count=F('ref_count') - count)
+
+
+def delete_unreferenced_blobs(blob_ids=None, dry_run=False):
+    """
+    Remove blobs whose last reference is gone, rows first and then files.
+    Returns the number of files removed (or that would be on a dry run).
+    """
+    blobs = StoredBlob.objects.filter(ref_count__lte=0)
+    if blob_ids is not None:
+        blobs = blobs.filter(id__in=blob_ids)
+
+    removed = 0
+    for blob_id, file_path in blobs.values_list('id', 'file_path'):
+        if dry_run:
+            removed += 1
+            continue
+        # Conditional delete: a new upload may have linked the blob meanwhile
+        deleted, _ = StoredBlob.objects.filter(id=blob_id, ref_count__lte=0).delete()
+        if not deleted:
+            continue
+        try:
+            os.remove(resolve_path(file_path))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
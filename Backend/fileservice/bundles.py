@@ -0,0 +1,159 @@
+"""
+Bundles: several files shared under one code.
+
+A bundle is a FileShare row with ``is_bundle`` set. It carries the
+code, download token and expiry of all its files, so a bundle is
+downloaded once and expires as a whole. The files are BundleFile rows,
+and a download streams them as a ZIP archive built on the fly.
+"""
+import os
+import posixpath
+from functools import partial
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .compression import (
+    ENCODING_GZIP,
+    GZIP_HEADER_SIZE,
+    GZIP_TRAILER_SIZE,
+    READ_SIZE,
+    get_level,
+    gzip_header_size,
+    is_compressible,
+)
+from .models import BundleFile, FileShare
+from .storage import resolve_path
+from .upload_handlers import get_max_upload_size
+from .zipstream import ZIP_DEFLATED, ZipEntry, ZipStream
+
+BUNDLE_CONTENT_TYPE = 'application/zip'
+DEFAULT_BUNDLE_NAME = 'files.zip'
+
+# BundleFile rows per INSERT
+CREATE_BATCH_SIZE = 500
+
+
+def get_max_bundle_size():
+    """Maximum size in bytes of all files of a bundle together"""
+    return getattr(settings, 'BUNDLE_MAX_SIZE', None) or get_max_upload_size()
+
+
+def bundle_filename(name):
+    """File name of a bundle's archive, from the name the client asked for"""
+    name = posixpath.basename((name or '').replace('\\', '/')).strip()
+    if not name:
+        return DEFAULT_BUNDLE_NAME
+    if not name.lower().endswith('.zip'):
+        name = name[:251] + '.zip'
+    return name[-255:]
+
+
+def archive_name(path, fallback):
+    """
+    Path of an entry inside the archive: relative, with forward slashes
+    and without '.' or '..' components, so extracting it cannot write
+    outside the target directory. Falls back to the file's own name.
+    """
+    parts = [part for part in (path or '').replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    return '/'.join(parts)[-500:] or fallback
+
+
+def _unique_name(name, taken):
+    """``name``, numbered like 'report (2).pdf' if another entry already has it"""
+    if name not in taken:
+        return name
+    stem, extension = posixpath.splitext(name)
+    number = 2
+    while f'{stem} ({number}){extension}' in taken:
+        number += 1
+    return f'{stem} ({number}){extension}'
+
+
+def create_bundle(received, name=None, paths=None):
+    """
+    Create the bundle share for stored files, given as (uploaded_file,
+    storage fields) pairs as returned by receive_bundle. The bundle row
+    is one INSERT and its files are added with batched bulk INSERTs, in
+    one transaction. ``paths`` optionally gives each file's path inside
+    the archive, in upload order.
+    """
+    paths = paths or []
+    taken = set()
+    bundle_files = []
+    for position, (uploaded_file, stored) in enumerate(received):
+        path = paths[position] if position < len(paths) else None
+        entry_name = _unique_name(archive_name(path, uploaded_file.name), taken)
+        taken.add(entry_name)
+        bundle_files.append(BundleFile(
+            position=position,
+            name=entry_name,
+            file_size=uploaded_file.size,
+            content_type=uploaded_file.content_type or 'application/octet-stream',
+            crc32=uploaded_file.crc32,
+            **stored,
+        ))
+
+    with transaction.atomic():
+        bundle = FileShare.objects.create(
+            original_filename=bundle_filename(name),
+            file_size=sum(bundle_file.file_size for bundle_file in bundle_files),
+            content_type=BUNDLE_CONTENT_TYPE,
+            file_path='',
+            is_bundle=True,
+        )
+        for bundle_file in bundle_files:
+            bundle_file.bundle = bundle
+        BundleFile.objects.bulk_create(bundle_files, batch_size=CREATE_BATCH_SIZE)
+    return bundle
+
+
+def _read_file(full_path):
+    """Yield a stored file block by block"""
+    with open(full_path, 'rb') as f:
+        while True:
+            block = f.read(READ_SIZE)
+            if not block:
+                break
+            yield block
+
+
+def _read_deflate(full_path, length):
+    """Yield the raw deflate stream inside a gzip-stored file, without inflating it"""
+    with open(full_path, 'rb') as f:
+        if gzip_header_size(f) != GZIP_HEADER_SIZE:
+            raise ValueError(f'{full_path} was not written by compressor()')
+        while length > 0:
+            block = f.read(min(READ_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def build_archive(bundle):
+    """
+    The files of a bundle as a ZipStream. Compressible content is
+    deflated and everything else stored. Content kept gzipped on disk
+    already is a deflate stream, so it is copied into the archive
+    without being recompressed. Raises FileNotFoundError when a file
+    is missing, before anything has been sent.
+    """
+    modified = timezone.localtime(bundle.created_at)
+    entries = []
+    for bundle_file in bundle.bundle_files.order_by('position'):
+        full_path = resolve_path(bundle_file.file_path)
+        if not os.path.exists(full_path):
+            raise FileNotFoundError(full_path)
+
+        entry = partial(ZipEntry, bundle_file.name, bundle_file.file_size, bundle_file.crc32, modified)
+        if bundle_file.content_encoding == ENCODING_GZIP:
+            # compressor() writes a fixed-size header; _read_deflate checks it
+            length = bundle_file.stored_size - GZIP_HEADER_SIZE - GZIP_TRAILER_SIZE
+            entries.append(entry(
+                partial(_read_deflate, full_path, length), method=ZIP_DEFLATED, compressed_size=length
+            ))
+        elif is_compressible(bundle_file.content_type, bundle_file.name):
+            entries.append(entry(partial(_read_file, full_path), method=ZIP_DEFLATED))
+        else:
+            entries.append(entry(partial(_read_file, full_path)))
+    return ZipStream(entries, level=get_level())
@@ -0,0 +1,186 @@
+import os
+import shutil
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from . import metrics, packs
+from .profiling import phase
+from .models import FileShare, UploadChunk, UploadSession
+from .storage import media_path
+from .upload_handlers import PARTIAL_PREFIX, get_uploads_dir, store_upload
+
+
+# Size of the pieces a chunk body is copied to disk in
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+class ChunkedUploadError(Exception):
+    """Raised when a chunked upload request cannot be accepted"""
+
+
+def get_chunked_max_size():
+    """Maximum total size in bytes of a chunked upload"""
+    return getattr(settings, 'CHUNKED_UPLOAD_MAX_SIZE', 1024 * 1024 * 1024)
+
+
+def get_default_chunk_size():
+    """Chunk size handed out when the client does not ask for one"""
+    return getattr(settings, 'CHUNKED_UPLOAD_CHUNK_SIZE', 5 * 1024 * 1024)
+
+
+def create_session(original_filename, file_size, content_type=None, chunk_size=None):
+    """
+    Create an upload session and a sparse partial file of the final size,
+    so chunks can be written in place at their offsets in any order.
+    """
+    if not original_filename:
+        raise ChunkedUploadError('No filename provided')
+    if file_size < 0:
+        raise ChunkedUploadError('Invalid file size')
+    if file_size > get_chunked_max_size():
+        raise ChunkedUploadError(
+            f'File size exceeds {get_chunked_max_size() // (1024 * 1024)}MB limit'
+        )
+
+    max_chunk_size = get_default_chunk_size()
+    chunk_size = chunk_size or max_chunk_size
+    if chunk_size <= 0 or chunk_size > max_chunk_size:
+        raise ChunkedUploadError(f'Chunk size must be between 1 and {max_chunk_size} bytes')
+
+    session = UploadSession(
+        original_filename=os.path.basename(original_filename),
+        file_size=file_size,
+        content_type=content_type or 'application/octet-stream',
+        chunk_size=chunk_size,
+        expires_at=timezone.now() + timedelta(
+            hours=getattr(settings, 'UPLOAD_SESSION_EXPIRE_HOURS', 24)
+        ),
+    )
+    partial_name = f"{PARTIAL_PREFIX}{session.id.hex}"
+    session.partial_path = f"uploads/{partial_name}"
+
+    with open(os.path.join(get_uploads_dir(), partial_name), 'wb') as partial_file:
+        partial_file.truncate(file_size)
+
+    session.save()
+    return session
+
+
+def write_chunk(session, index, stream, content_length):
+    """
+    Copy one chunk from the request stream to its offset in the partial
+    file. Each request writes through its own file handle, so chunks of
+    the same session can be received in parallel.
+    """
+    if index < 0 or index >= session.total_chunks:
+        raise ChunkedUploadError('Chunk index out of range')
+
+    expected_length = session.chunk_length(index)
+    if content_length != expected_length:
+        raise ChunkedUploadError(f'Chunk {index} must be exactly {expected_length} bytes')
+
+    partial_path = os.path.join(settings.MEDIA_ROOT, session.partial_path)
+    written = 0
+    with phase('receive'), open(partial_path, 'r+b') as partial_file:
+        partial_file.seek(index * session.chunk_size)
+        while written < expected_length:
+            data = stream.read(min(COPY_BUFFER_SIZE, expected_length - written))
+            if not data:
+                break
+            partial_file.write(data)
+            written += len(data)
+
+    if written != expected_length:
+        raise ChunkedUploadError(f'Chunk {index} was incomplete')
+
+    try:
+        # Savepoint, so a duplicate doesn't break an enclosing transaction
+        with transaction.atomic():
+            UploadChunk.objects.create(session=session, index=index, size=written)
+    except IntegrityError:
+        # Chunk was re-sent; the bytes on disk were simply overwritten
+        pass
+    return written
+
+
+def complete_session(session):
+    """
+    Turn a fully received session into a FileShare. The chunks already
+    sit at their final offsets, so assembling is a single rename.
+    Returns None if another request completed the session first.
+    """
+    received = session.chunks.count()
+    if received < session.total_chunks:
+        raise ChunkedUploadError(
+            f'Upload incomplete: {received} of {session.total_chunks} chunks received'
+        )
+
+    # The row lock makes concurrent completions wait; the session is only
+    # deleted once its file is stored and shared, so a failed completion
+    # rolls back, gets its partial file back, and the client can retry
+    partial_path = os.path.join(settings.MEDIA_ROOT, session.partial_path)
+    stored = None
+    try:
+        with transaction.atomic():
+            if not UploadSession.objects.select_for_update().filter(pk=session.pk).exists():
+                return None
+            if not os.path.exists(partial_path):
+                # Stored by a completion that has not committed yet
+                return None
+
+            with phase('storage'):
+                stored = store_upload(partial_path, session.original_filename, file_size=session.file_size)
+            file_share = FileShare.objects.create(
+                original_filename=session.original_filename,
+                file_size=session.file_size,
+                content_type=session.content_type,
+                **stored,
+            )
+            UploadSession.objects.filter(pk=session.pk).delete()
+    except BaseException:
+        if stored is not None:
+            _restore_partial(stored, partial_path)
+        raise
+    metrics.record_upload(file_share.file_size)
+    return file_share
+
+
+def _restore_partial(stored, partial_path):
+    """
+    Put a stored upload back at its partial path after the transaction
+    recording it rolled back. The rollback also undid any blob row or
+    reference and pack segment claim the store made.
+    """
+    if stored.get('pack_segment') is not None:
+        # The segment keeps a dead copy until the compactor rewrites it
+        with open(partial_path, 'wb') as f:
+            f.write(packs.read_entry(FileShare(**stored)))
+    elif stored.get('blob') is not None and stored['blob'].ref_count > 1:
+        # Linked to content other rows still share
+        shutil.copyfile(media_path(stored['file_path']), partial_path)
+    else:
+        # A file of its own, or a blob whose row was created and rolled back
+        os.replace(media_path(stored['file_path']), partial_path)
+
+
+def abort_session(session):
+    """Delete an upload session and its partial file"""
+    partial_path = os.path.join(settings.MEDIA_ROOT, session.partial_path)
+    if os.path.exists(partial_path):
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+    session.delete()
+
+
+def cleanup_expired_sessions(dry_run=False):
+    """Remove upload sessions that were never completed. Returns the count."""
+    expired_sessions = UploadSession.objects.filter(expires_at__lt=timezone.now())
+    count = 0
+    for session in expired_sessions:
+        if not dry_run:
+            abort_session(session)
+        count += 1
+    return count
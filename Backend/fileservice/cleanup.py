@@ -0,0 +1,223 @@
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from . import metadata_cache, metrics
+from .blobs import delete_unreferenced_blobs, release_blobs
+from .models import BundleFile, FileShare
+from .storage import resolve_path
+
+
+# Outcomes of removing a single file from disk
+FILE_DELETED = 'deleted'
+FILE_MISSING = 'missing'
+FILE_ERROR = 'error'
+FILE_SHARED = 'shared'  # Deduplicated content; removed with its last reference
+FILE_PACKED = 'packed'  # Inside a pack segment; the compactor reclaims the space
+FILE_BUNDLE = 'bundle'  # Several files; each removed, or released if deduplicated
+
+
+def get_batch_size():
+    """Rows handled per batch"""
+    return getattr(settings, 'CLEANUP_BATCH_SIZE', 500)
+
+
+def get_time_budget():
+    """Seconds a cleanup run may take before it stops, or None for no limit"""
+    return getattr(settings, 'CLEANUP_TIME_BUDGET', None) or None
+
+
+def get_unlink_workers():
+    """Size of the thread pool used to remove files"""
+    return getattr(settings, 'CLEANUP_UNLINK_WORKERS', 8)
+
+
+class CleanupResult:
+    """Counters for one cleanup run"""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.records_deleted = 0
+        self.files_deleted = 0
+        self.files_missing = 0
+        self.references_released = 0
+        self.packed_released = 0
+        self.batches = 0
+        self.budget_exhausted = False
+        self.errors = []
+
+    def __str__(self):
+        verb = 'Would delete' if self.dry_run else 'Deleted'
+        return f"{verb} {self.records_deleted} records and {self.files_deleted} files"
+
+
+def _remove_file(full_path, dry_run):
+    """Remove one file, or just check it exists on a dry run"""
+    try:
+        if dry_run:
+            return (FILE_DELETED, None) if os.path.exists(full_path) else (FILE_MISSING, None)
+        os.remove(full_path)
+        return FILE_DELETED, None
+    except FileNotFoundError:
+        return FILE_MISSING, None
+    except OSError as e:
+        return FILE_ERROR, str(e)
+
+
+def _release_row(row, entries, dry_run):
+    """
+    Free what one row holds on disk. Returns (outcome, error, files
+    removed). A bundle removes the files of its entries; their blob
+    references are released along with the row.
+    """
+    if row['is_bundle']:
+        removed = 0
+        for entry in entries:
+            if entry['blob_id']:
+                continue
+            outcome, error = _remove_file(resolve_path(entry['file_path']), dry_run)
+            if outcome == FILE_ERROR:
+                return FILE_ERROR, error, removed
+            removed += outcome == FILE_DELETED
+        return FILE_BUNDLE, None, removed
+    if row['blob_id']:
+        return FILE_SHARED, None, 0
+    if row['pack_segment_id']:
+        return FILE_PACKED, None, 0
+    outcome, error = _remove_file(resolve_path(row['file_path']), dry_run)
+    return outcome, error, int(outcome == FILE_DELETED)
+
+
+def expired_queryset(now=None):
+    """Rows whose expiry has passed"""
+    return FileShare.objects.filter(expires_at__lt=now or timezone.now())
+
+
+def run_cleanup(queryset=None, dry_run=False, batch_size=None, time_budget=None,
+                workers=None, on_file=None):
+    """
+    Delete FileShare rows and their files in keyset-paginated batches.
+
+    Each batch reads at most ``batch_size`` rows ordered by id, removes
+    their files through a bounded thread pool and then deletes the rows
+    with a single ``DELETE ... WHERE id IN (...)``, after one more for
+    the entries of any bundles among them. Rows whose file could
+    not be removed are kept for the next run. The run stops early once
+    ``time_budget`` seconds have passed. ``on_file(row, outcome, error)``
+    is called for every row, with ``row`` a dict of id, code,
+    original_filename, file_path, blob_id, pack_segment_id and is_bundle.
+    Deduplicated files are not unlinked per row; the row only drops its
+    blob reference, and the blob is removed once the last reference is
+    gone. Packed files have nothing to unlink either; their segment
+    space is reclaimed by the pack compactor. A bundle row removes the
+    files of all its entries; a failure on any of them keeps the bundle.
+    """
+    queryset = expired_queryset() if queryset is None else queryset
+    batch_size = batch_size or get_batch_size()
+    time_budget = get_time_budget() if time_budget is None else time_budget
+    workers = workers or get_unlink_workers()
+
+    result = CleanupResult(dry_run=dry_run)
+    started = time.monotonic()
+    last_id = 0
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cleanup-unlink') as pool:
+        while True:
+            if time_budget and time.monotonic() - started >= time_budget:
+                result.budget_exhausted = True
+                break
+
+            rows = list(
+                queryset
+                .filter(id__gt=last_id)
+                .order_by('id')
+                .values(
+                    'id', 'code', 'original_filename', 'file_path', 'blob_id', 'pack_segment_id', 'is_bundle'
+                )[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            result.batches += 1
+
+            bundle_entries = {}
+            bundle_ids = [row['id'] for row in rows if row['is_bundle']]
+            if bundle_ids:
+                for entry in (BundleFile.objects.filter(bundle_id__in=bundle_ids)
+                              .values('bundle_id', 'file_path', 'blob_id')):
+                    bundle_entries.setdefault(entry['bundle_id'], []).append(entry)
+
+            outcomes = pool.map(
+                lambda row: _release_row(row, bundle_entries.get(row['id'], ()), dry_run),
+                rows,
+            )
+
+            deletable_ids = []
+            deletable_codes = []
+            deletable_bundle_ids = []
+            released = Counter()
+            for row, (outcome, error, removed) in zip(rows, outcomes):
+                result.files_deleted += removed
+                if outcome == FILE_SHARED:
+                    released[row['blob_id']] += 1
+                elif outcome == FILE_BUNDLE:
+                    for entry in bundle_entries.get(row['id'], ()):
+                        if entry['blob_id']:
+                            released[entry['blob_id']] += 1
+                elif outcome == FILE_PACKED:
+                    result.packed_released += 1
+                elif outcome == FILE_DELETED:
+                    pass  # Already counted in files_deleted
+                elif outcome == FILE_MISSING:
+                    result.files_missing += 1
+                else:
+                    result.errors.append(f"Error processing {row['code']}: {error}")
+                if outcome != FILE_ERROR:
+                    deletable_ids.append(row['id'])
+                    deletable_codes.append(row['code'])
+                    if row['is_bundle']:
+                        deletable_bundle_ids.append(row['id'])
+                if on_file is not None:
+                    on_file(row, outcome, error)
+
+            result.references_released += sum(released.values())
+            if dry_run:
+                result.records_deleted += len(deletable_ids)
+            elif deletable_ids:
+                # Rows and their blob references go together; only rows this
+                # run actually deletes give up a reference
+                with transaction.atomic():
+                    blob_counts = Counter()
+                    if released:
+                        blob_counts.update(
+                            FileShare.objects.select_for_update()
+                            .filter(id__in=deletable_ids, blob__isnull=False)
+                            .values_list('blob_id', flat=True)
+                        )
+                        # Bundle entries go with their bundle's row
+                        blob_counts.update(
+                            BundleFile.objects.select_for_update()
+                            .filter(bundle_id__in=deletable_ids, blob__isnull=False)
+                            .values_list('blob_id', flat=True)
+                        )
+                    # Bundle entries are the only rows that cascade from a share;
+                    # with them gone the shares go in one DELETE, without the
+                    # ORM fetching every row to collect its dependents
+                    if deletable_bundle_ids:
+                        BundleFile.objects.filter(bundle_id__in=deletable_bundle_ids).delete()
+                    shares = FileShare.objects.filter(id__in=deletable_ids)
+                    deleted = shares._raw_delete(shares.db)
+                    release_blobs(blob_counts)
+                result.records_deleted += deleted
+                metadata_cache.invalidate(*deletable_codes)
+                if blob_counts:
+                    result.files_deleted += delete_unreferenced_blobs(blob_ids=list(blob_counts))
+
+    if not dry_run:
+        metrics.CLEANUP_DURATION.observe(time.monotonic() - started)
+        metrics.CLEANUP_RECORDS.inc(result.records_deleted)
+        metrics.CLEANUP_FILES.inc(result.files_deleted)
+    return result
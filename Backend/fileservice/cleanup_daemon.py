@@ -0,0 +1,175 @@
+import heapq
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from datetime import timedelta
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from .cleanup import FILE_ERROR, run_cleanup
+from .models import FileShare
+
+logger = logging.getLogger(__name__)
+
+
+class CleanupDaemon:
+    """
+    Resident cleanup loop that deletes files within seconds of expiry.
+
+    Upcoming ``expires_at`` values are kept in an in-memory heap. Every
+    refresh reads only the near-future slice of the ``expires_at`` index
+    (rows expiring within ``horizon`` seconds, plus any overdue backlog)
+    and merges it into the heap, so the table is never scanned in full.
+    """
+
+    def __init__(self, refresh_interval=2.0, horizon=300, batch_size=500,
+                 sweep_interval=300, sweep=None, stats_file=None, stdout=None):
+        self.refresh_interval = refresh_interval
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.sweep_interval = sweep_interval
+        self.sweep = sweep
+        self.stats_file = stats_file
+        self.stdout = stdout
+
+        self._heap = []
+        self._expiries = {}
+        self._cursor = None
+        self._stop = threading.Event()
+        self._last_sweep = time.time()
+
+        self.stats = {
+            'started_at': time.time(),
+            'refreshes': 0,
+            'files_deleted': 0,
+            'records_deleted': 0,
+            'errors': 0,
+            'tracked': 0,
+            'backlog': 0,
+            'last_lag_seconds': 0.0,
+            'max_lag_seconds': 0.0,
+            'last_refresh_at': None,
+        }
+
+    def stop(self, *args):
+        """Ask the loop to finish its current pass and exit"""
+        self._stop.set()
+
+    def install_signal_handlers(self):
+        """Stop gracefully on SIGTERM and SIGINT"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run(self):
+        """Run until stopped"""
+        next_refresh = 0
+        while not self._stop.is_set():
+            now = time.time()
+            try:
+                if now >= next_refresh:
+                    self.refresh()
+                    next_refresh = now + self.refresh_interval
+                self.delete_due()
+                if self.sweep is not None and now - self._last_sweep >= self.sweep_interval:
+                    self._last_sweep = now
+                    self.sweep()
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception('Cleanup daemon pass failed')
+            finally:
+                close_old_connections()
+
+            self.write_stats()
+            self._stop.wait(self._sleep_time(next_refresh))
+
+        self.write_stats()
+
+    def refresh(self):
+        """
+        Merge rows expiring within the horizon into the heap. A window
+        holding more than ``batch_size`` rows is read a page per refresh,
+        keyset on (expires_at, id), so rows that keep failing to delete
+        cannot hide the ones behind them.
+        """
+        window_end = timezone.now() + timedelta(seconds=self.horizon)
+        rows = FileShare.objects.filter(expires_at__isnull=False, expires_at__lte=window_end)
+        if self._cursor is not None:
+            after, after_id = self._cursor
+            rows = rows.filter(Q(expires_at__gt=after) | Q(expires_at=after, id__gt=after_id))
+        rows = list(rows.order_by('expires_at', 'id').values_list('id', 'expires_at')[:self.batch_size])
+        # A short page ends the window; the next refresh starts over
+        self._cursor = (rows[-1][1], rows[-1][0]) if len(rows) == self.batch_size else None
+
+        for file_id, expires_at in rows:
+            when = expires_at.timestamp()
+            if self._expiries.get(file_id) != when:
+                # New row, or its expiry moved; stale heap entries are skipped later
+                self._expiries[file_id] = when
+                heapq.heappush(self._heap, (when, file_id))
+
+        self.stats['refreshes'] += 1
+        self.stats['last_refresh_at'] = time.time()
+        self._update_gauges()
+
+    def delete_due(self):
+        """Delete every tracked file whose expiry has passed"""
+        now = time.time()
+        due = {}
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            when, file_id = heapq.heappop(self._heap)
+            if self._expiries.get(file_id) != when:
+                continue
+            del self._expiries[file_id]
+            due[file_id] = when
+
+        if due:
+            self._delete(due, now)
+        self._update_gauges()
+
+    def _delete(self, due, now):
+        # Re-check expiry in the query; a row may have changed since it was read
+        deleted_ids = []
+        result = run_cleanup(
+            queryset=FileShare.objects.filter(id__in=list(due), expires_at__lte=timezone.now()),
+            batch_size=self.batch_size,
+            on_file=lambda row, outcome, error: outcome != FILE_ERROR and deleted_ids.append(row['id']),
+        )
+        self.stats['files_deleted'] += result.files_deleted
+        self.stats['records_deleted'] += result.records_deleted
+        self.stats['errors'] += len(result.errors)
+        for error in result.errors:
+            logger.error(error)
+
+        if deleted_ids:
+            lag = max(now - due[file_id] for file_id in deleted_ids)
+            self.stats['last_lag_seconds'] = round(lag, 3)
+            self.stats['max_lag_seconds'] = round(max(self.stats['max_lag_seconds'], lag), 3)
+            if self.stdout is not None:
+                self.stdout.write(f'Deleted {result.records_deleted} expired files (lag {lag:.2f}s)')
+
+    def _update_gauges(self):
+        now = time.time()
+        self.stats['tracked'] = len(self._expiries)
+        self.stats['backlog'] = sum(1 for when in self._expiries.values() if when <= now)
+
+    def _sleep_time(self, next_refresh):
+        """Sleep until the next expiry or refresh, whichever comes first"""
+        wake_at = next_refresh
+        if self._heap:
+            wake_at = min(wake_at, self._heap[0][0])
+        return max(0.0, min(wake_at - time.time(), self.refresh_interval))
+
+    def write_stats(self):
+        """Write the current stats as JSON for monitoring"""
+        if not self.stats_file:
+            return
+        tmp_path = f"{self.stats_file}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({**self.stats, 'updated_at': time.time()}, f)
+            os.replace(tmp_path, self.stats_file)
+        except OSError:
+            logger.exception('Could not write cleanup daemon stats to %s', self.stats_file)
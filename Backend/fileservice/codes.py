@@ -0,0 +1,128 @@
+import logging
+import secrets
+import string
+import threading
+from collections import deque
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CODE_ALPHABET = string.ascii_letters + string.digits
+
+# Random bytes at or above this are rejected, so every character is equally likely
+_BYTE_LIMIT = 256 - 256 % len(CODE_ALPHABET)
+
+# Inserts attempted per row before a code collision is treated as an error
+MAX_ALLOCATION_ATTEMPTS = 5
+
+# Shared counter holding the number of collisions seen by all workers
+COLLISIONS_COUNTER = 'code-collisions'
+
+
+def get_code_length():
+    """Number of characters in a share code"""
+    return getattr(settings, 'CODE_LENGTH', 8)
+
+
+def get_pool_size():
+    """Codes pre-generated per refill of the reserved pool, 0 to disable it"""
+    return getattr(settings, 'FILE_CODE_POOL_SIZE', 0)
+
+
+def code_space(length=None):
+    """Number of distinct codes"""
+    return len(CODE_ALPHABET) ** (length or get_code_length())
+
+
+def random_codes(count, length=None):
+    """
+    Generate ``count`` codes from the system CSPRNG, reading the random
+    bytes for the whole batch at once.
+    """
+    length = length or get_code_length()
+    codes = []
+    chars = []
+    while len(codes) < count:
+        # Ask for a little more than needed to make up for rejected bytes
+        needed = (count - len(codes)) * length - len(chars)
+        for byte in secrets.token_bytes(needed + needed // 16 + 8):
+            if byte >= _BYTE_LIMIT:
+                continue
+            chars.append(CODE_ALPHABET[byte % len(CODE_ALPHABET)])
+            if len(chars) == length:
+                codes.append(''.join(chars))
+                chars = []
+                if len(codes) == count:
+                    break
+    return codes
+
+
+class CodePool:
+    """
+    Per-process pool of pre-generated codes, refilled in bulk when it
+    runs dry, so an upload only pops a ready code off a deque.
+    """
+
+    def __init__(self):
+        self._codes = deque()
+        self._lock = threading.Lock()
+
+    def take(self, refill_size):
+        try:
+            return self._codes.popleft()
+        except IndexError:
+            pass
+        with self._lock:
+            if not self._codes:
+                self._codes.extend(random_codes(refill_size))
+            return self._codes.popleft()
+
+    def __len__(self):
+        return len(self._codes)
+
+
+code_pool = CodePool()
+
+
+def next_code():
+    """A fresh random share code, from the reserved pool when it is enabled"""
+    pool_size = get_pool_size()
+    if pool_size > 0:
+        return code_pool.take(pool_size)
+    length = get_code_length()
+    return ''.join(secrets.choice(CODE_ALPHABET) for _ in range(length))
+
+
+def is_code_collision(error):
+    """Check whether an IntegrityError came from the unique index on the code"""
+    message = str(error)
+    return any(marker in message for marker in ('file_shares.code', "key 'code'", 'file_shares_code'))
+
+
+def record_collision(code):
+    """Count a code collision for every worker to see"""
+    from .counters import increment_counter
+
+    logger.warning('Share code %s already taken, retrying with a new code', code)
+    try:
+        increment_counter(COLLISIONS_COUNTER)
+    except Exception:
+        logger.exception('Could not record share code collision')
+
+
+def collision_report(live_codes, codes_allocated, collisions, length=None):
+    """
+    Summarize how full the code space is. The chance that one random
+    code collides equals the fraction of the space in use.
+    """
+    space = code_space(length)
+    fill = live_codes / space
+    return {
+        'code_space': space,
+        'live_codes': live_codes,
+        'codes_allocated': codes_allocated,
+        'collisions': collisions,
+        'observed_collision_rate': collisions / codes_allocated if codes_allocated else 0.0,
+        'expected_collision_rate': fill,
+        'retry_exhaustion_probability': fill ** MAX_ALLOCATION_ATTEMPTS,
+    }
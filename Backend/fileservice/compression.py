@@ -0,0 +1,193 @@
+"""
+Optional compression of stored files.
+
+Uploads whose content type compresses well are gzipped while they are
+written to disk. Downloads send the stored bytes with
+``Content-Encoding: gzip`` to clients that accept it and decompress
+them on the fly for everyone else.
+"""
+import mimetypes
+import zlib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from .ranges import file_etag
+
+ENCODING_GZIP = 'gzip'
+
+# Content types worth compressing, matched by prefix
+DEFAULT_COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/ld+json',
+    'application/x-ndjson',
+    'application/xml',
+    'application/javascript',
+    'application/csv',
+    'application/sql',
+    'application/x-yaml',
+    'application/yaml',
+    'application/x-sh',
+    'image/svg+xml',
+)
+
+# Leading bytes of formats that are already compressed, whatever their declared type
+COMPRESSED_SIGNATURES = (
+    b'\x1f\x8b',  # gzip
+    b'PK\x03\x04',  # zip, docx, xlsx, jar
+    b'BZh',  # bzip2
+    b'\xfd7zXZ\x00',  # xz
+    b'(\xb5/\xfd',  # zstd
+    b"7z\xbc\xaf'\x1c",  # 7-Zip
+    b'Rar!',  # rar
+    b'\x89PNG',  # png
+    b'\xff\xd8\xff',  # jpeg
+    b'GIF8',  # gif
+    b'OggS',  # ogg
+)
+
+# Size of the stored blocks read when decompressing a download
+READ_SIZE = 256 * 1024
+
+# Header written by compressor(): no file name, comment or extra field
+GZIP_HEADER_SIZE = 10
+
+# CRC-32 and original size that end every gzip stream
+GZIP_TRAILER_SIZE = 8
+
+
+def compression_enabled():
+    """Whether new uploads may be stored compressed"""
+    return getattr(settings, 'STORAGE_COMPRESSION', False)
+
+
+def get_level():
+    """zlib compression level, 1 (fastest) to 9 (smallest)"""
+    return getattr(settings, 'STORAGE_COMPRESSION_LEVEL', 6)
+
+
+def get_compressible_types():
+    """Content type prefixes that are compressed"""
+    return tuple(getattr(settings, 'STORAGE_COMPRESSION_TYPES', DEFAULT_COMPRESSIBLE_TYPES))
+
+
+def is_compressible(content_type, file_name):
+    """
+    Check whether content of this type compresses well. Falls back to
+    the file extension when the client sent no useful type.
+    """
+    if not content_type or content_type == 'application/octet-stream':
+        content_type, _ = mimetypes.guess_type(file_name or '')
+    return bool(content_type) and content_type.lower().startswith(get_compressible_types())
+
+
+def should_compress(content_type, file_name):
+    """Check whether an upload of this type should be stored compressed"""
+    return compression_enabled() and is_compressible(content_type, file_name)
+
+
+def looks_compressed(head):
+    """Check the first bytes of a file for a compressed format's signature"""
+    return head.startswith(COMPRESSED_SIGNATURES)
+
+
+def compressor():
+    """A streaming gzip compressor"""
+    return zlib.compressobj(get_level(), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_header_size(f):
+    """
+    Length of the gzip header at the start of an open file, which is
+    followed by the raw deflate stream and an 8-byte trailer
+    """
+    header = f.read(GZIP_HEADER_SIZE)
+    if len(header) < GZIP_HEADER_SIZE or header[:3] != b'\x1f\x8b\x08':
+        raise ValueError('Not a gzip file')
+    flags = header[3]
+    size = GZIP_HEADER_SIZE
+    if flags & 0x04:  # FEXTRA
+        extra_length = int.from_bytes(f.read(2), 'little')
+        f.seek(extra_length, 1)
+        size += 2 + extra_length
+    for flag in (0x08, 0x10):  # FNAME, FCOMMENT: zero-terminated
+        if flags & flag:
+            while True:
+                byte = f.read(1)
+                size += 1
+                if byte in (b'', b'\0'):
+                    break
+    if flags & 0x02:  # FHCRC
+        f.read(2)
+        size += 2
+    return size
+
+
+def accepts_encoding(accept_encoding, encoding):
+    """Check whether an Accept-Encoding header allows ``encoding``"""
+    if not accept_encoding:
+        return False
+    wildcard = None
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        name = name.strip().lower()
+        if name == encoding:
+            return quality > 0
+        if name == '*':
+            wildcard = quality > 0
+    return bool(wildcard)
+
+
+def iter_decompressed(file_path):
+    """
+    Yield the decompressed content of a gzip file in blocks of at most
+    READ_SIZE bytes, however well the input compresses
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(file_path, 'rb') as f:
+        while True:
+            block = decompressor.unconsumed_tail or f.read(READ_SIZE)
+            if not block:
+                break
+            data = decompressor.decompress(block, READ_SIZE)
+            if data:
+                yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+async def aiter_decompressed(file_path):
+    """Async version of iter_decompressed; reading and inflating run in a worker thread"""
+    blocks = iter_decompressed(file_path)
+    next_block = sync_to_async(lambda: next(blocks, None), thread_sensitive=False)
+    try:
+        while True:
+            data = await next_block()
+            if data is None:
+                break
+            yield data
+    finally:
+        blocks.close()
+
+
+def add_encoding_headers(response, encoding, encoded, stat_result=None):
+    """
+    Describe the representation of a compressed file. Byte ranges are
+    not offered, since they would not map onto the stored bytes.
+    """
+    patch_vary_headers(response, ('Accept-Encoding',))
+    response['Accept-Ranges'] = 'none'
+    if encoded:
+        response['Content-Encoding'] = encoding
+    if stat_result is not None:
+        etag = file_etag(stat_result)
+        response['ETag'] = f'{etag[:-1]}-{encoding}"' if encoded else etag
+    return response
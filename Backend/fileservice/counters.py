@@ -0,0 +1,20 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .models import SharedCounter
+
+
+def increment_counter(name, amount=1):
+    """Add to a named counter with a single UPDATE, creating it on first use"""
+    if SharedCounter.objects.filter(name=name).update(value=F('value') + amount):
+        return
+    try:
+        with transaction.atomic():
+            SharedCounter.objects.create(name=name, value=amount)
+    except IntegrityError:
+        # Created by another worker meanwhile
+        SharedCounter.objects.filter(name=name).update(value=F('value') + amount)
+
+
+def get_counter(name):
+    """Current value of a named counter"""
+    return SharedCounter.objects.filter(name=name).values_list('value', flat=True).first() or 0
@@ -0,0 +1,212 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free in time"""
+
+
+class ConnectionPool:
+    """
+    A bounded pool of raw DB-API connections shared by every thread of
+    one process. At most ``max_size`` connections are open at a time;
+    callers beyond that wait up to ``timeout`` seconds for a free one.
+    Idle connections are pinged before reuse once they have been idle
+    for ``ping_after`` seconds, and replaced after ``recycle`` seconds.
+    """
+
+    def __init__(self, max_size=10, timeout=5.0, recycle=None, ping_after=30.0):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = []  # (connection, created_at, released_at), most recent last
+        self._created_at = {}  # id(connection) -> created_at, for connections in use
+        self._counters = {
+            'created': 0,
+            'reused': 0,
+            'recycled': 0,
+            'health_check_failures': 0,
+            'waits': 0,
+            'timeouts': 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def acquire(self, connect, ping=None):
+        """
+        Take a connection from the pool, opening one with ``connect()``
+        when none is idle. ``ping(connection)`` should raise if an idle
+        connection is no longer usable.
+        """
+        if not self._slots.acquire(blocking=False):
+            self._count('waits')
+            if not self._slots.acquire(timeout=self.timeout):
+                self._count('timeouts')
+                raise PoolTimeout(
+                    f'No database connection became free within {self.timeout}s '
+                    f'(pool size {self.max_size})'
+                )
+
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, created_at, released_at = self._idle.pop()
+
+                now = time.monotonic()
+                if self.recycle and now - created_at >= self.recycle:
+                    self._count('recycled')
+                    _close_quietly(connection)
+                    continue
+                if ping is not None and now - released_at >= self.ping_after:
+                    try:
+                        ping(connection)
+                    except Exception:
+                        self._count('health_check_failures')
+                        _close_quietly(connection)
+                        continue
+
+                with self._lock:
+                    self._counters['reused'] += 1
+                    self._created_at[id(connection)] = created_at
+                return connection
+
+            connection = connect()
+            with self._lock:
+                self._counters['created'] += 1
+                self._created_at[id(connection)] = time.monotonic()
+            return connection
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, connection, reusable=True):
+        """Give a connection back, closing it instead if it can't be reused"""
+        with self._lock:
+            created_at = self._created_at.pop(id(connection), None)
+            if created_at is None:
+                # Not handed out by this pool (or already released)
+                return
+            if reusable:
+                self._idle.append((connection, created_at, time.monotonic()))
+        if not reusable:
+            _close_quietly(connection)
+        self._slots.release()
+
+    def close_idle(self):
+        """Close every idle connection, e.g. on shutdown"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _, _ in idle:
+            _close_quietly(connection)
+
+    def stats(self):
+        """Point-in-time counters for monitoring"""
+        with self._lock:
+            return {
+                'max_size': self.max_size,
+                'in_use': len(self._created_at),
+                'idle': len(self._idle),
+                **self._counters,
+            }
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        logger.debug('Error closing pooled database connection', exc_info=True)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, options):
+    """The process-wide pool for a database alias, created on first use"""
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = ConnectionPool(
+                max_size=options.get('MAX_SIZE', 10),
+                timeout=options.get('TIMEOUT', 5.0),
+                recycle=options.get('RECYCLE'),
+                ping_after=options.get('PING_AFTER', 30.0),
+            )
+        return pool
+
+
+def _reset_after_fork():
+    """Connections inherited from the parent belong to it; drop them without closing"""
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def pool_stats():
+    """Stats of every pool in this process, by database alias"""
+    with _pools_lock:
+        pools = dict(_pools)
+    return {alias: pool.stats() for alias, pool in pools.items()}
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Mixin for Django database backends that takes connections from a
+    per-process ConnectionPool and returns them on close, instead of
+    opening and closing a server connection per request. Enabled by a
+    ``POOL`` dict in the DATABASES entry; without one the backend
+    behaves like the stock one.
+    """
+
+    def connection_pool(self):
+        options = self.settings_dict.get('POOL')
+        if not options:
+            return None
+        return get_pool(self.alias, options)
+
+    def ping_connection(self, connection):
+        """Raise if a raw connection is no longer usable"""
+        raise NotImplementedError
+
+    def get_new_connection(self, conn_params):
+        pool = self.connection_pool()
+        connect = super().get_new_connection
+        if pool is None:
+            return connect(conn_params)
+        try:
+            return pool.acquire(lambda: connect(conn_params), ping=self.ping_connection)
+        except PoolTimeout as e:
+            raise self.Database.OperationalError(str(e)) from e
+
+    def _close(self):
+        pool = self.connection_pool()
+        if pool is None or self.connection is None:
+            return super()._close()
+
+        # Never hand a connection with open work to the next thread
+        reusable = True
+        try:
+            self.connection.rollback()
+        except Exception:
+            reusable = False
+        if self.errors_occurred and reusable:
+            try:
+                self.ping_connection(self.connection)
+            except Exception:
+                reusable = False
+        pool.release(self.connection, reusable=reusable)
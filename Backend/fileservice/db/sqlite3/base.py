@@ -0,0 +1,18 @@
+from django.db.backends.sqlite3 import base
+from fileservice.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """
+    SQLite backend with optional connection pooling, mainly for
+    exercising the pool locally without a MySQL server.
+    """
+
+    def connection_pool(self):
+        # Every connection to an in-memory database is a different database
+        if self.is_in_memory_db():
+            return None
+        return super().connection_pool()
+
+    def ping_connection(self, connection):
+        connection.execute('SELECT 1')
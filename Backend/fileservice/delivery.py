@@ -0,0 +1,278 @@
+import contextvars
+import os
+import tempfile
+import urllib.parse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import RequestAborted
+from django.core.handlers.asgi import ASGIHandler
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import Resolver404, resolve
+from .compression import aiter_decompressed, iter_decompressed
+from .zipstream import aiter_archive
+
+
+# Supported ways of getting file bytes to the client
+DELIVERY_DJANGO = 'django'
+DELIVERY_X_ACCEL_REDIRECT = 'x-accel-redirect'
+DELIVERY_X_SENDFILE = 'x-sendfile'
+
+DELIVERY_MODES = (DELIVERY_DJANGO, DELIVERY_X_ACCEL_REDIRECT, DELIVERY_X_SENDFILE)
+
+# ASGI extension that lets the server send a file by path (os.sendfile)
+ASGI_PATHSEND = 'http.response.pathsend'
+
+# Scope of the ASGI request currently being handled
+_current_scope = contextvars.ContextVar('fileservice_asgi_scope', default=None)
+
+
+def get_delivery_mode():
+    """Return the configured download delivery mode"""
+    mode = getattr(settings, 'DOWNLOAD_DELIVERY_MODE', DELIVERY_DJANGO).lower()
+    if mode not in DELIVERY_MODES:
+        raise ImproperlyConfigured(
+            f"DOWNLOAD_DELIVERY_MODE must be one of {', '.join(DELIVERY_MODES)}, got '{mode}'"
+        )
+    return mode
+
+
+def is_offloaded():
+    """Check if file bytes are served by a reverse proxy instead of Django"""
+    return get_delivery_mode() != DELIVERY_DJANGO
+
+
+def accel_redirect_uri(full_path):
+    """Internal nginx URI for a file under MEDIA_ROOT"""
+    prefix = getattr(settings, 'DOWNLOAD_ACCEL_REDIRECT_PREFIX', '/protected/')
+    relative_path = os.path.relpath(full_path, settings.MEDIA_ROOT)
+    return prefix.rstrip('/') + '/' + urllib.parse.quote(relative_path.replace(os.sep, '/'))
+
+
+def offload_response(full_path, content_type):
+    """
+    Build an empty response that tells the reverse proxy which file to
+    send. The proxy streams the bytes itself and handles Range requests,
+    so the worker is released as soon as this response is returned.
+    """
+    mode = get_delivery_mode()
+    response = HttpResponse(content_type=content_type)
+
+    if mode == DELIVERY_X_ACCEL_REDIRECT:
+        response['X-Accel-Redirect'] = accel_redirect_uri(full_path)
+    elif mode == DELIVERY_X_SENDFILE:
+        # Apache mod_xsendfile and lighttpd expect an absolute path
+        response['X-Sendfile'] = os.path.abspath(full_path)
+    else:
+        raise ImproperlyConfigured('offload_response() requires an offload delivery mode')
+
+    return response
+
+
+class SendfileResponse(FileResponse):
+    """
+    FileResponse for files on local disk that keeps the file's path, so
+    SendfileASGIHandler can send it with ``http.response.pathsend`` when
+    the server supports that extension. That is the only zero-copy path
+    this class adds.
+
+    * WSGI: same as FileResponse. Django hands ``file_to_stream`` to
+      ``wsgi.file_wrapper``, which gunicorn implements with os.sendfile
+      for plain (non-TLS) sockets; only the block size differs.
+    * Anywhere else the file is streamed in ``block_size`` reads.
+    """
+    block_size = 256 * 1024
+
+    def __init__(self, file_path, *args, **kwargs):
+        self.sendfile_path = os.path.abspath(file_path)
+        super().__init__(open(self.sendfile_path, 'rb'), *args, **kwargs)
+
+
+class AsyncSendfileResponse(StreamingHttpResponse):
+    """
+    Streaming response for a file on local disk, for async views. Each
+    block is read in a worker thread and handed to the server before the
+    next one is read, so a slow client applies backpressure without
+    holding a thread. SendfileASGIHandler still sends it by path when
+    the server supports that.
+    """
+    block_size = SendfileResponse.block_size
+
+    def __init__(self, file_path, *args, size=None, **kwargs):
+        self.sendfile_path = os.path.abspath(file_path)
+        super().__init__(self._read_blocks(), *args, **kwargs)
+        if size is None:
+            size = os.path.getsize(self.sendfile_path)
+        self['Content-Length'] = str(size)
+
+    async def _read_blocks(self):
+        """Read the file block by block without blocking the event loop"""
+        f = await sync_to_async(open, thread_sensitive=False)(self.sendfile_path, 'rb')
+        try:
+            read = sync_to_async(f.read, thread_sensitive=False)
+            while True:
+                block = await read(self.block_size)
+                if not block:
+                    break
+                yield block
+        finally:
+            f.close()
+
+
+class DecompressedFileResponse(StreamingHttpResponse):
+    """
+    Streaming response that inflates a gzip-stored file block by block,
+    for clients that don't accept gzip. ``size`` is the original size of
+    the file. Async views pass ``asynchronous=True``.
+    """
+
+    def __init__(self, file_path, *args, size, asynchronous=False, **kwargs):
+        iter_content = aiter_decompressed if asynchronous else iter_decompressed
+        super().__init__(iter_content(file_path), *args, **kwargs)
+        self['Content-Length'] = str(size)
+
+
+class ZipStreamResponse(StreamingHttpResponse):
+    """
+    Streaming response for a ZIP archive that is generated while it is
+    sent (a zipstream.ZipStream). Content-Length is set when the size of
+    the archive is known up front. Async views pass ``asynchronous=True``.
+    """
+
+    def __init__(self, archive, *args, asynchronous=False, **kwargs):
+        super().__init__(aiter_archive(archive) if asynchronous else iter(archive), *args, **kwargs)
+        if archive.size is not None:
+            self['Content-Length'] = str(archive.size)
+
+
+def _encode_headers(response):
+    """Encode response headers and cookies as ASGI header pairs"""
+    response_headers = []
+    for header, value in response.items():
+        if isinstance(header, str):
+            header = header.encode('ascii')
+        if isinstance(value, str):
+            value = value.encode('latin1')
+        response_headers.append((bytes(header), bytes(value)))
+    for c in response.cookies.values():
+        response_headers.append(
+            (b'Set-Cookie', c.output(header='').encode('ascii').strip())
+        )
+    return response_headers
+
+
+def get_body_spool_size():
+    """Request body bytes the ASGI handler keeps in memory before spooling to disk"""
+    return getattr(settings, 'ASGI_BODY_SPOOL_SIZE', 256 * 1024)
+
+
+class RequestBodyTooLarge(Exception):
+    """Raised while receiving a request body larger than its view accepts"""
+
+
+def request_body_limit(path_info):
+    """
+    Largest request body, in bytes, the view at ``path_info`` accepts,
+    or None for no limit. Upload views get their size limit plus room
+    for multipart framing; everything else gets Django's limit for
+    bodies read into memory.
+    """
+    from .bundles import get_max_bundle_size
+    from .chunked_uploads import get_default_chunk_size
+    from .upload_handlers import MULTIPART_OVERHEAD, get_max_upload_size
+
+    limits = {
+        'upload_file': lambda: get_max_upload_size() + MULTIPART_OVERHEAD,
+        'upload_bundle': lambda: get_max_bundle_size() + MULTIPART_OVERHEAD,
+        'upload_chunk': get_default_chunk_size,
+    }
+    try:
+        limit = limits.get(resolve(path_info).url_name)
+    except Resolver404:
+        limit = None
+    return limit() if limit else settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+
+
+class SendfileASGIHandler(ASGIHandler):
+    """
+    ASGI handler that sends SendfileResponse bodies through the
+    ``http.response.pathsend`` extension, so the server can use
+    os.sendfile. Other responses, and servers without the extension,
+    take Django's normal path.
+
+    Django receives the whole request body before the view runs. This
+    handler rejects a body over its view's limit with 413, from
+    Content-Length before reading any of it or as soon as a body
+    without one crosses the limit, and spools bodies larger than
+    ASGI_BODY_SPOOL_SIZE to disk instead of holding them in memory.
+    """
+
+    async def handle(self, scope, receive, send):
+        _current_scope.set(scope)
+        try:
+            await super().handle(scope, receive, send)
+        except RequestBodyTooLarge:
+            response = JsonResponse({'error': 'Request body too large'}, status=413)
+            # The rest of the body is never read, so the connection can't be reused
+            response['Connection'] = 'close'
+            await self.send_response(response, send)
+
+    async def read_body(self, receive):
+        scope = _current_scope.get() or {}
+        path = scope.get('path', '')
+        root_path = scope.get('root_path', '')
+        limit = request_body_limit(path[len(root_path):] if path.startswith(root_path) else path)
+
+        if limit is not None:
+            for name, value in scope.get('headers', ()):
+                if name.lower() == b'content-length':
+                    try:
+                        declared = int(value)
+                    except ValueError:
+                        break
+                    if declared > limit:
+                        raise RequestBodyTooLarge()
+                    break
+
+        spool_size = get_body_spool_size()
+        body_file = tempfile.SpooledTemporaryFile(max_size=spool_size, mode='w+b')
+        received = 0
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    # Early client disconnect
+                    raise RequestAborted()
+                body = message.get('body', b'')
+                received += len(body)
+                if limit is not None and received > limit:
+                    raise RequestBodyTooLarge()
+                # Once spooled to disk, writes are blocking I/O; keep them off the event loop
+                if received > spool_size:
+                    await sync_to_async(body_file.write, thread_sensitive=False)(body)
+                else:
+                    body_file.write(body)
+                if not message.get('more_body', False):
+                    break
+        except BaseException:
+            body_file.close()
+            raise
+        body_file.seek(0)
+        return body_file
+
+    async def send_response(self, response, send):
+        scope = _current_scope.get()
+        sendfile_path = getattr(response, 'sendfile_path', None)
+        extensions = (scope or {}).get('extensions') or {}
+
+        if sendfile_path is None or ASGI_PATHSEND not in extensions:
+            return await super().send_response(response, send)
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': _encode_headers(response),
+        })
+        await send({'type': ASGI_PATHSEND, 'path': sendfile_path})
+        # Closes the file and fires request_finished, like the default path
+        await sync_to_async(response.close, thread_sensitive=True)()
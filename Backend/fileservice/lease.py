@@ -0,0 +1,37 @@
+import os
+import socket
+from datetime import timedelta
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import CleanupLease
+
+
+def lease_holder():
+    """Identify this worker process across the cluster"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_lease(name, ttl):
+    """
+    Try to take the named lease for ``ttl`` seconds. The lease is taken
+    with a single conditional UPDATE, so across all workers and nodes
+    at most one caller wins until it expires. Returns True on success.
+    """
+    now = timezone.now()
+    holder = lease_holder()
+    expires_at = now + timedelta(seconds=ttl)
+
+    won = CleanupLease.objects.filter(name=name, expires_at__lte=now).update(
+        holder=holder, expires_at=expires_at
+    )
+    if won:
+        return True
+
+    # First use of this lease: whoever inserts the row holds it
+    try:
+        with transaction.atomic():
+            CleanupLease.objects.create(name=name, holder=holder, expires_at=expires_at)
+        return True
+    except IntegrityError:
+        return False
+
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import tempfile
+import time
+import urllib.parse
+from wsgiref.util import FileWrapper
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.http import FileResponse
+from django.test import RequestFactory, override_settings
+from django.urls import path
+from fileservice.delivery import ASGI_PATHSEND, SendfileASGIHandler, SendfileResponse
+
+
+def _file_response(request):
+    return FileResponse(open(request.GET['path'], 'rb'))
+
+
+def _sendfile_response(request):
+    return SendfileResponse(request.GET['path'])
+
+
+# URLconf the benchmark serves through, so each method goes through the
+# real handlers and middleware
+urlpatterns = [
+    path('file-response/', _file_response),
+    path('sendfile-response/', _sendfile_response),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare CPU cost per GB of FileResponse and SendfileResponse, served '
+        'through the WSGI handler and through SendfileASGIHandler'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size-mb',
+            type=int,
+            default=256,
+            help='Size of the test file in MB (default: 256)',
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=3,
+            help='Number of runs per delivery method (default: 3)',
+        )
+
+    def handle(self, *args, **options):
+        if not hasattr(os, 'sendfile'):
+            raise CommandError('os.sendfile is not available on this platform')
+
+        size = options['size_mb'] * 1024 * 1024
+        runs = options['runs']
+
+        with tempfile.NamedTemporaryFile(delete=False) as source:
+            block = os.urandom(1024 * 1024)
+            for _ in range(options['size_mb']):
+                source.write(block)
+            source_path = source.name
+
+        try:
+            with override_settings(ROOT_URLCONF=__name__, ALLOWED_HOSTS=['testserver']):
+                self.wsgi_application = WSGIHandler()
+                self.asgi_application = SendfileASGIHandler()
+                self.stdout.write(f'Serving a {options["size_mb"]} MB file {runs} times per method...\n')
+                methods = {
+                    'FileResponse, WSGI': (self._serve_wsgi, 'file-response'),
+                    'SendfileResponse, WSGI': (self._serve_wsgi, 'sendfile-response'),
+                    'FileResponse, ASGI': (self._serve_asgi, 'file-response'),
+                    'SendfileResponse, ASGI': (self._serve_asgi, 'sendfile-response'),
+                    'SendfileResponse, ASGI with pathsend': (self._serve_asgi_pathsend, 'sendfile-response'),
+                }
+                results = {
+                    method: self._measure(serve, f'/{route}/', source_path, runs)
+                    for method, (serve, route) in methods.items()
+                }
+        finally:
+            os.remove(source_path)
+
+        gigabytes = size * runs / (1024 ** 3)
+        self.stdout.write(self.style.SUCCESS('--- Delivery Benchmark ---'))
+        for method, (cpu_seconds, wall_seconds) in results.items():
+            self.stdout.write(
+                f'{method}: {cpu_seconds / gigabytes:.3f} CPU s/GB, '
+                f'{gigabytes / wall_seconds:.2f} GB/s'
+            )
+        self.stdout.write(
+            'WSGI uses wsgiref\'s file_wrapper, which reads the file in Python; '
+            'servers whose wrapper uses os.sendfile (gunicorn) send either response zero-copy.'
+        )
+
+    def _measure(self, serve, url, source_path, runs):
+        """Return total CPU and wall seconds spent serving the file"""
+        query = urllib.parse.urlencode({'path': source_path})
+        with open(os.devnull, 'wb') as sink:
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            for _ in range(runs):
+                serve(url, query, sink.fileno())
+            return time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+    def _serve_wsgi(self, url, query, out_fd):
+        """Call the WSGI application and write the body it returns"""
+        environ = RequestFactory().get(f'{url}?{query}').environ
+        environ['wsgi.file_wrapper'] = FileWrapper
+
+        def start_response(status, headers, exc_info=None):
+            if not status.startswith('200'):
+                raise CommandError(f'{url} answered {status}')
+
+        body = self.wsgi_application(environ, start_response)
+        try:
+            for chunk in body:
+                os.write(out_fd, chunk)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def _serve_asgi(self, url, query, out_fd, extensions=None):
+        """Run one request through SendfileASGIHandler, acting as the server"""
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': url,
+            'raw_path': url.encode(),
+            'query_string': query.encode(),
+            'headers': [(b'host', b'testserver')],
+            'client': ('127.0.0.1', 0),
+            'server': ('testserver', 80),
+            'extensions': extensions or {},
+        }
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start' and message['status'] != 200:
+                raise CommandError(f'{url} answered {message["status"]}')
+            if message['type'] == 'http.response.body':
+                os.write(out_fd, message.get('body', b''))
+            elif message['type'] == ASGI_PATHSEND:
+                # What a server implementing the extension does with the path
+                with open(message['path'], 'rb') as source:
+                    offset, size = 0, os.fstat(source.fileno()).st_size
+                    while offset < size:
+                        sent = os.sendfile(out_fd, source.fileno(), offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+
+        asyncio.run(self.asgi_application(scope, receive, send))
+
+    def _serve_asgi_pathsend(self, url, query, out_fd):
+        self._serve_asgi(url, query, out_fd, extensions={ASGI_PATHSEND: {}})
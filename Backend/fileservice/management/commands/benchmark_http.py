@@ -0,0 +1,334 @@
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from fileservice.benchmark import OPERATIONS, TrafficGenerator, parse_size, parse_weights
+
+BENCHMARK_SETTINGS = 'fileshare_backend.settings_benchmark'
+
+# Longer than METRICS_FLUSH_INTERVAL in the benchmark settings
+METRICS_SETTLE_SECONDS = 1.5
+
+# Server-side counters copied into the results, from /api/metrics/
+SERVER_COUNTERS = {
+    'fileshare_upload_bytes_total': 'server_uploaded',
+    'fileshare_download_bytes_total': 'server_downloaded',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Start the app on SQLite and a scratch MEDIA_ROOT, drive a mix of concurrent upload, '
+        'file info and download traffic, and write throughput, latency and memory results as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=2,
+            help='Server processes to start (default: 2)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=8,
+            help='Concurrent client connections (default: 8)',
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=500,
+            help='Operations to send; ignored when --duration is given (default: 500)',
+        )
+        parser.add_argument(
+            '--duration',
+            type=float,
+            default=None,
+            help='Send traffic for this many seconds instead of a fixed number of operations',
+        )
+        parser.add_argument(
+            '--mix',
+            default='upload:1,info:2,download:1',
+            help='Operation weights (default: upload:1,info:2,download:1)',
+        )
+        parser.add_argument(
+            '--sizes',
+            default='4KB:50,256KB:35,4MB:15',
+            help='Upload size distribution as size:weight pairs (default: 4KB:50,256KB:35,4MB:15)',
+        )
+        parser.add_argument(
+            '--prefill',
+            type=int,
+            default=50,
+            help='Files uploaded before measuring (default: 50)',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed for the operation and size sequence (default: 0)',
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=8901,
+            help='First port to listen on; worker N uses port + N (default: 8901)',
+        )
+        parser.add_argument(
+            '--output',
+            default=None,
+            help='Path of the JSON results (default: benchmark-<timestamp>.json)',
+        )
+        parser.add_argument(
+            '--baseline',
+            default=None,
+            help='Earlier results to compare against; fails if any operation regressed',
+        )
+        parser.add_argument(
+            '--max-regression',
+            type=float,
+            default=20.0,
+            help='Allowed drop in throughput or rise in p95 latency versus the baseline, in percent (default: 20)',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Keep the scratch directory with the database, uploads and server logs',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_weights(options['mix'])
+            sizes = parse_weights(options['sizes'], parse_key=parse_size)
+        except ValueError as e:
+            raise CommandError(e)
+        unknown = {operation for operation, _ in mix} - set(OPERATIONS)
+        if unknown:
+            raise CommandError(f'Unknown operations in --mix: {", ".join(sorted(unknown))}')
+        if max(size for size, _ in sizes) > settings.FILE_UPLOAD_MAX_SIZE:
+            raise CommandError('--sizes exceeds FILE_UPLOAD_MAX_SIZE')
+
+        scratch_dir = tempfile.mkdtemp(prefix='fileshare-benchmark-')
+        env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': BENCHMARK_SETTINGS,
+            'FILESHARE_BENCHMARK_DIR': scratch_dir,
+        }
+        servers = []
+        try:
+            self._prepare_database(scratch_dir, env)
+            servers = self._start_servers(options['workers'], options['port'], scratch_dir, env)
+            addresses = [address for _, address in servers]
+
+            generator = TrafficGenerator(
+                addresses, mix, sizes, options['concurrency'], seed=options['seed']
+            )
+            self.stdout.write(f'Uploading {options["prefill"]} files before measuring...')
+            generator.prefill(options['prefill'])
+            counters_before = self._server_counters(addresses[0])
+
+            self.stdout.write('Sending traffic...')
+            elapsed = generator.run(
+                requests=None if options['duration'] else options['requests'],
+                duration=options['duration'],
+            )
+
+            workers = [
+                {'pid': process.pid, 'address': f'{host}:{port}', 'peak_rss_bytes': self._peak_rss(process.pid)}
+                for process, (host, port) in servers
+            ]
+            counters_after = self._server_counters(addresses[0])
+        finally:
+            for process, _ in servers:
+                process.terminate()
+            for process, _ in servers:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            if options['keep']:
+                self.stdout.write(f'Scratch directory kept at {scratch_dir}')
+            else:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+
+        results = self._results(options, generator, elapsed, workers, counters_before, counters_after)
+        output = options['output'] or f'benchmark-{timezone.now():%Y%m%d-%H%M%S}.json'
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        self._report(results)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {output}'))
+
+        if options['baseline']:
+            self._compare(results, options['baseline'], options['max_regression'])
+
+    def _manage(self, *args):
+        return [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), *args]
+
+    def _prepare_database(self, scratch_dir, env):
+        """Create the schema, with WAL so readers don't wait on writers"""
+        subprocess.run(self._manage('migrate', '--noinput'), env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        with sqlite3.connect(os.path.join(scratch_dir, 'db.sqlite3')) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+
+    def _start_servers(self, count, first_port, scratch_dir, env):
+        """Start one server process per worker and wait until each answers"""
+        servers = []
+        for index in range(count):
+            address = ('127.0.0.1', first_port + index)
+            log = open(os.path.join(scratch_dir, f'server-{index}.log'), 'wb')
+            process = subprocess.Popen(
+                self._manage('runserver', f'{address[0]}:{address[1]}', '--noreload'),
+                env=env, stdout=log, stderr=subprocess.STDOUT,
+            )
+            log.close()
+            servers.append((process, address))
+
+        deadline = time.monotonic() + 30
+        for process, (host, port) in servers:
+            while True:
+                if process.poll() is not None:
+                    raise CommandError(f'Server on port {port} exited; see its log with --keep')
+                try:
+                    urllib.request.urlopen(f'http://{host}:{port}/api/health/', timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() >= deadline:
+                        raise CommandError(f'Server on port {port} did not start within 30 seconds')
+                    time.sleep(0.2)
+        return servers
+
+    def _peak_rss(self, pid):
+        """Peak resident memory of a process in bytes, where /proc is available"""
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def _server_counters(self, address):
+        """Read the byte counters every worker reports through /api/metrics/"""
+        # Give every worker time to write its latest values
+        time.sleep(METRICS_SETTLE_SECONDS)
+        host, port = address
+        with urllib.request.urlopen(f'http://{host}:{port}/api/metrics/', timeout=10) as response:
+            text = response.read().decode()
+        counters = dict.fromkeys(SERVER_COUNTERS.values(), 0)
+        for line in text.splitlines():
+            name, _, value = line.partition(' ')
+            if name in SERVER_COUNTERS:
+                counters[SERVER_COUNTERS[name]] = int(float(value))
+        return counters
+
+    def _results(self, options, generator, elapsed, workers, counters_before, counters_after):
+        operations = {
+            operation: generator.stats[operation].summary(elapsed)
+            for operation in OPERATIONS
+            if operation in generator.stats
+        }
+        total = sum(op['requests'] for op in operations.values())
+        return {
+            'created_at': timezone.now().isoformat(),
+            'commit': self._git_commit(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+            },
+            'config': {
+                key: options[key]
+                for key in ('workers', 'concurrency', 'requests', 'duration', 'mix', 'sizes', 'prefill', 'seed')
+            },
+            'elapsed_seconds': round(elapsed, 3),
+            'requests': total,
+            'throughput_rps': round(total / elapsed, 2) if elapsed else None,
+            'operations': operations,
+            'bytes': {
+                'client_sent': sum(op['bytes_sent'] for op in operations.values()),
+                'client_received': sum(op['bytes_received'] for op in operations.values()),
+                **{
+                    key: counters_after[key] - counters_before[key]
+                    for key in SERVER_COUNTERS.values()
+                },
+            },
+            'workers': workers,
+        }
+
+    def _git_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def _report(self, results):
+        self.stdout.write(self.style.SUCCESS('\n--- HTTP Benchmark ---'))
+        self.stdout.write(
+            f'{results["requests"]} requests in {results["elapsed_seconds"]:.2f}s '
+            f'({results["throughput_rps"]}/s)'
+        )
+        for operation, stats in results['operations'].items():
+            latency = stats['latency_ms']
+            self.stdout.write(
+                f'{operation:>8}: {stats["requests"]} ok, {stats["errors"]} errors, '
+                f'{stats["throughput_rps"]}/s, p50 {latency["p50"]} ms, '
+                f'p95 {latency["p95"]} ms, p99 {latency["p99"]} ms'
+            )
+        copied = results['bytes']
+        self.stdout.write(
+            f'Bytes: {copied["server_uploaded"]} stored, {copied["server_downloaded"]} served'
+        )
+        for worker in results['workers']:
+            rss = worker['peak_rss_bytes']
+            self.stdout.write(
+                f'Worker {worker["pid"]}: peak RSS '
+                f'{"unknown" if rss is None else f"{rss / 1024 / 1024:.1f} MB"}'
+            )
+
+    def _compare(self, results, baseline_path, max_regression):
+        """Compare throughput and p95 latency per operation against earlier results"""
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+        self.stdout.write(self.style.SUCCESS(f'\n--- Compared to {baseline_path} ---'))
+        regressions = []
+        for operation, stats in results['operations'].items():
+            before = baseline.get('operations', {}).get(operation)
+            if not before:
+                continue
+            checks = (
+                ('throughput', before['throughput_rps'], stats['throughput_rps'], -1),
+                ('p95 latency', before['latency_ms']['p95'], stats['latency_ms']['p95'], 1),
+            )
+            for label, old, new, worse in checks:
+                if not old or new is None:
+                    continue
+                change = (new - old) / old * 100
+                line = f'{operation} {label}: {old} -> {new} ({change:+.1f}%)'
+                if change * worse > max_regression:
+                    regressions.append(line)
+                    self.stdout.write(self.style.ERROR(line))
+                else:
+                    self.stdout.write(line)
+
+        if regressions:
+            raise CommandError(f'{len(regressions)} regressions beyond {max_regression}%')
+        self.stdout.write(self.style.SUCCESS('No regressions'))
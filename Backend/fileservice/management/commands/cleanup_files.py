@@ -1,9 +1,14 @@
 import os
 import logging
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 from django.conf import settings
 from fileservice.models import FileShare
+from fileservice.chunked_uploads import cleanup_expired_sessions
+from fileservice.cleanup import FILE_BUNDLE, FILE_DELETED, FILE_MISSING, FILE_PACKED, FILE_SHARED, get_batch_size, run_cleanup
+from fileservice.cleanup_daemon import CleanupDaemon
+from fileservice.orphans import scan_orphans
+from fileservice.packs import compact_packs, packing_enabled
 
 logger = logging.getLogger(__name__)
 
@@ -22,8 +27,56 @@ class Command(BaseCommand):
             action='store_true',
             help='Force cleanup of all downloaded files regardless of expiry',
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Rows deleted per batch, and in daemon mode rows read per refresh (default: CLEANUP_BATCH_SIZE)',
+        )
+        parser.add_argument(
+            '--time-budget',
+            type=float,
+            default=None,
+            help='Stop after this many seconds and leave the rest for the next run (not with --daemon)',
+        )
+        parser.add_argument(
+            '--orphan-scan-limit',
+            type=int,
+            default=None,
+            help='Files examined by the orphan scan per run (default: ORPHAN_SCAN_MAX_FILES)',
+        )
+        parser.add_argument(
+            '--daemon',
+            action='store_true',
+            help='Stay resident and delete files within seconds of expiry',
+        )
+        parser.add_argument(
+            '--refresh-interval',
+            type=float,
+            default=2.0,
+            help='Daemon: seconds between reads of upcoming expiries (default: 2)',
+        )
+        parser.add_argument(
+            '--horizon',
+            type=int,
+            default=300,
+            help='Daemon: how many seconds ahead to track expiries (default: 300)',
+        )
+        parser.add_argument(
+            '--sweep-interval',
+            type=int,
+            default=300,
+            help='Daemon: seconds between full sweeps for orphans and stale sessions (default: 300)',
+        )
+        parser.add_argument(
+            '--stats-file',
+            help='Daemon: write lag and backlog stats as JSON to this file',
+        )
 
     def handle(self, *args, **options):
+        if options['daemon']:
+            return self._run_daemon(options)
+        
         dry_run = options['dry_run']
         force = options['force']
         
@@ -39,52 +92,57 @@ class Command(BaseCommand):
             )
             self.stdout.write(f'Found {expired_files.count()} expired files')
         
-        deleted_files_count = 0
-        deleted_records_count = 0
-        errors = []
-        
-        for file_obj in expired_files:
-            try:
-                # Delete physical file
-                file_path = os.path.join(settings.MEDIA_ROOT, file_obj.file_path)
-                
-                if os.path.exists(file_path):
-                    if not dry_run:
-                        os.remove(file_path)
-                        deleted_files_count += 1
-                    self.stdout.write(
-                        f'{"Would delete" if dry_run else "Deleted"} file: {file_obj.original_filename} ({file_obj.code})'
-                    )
-                else:
-                    self.stdout.write(
-                        self.style.WARNING(f'File not found on disk: {file_obj.original_filename} ({file_obj.code})')
-                    )
-                
-                # Delete database record
-                if not dry_run:
-                    file_obj.delete()
-                    deleted_records_count += 1
-                
-            except Exception as e:
-                error_msg = f'Error processing {file_obj.code}: {str(e)}'
-                errors.append(error_msg)
-                self.stdout.write(self.style.ERROR(error_msg))
+        def report(row, outcome, error):
+            label = f"{row['original_filename']} ({row['code']})"
+            if outcome == FILE_DELETED:
+                self.stdout.write(f'{"Would delete" if dry_run else "Deleted"} file: {label}')
+            elif outcome == FILE_SHARED:
+                self.stdout.write(f'{"Would release" if dry_run else "Released"} shared content: {label}')
+            elif outcome == FILE_BUNDLE:
+                self.stdout.write(f'{"Would delete" if dry_run else "Deleted"} bundle files: {label}')
+            elif outcome == FILE_PACKED:
+                self.stdout.write(f'{"Would release" if dry_run else "Released"} packed file: {label}')
+            elif outcome == FILE_MISSING:
+                self.stdout.write(self.style.WARNING(f'File not found on disk: {label}'))
+            else:
+                self.stdout.write(self.style.ERROR(f"Error processing {row['code']}: {error}"))
+        
+        result = run_cleanup(
+            queryset=expired_files,
+            dry_run=dry_run,
+            batch_size=options['batch_size'],
+            time_budget=options['time_budget'],
+            on_file=report,
+        )
         
         # Clean up orphaned files
         self.stdout.write('\nCleaning up orphaned files...')
-        orphaned_count = self._cleanup_orphaned_files(dry_run)
+        orphaned_count = self._cleanup_orphaned_files(dry_run, options['orphan_scan_limit'])
+        
+        # Clean up abandoned chunked uploads
+        self.stdout.write('\nCleaning up expired upload sessions...')
+        session_count = cleanup_expired_sessions(dry_run)
+        
+        # Reclaim space in pack segments
+        compaction = None
+        if packing_enabled():
+            self.stdout.write('\nCompacting pack segments...')
+            compaction = compact_packs(dry_run)
         
         # Summary
         self.stdout.write(self.style.SUCCESS('\n--- Cleanup Summary ---'))
-        if dry_run:
-            self.stdout.write(f'Would delete {expired_files.count()} database records')
-            self.stdout.write(f'Would delete {deleted_files_count} files from disk')
-        else:
-            self.stdout.write(f'Deleted {deleted_records_count} database records')
-            self.stdout.write(f'Deleted {deleted_files_count} files from disk')
+        verb = 'Would delete' if dry_run else 'Deleted'
+        self.stdout.write(f'{verb} {result.records_deleted} database records')
+        self.stdout.write(f'{verb} {result.files_deleted} files from disk')
+        if result.budget_exhausted:
+            self.stdout.write(self.style.WARNING('Time budget reached; remaining files will be cleaned up on the next run'))
         
         self.stdout.write(f'Found and {"would clean" if dry_run else "cleaned"} {orphaned_count} orphaned files')
+        self.stdout.write(f'{"Would remove" if dry_run else "Removed"} {session_count} expired upload sessions')
+        if compaction is not None:
+            self.stdout.write(str(compaction))
         
+        errors = result.errors + (compaction.errors if compaction is not None else [])
         if errors:
             self.stdout.write(self.style.ERROR(f'\nErrors encountered: {len(errors)}'))
             for error in errors:
@@ -92,38 +150,50 @@ class Command(BaseCommand):
         
         self.stdout.write(self.style.SUCCESS('Cleanup completed!'))
 
-    def _cleanup_orphaned_files(self, dry_run=False):
+    def _run_daemon(self, options):
+        """Run the resident cleanup loop until SIGTERM or SIGINT"""
+        if options['dry_run'] or options['force'] or options['time_budget'] is not None:
+            raise CommandError('--daemon cannot be combined with --dry-run, --force or --time-budget')
+        
+        def sweep():
+            self._cleanup_orphaned_files()
+            cleanup_expired_sessions()
+            if packing_enabled():
+                compact_packs()
+        
+        daemon = CleanupDaemon(
+            refresh_interval=options['refresh_interval'],
+            horizon=options['horizon'],
+            batch_size=options['batch_size'] or get_batch_size(),
+            sweep_interval=options['sweep_interval'],
+            sweep=sweep,
+            stats_file=options['stats_file'],
+            stdout=self.stdout if options['verbosity'] >= 1 else None,
+        )
+        daemon.install_signal_handlers()
+        
+        self.stdout.write(self.style.SUCCESS('Cleanup daemon started'))
+        daemon.run()
+        
+        stats = daemon.stats
+        self.stdout.write(self.style.SUCCESS(
+            f'Cleanup daemon stopped: deleted {stats["records_deleted"]} records and '
+            f'{stats["files_deleted"]} files, max lag {stats["max_lag_seconds"]}s'
+        ))
+
+    def _cleanup_orphaned_files(self, dry_run=False, max_files=None):
         """Clean up files that exist on disk but not in database"""
         if not os.path.exists(settings.MEDIA_ROOT):
             self.stdout.write(self.style.WARNING('Media directory does not exist'))
             return 0
         
-        # Get all file paths from database
-        db_files = set(FileShare.objects.values_list('file_path', flat=True))
-        
-        # Get all files from uploads directory
-        uploads_dir = os.path.join(settings.MEDIA_ROOT, 'uploads')
-        if not os.path.exists(uploads_dir):
-            return 0
+        def report(path, error):
+            if error:
+                self.stdout.write(self.style.ERROR(f'Error deleting orphaned file {path}: {error}'))
+            else:
+                self.stdout.write(f'{"Would delete" if dry_run else "Deleted"} orphaned file: {path}')
         
-        orphaned_count = 0
-        
-        for root, dirs, files in os.walk(uploads_dir):
-            for file in files:
-                full_path = os.path.join(root, file)
-                relative_path = os.path.relpath(full_path, settings.MEDIA_ROOT)
-                
-                if relative_path not in db_files:
-                    orphaned_count += 1
-                    if not dry_run:
-                        try:
-                            os.remove(full_path)
-                            self.stdout.write(f'Deleted orphaned file: {relative_path}')
-                        except OSError as e:
-                            self.stdout.write(
-                                self.style.ERROR(f'Error deleting orphaned file {relative_path}: {e}')
-                            )
-                    else:
-                        self.stdout.write(f'Would delete orphaned file: {relative_path}')
-        
-        return orphaned_count
\ No newline at end of file
+        result = scan_orphans(max_files=max_files, dry_run=dry_run, on_orphan=report)
+        if not result.pass_completed:
+            self.stdout.write(f'Scanned {result.scanned} files; the next run resumes from there')
+        return result.orphaned
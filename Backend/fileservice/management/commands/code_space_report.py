@@ -0,0 +1,26 @@
+from django.db.models import Max
+from django.core.management.base import BaseCommand
+from fileservice.codes import COLLISIONS_COUNTER, collision_report
+from fileservice.counters import get_counter
+from fileservice.models import FileShare
+
+
+class Command(BaseCommand):
+    help = 'Report how full the share code space is and how often code allocation collides'
+
+    def handle(self, *args, **options):
+        # Ids are never reused, so the highest one counts every row ever inserted
+        report = collision_report(
+            live_codes=FileShare.objects.count(),
+            codes_allocated=FileShare.objects.aggregate(Max('id'))['id__max'] or 0,
+            collisions=get_counter(COLLISIONS_COUNTER),
+        )
+
+        self.stdout.write(self.style.SUCCESS('--- Share Code Allocation ---'))
+        self.stdout.write(f'Code space: {report["code_space"]:,} codes')
+        self.stdout.write(f'Live codes: {report["live_codes"]:,} ({report["expected_collision_rate"]:.3e} of the space)')
+        self.stdout.write(f'Codes allocated: {report["codes_allocated"]:,}')
+        self.stdout.write(f'Collisions: {report["collisions"]:,}')
+        self.stdout.write(f'Observed collision rate: {report["observed_collision_rate"]:.3e} per insert')
+        self.stdout.write(f'Expected collision rate: {report["expected_collision_rate"]:.3e} per insert')
+        self.stdout.write(f'Chance an insert exhausts its retries: {report["retry_exhaustion_probability"]:.3e}')
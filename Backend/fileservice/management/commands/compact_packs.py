@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from fileservice.packs import compact_packs
+
+
+class Command(BaseCommand):
+    help = 'Seal idle pack segments, rewrite sparse ones and delete the ones no file uses'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show what would be reclaimed without changing anything',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        self.stdout.write(self.style.SUCCESS('Starting pack compaction...'))
+        result = compact_packs(dry_run=dry_run)
+
+        self.stdout.write(self.style.SUCCESS('\n--- Compaction Summary ---'))
+        self.stdout.write(f'{"Would seal" if dry_run else "Sealed"} {result.sealed} idle segments')
+        self.stdout.write(f'{"Would rewrite" if dry_run else "Rewrote"} {result.rewritten} sparse segments'
+                          f' ({result.entries_moved} files moved)')
+        self.stdout.write(f'{"Would delete" if dry_run else "Deleted"} {result.segments_deleted} empty segments'
+                          f' ({result.bytes_reclaimed} bytes)')
+        self.stdout.write(f'{"Would delete" if dry_run else "Deleted"} {result.stray_files_deleted} stray segment files')
+        if result.errors:
+            self.stdout.write(self.style.ERROR(f'Errors encountered: {len(result.errors)}'))
+            for error in result.errors:
+                self.stdout.write(self.style.ERROR(f'  - {error}'))
+        self.stdout.write(self.style.SUCCESS('Compaction completed!'))
@@ -0,0 +1,70 @@
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django.db import connections
+from fileservice.db.pool import pool_stats
+
+
+class Command(BaseCommand):
+    help = 'Simulate request traffic against the database and report connection pool statistics'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=16,
+            help='Concurrent simulated workers (default: 16)',
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=100,
+            help='Requests per worker; each one runs a query and closes its connection (default: 100)',
+        )
+        parser.add_argument(
+            '--database',
+            default='default',
+            help='Database alias to use (default: default)',
+        )
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        errors = []
+
+        def worker():
+            connection = connections[alias]
+            try:
+                for _ in range(options['requests']):
+                    with connection.cursor() as cursor:
+                        cursor.execute('SELECT 1')
+                    # What Django does at the end of every request
+                    connection.close_if_unusable_or_obsolete()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        total = options['threads'] * options['requests']
+        self.stdout.write(self.style.SUCCESS('--- Database Connection Report ---'))
+        self.stdout.write(f'Backend: {connections[alias].settings_dict["ENGINE"]}')
+        self.stdout.write(f'Requests: {total} in {elapsed:.2f}s ({total / elapsed:.0f}/s)')
+
+        stats = pool_stats().get(alias)
+        if stats is None:
+            self.stdout.write(self.style.WARNING('Connection pooling is disabled for this database'))
+        else:
+            for name, value in stats.items():
+                self.stdout.write(f'{name}: {value}')
+
+        if errors:
+            self.stdout.write(self.style.ERROR(f'Errors encountered: {len(errors)}'))
+            for error in errors[:10]:
+                self.stdout.write(self.style.ERROR(f'  - {error}'))
@@ -0,0 +1,133 @@
+import os
+import posixpath
+import time
+from django.core.management.base import BaseCommand
+from fileservice.models import BundleFile, FileShare, StoredBlob
+from fileservice.storage import media_path, upload_path_for
+
+
+class Command(BaseCommand):
+    help = 'Move stored uploads into the configured sharded directory layout while the service keeps running'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rows examined per batch (default: 500)',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help='Seconds to sleep between batches to limit I/O pressure',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Stop after moving this many files',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show what would be moved without moving anything',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        batch_size = options['batch_size']
+        limit = options['limit']
+
+        self.stdout.write(self.style.SUCCESS('Starting upload layout migration...'))
+
+        moved = 0
+        missing = 0
+        errors = []
+
+        # Bundles have no file of their own; their entries are moved instead
+        querysets = [
+            FileShare.objects.filter(pack_segment__isnull=True, is_bundle=False),
+            BundleFile.objects.all(),
+        ]
+        for queryset in querysets:
+            last_id = 0
+            while limit is None or moved < limit:
+                rows = list(
+                    queryset
+                    .filter(id__gt=last_id)
+                    .order_by('id')
+                    .values_list('id', 'file_path')[:batch_size]
+                )
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                for file_id, file_path in rows:
+                    if limit is not None and moved >= limit:
+                        break
+                    target_path = upload_path_for(posixpath.basename(file_path))
+                    if target_path == file_path:
+                        continue
+
+                    source = media_path(file_path)
+                    if not os.path.exists(source):
+                        if os.path.exists(media_path(target_path)):
+                            # Moved by an earlier, interrupted run; only the row is left
+                            if dry_run or self._repoint(file_path, target_path):
+                                moved += 1
+                        else:
+                            missing += 1
+                        continue
+
+                    if dry_run:
+                        self.stdout.write(f'Would move {file_path} -> {target_path}')
+                        moved += 1
+                        continue
+
+                    try:
+                        self._move(file_path, target_path)
+                        moved += 1
+                    except OSError as e:
+                        errors.append(f'Error moving {file_path}: {e}')
+                        self.stdout.write(self.style.ERROR(errors[-1]))
+
+                if options['pause']:
+                    time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS('\n--- Migration Summary ---'))
+        self.stdout.write(f'{"Would move" if dry_run else "Moved"} {moved} files')
+        if missing:
+            self.stdout.write(self.style.WARNING(f'{missing} files were not found on disk'))
+        if errors:
+            self.stdout.write(self.style.ERROR(f'Errors encountered: {len(errors)}'))
+        self.stdout.write(self.style.SUCCESS('Migration completed!'))
+
+    def _move(self, file_path, target_path):
+        """
+        Rename the file into its shard, then point the row at it. Between
+        the two steps readers find the file through storage.resolve_path.
+        """
+        target = media_path(target_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(media_path(file_path), target)
+
+        updated = self._repoint(file_path, target_path)
+        if not updated:
+            # The row was cleaned up meanwhile; don't leave its file behind
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+
+    def _repoint(self, file_path, target_path):
+        """
+        Point every row at the file's new location. Deduplicated content
+        is shared by several rows, bundle entries and its blob, which all
+        move together.
+        Returns the number of rows updated.
+        """
+        updated = FileShare.objects.filter(file_path=file_path).update(file_path=target_path)
+        updated += BundleFile.objects.filter(file_path=file_path).update(file_path=target_path)
+        updated += StoredBlob.objects.filter(file_path=file_path).update(file_path=target_path)
+        return updated
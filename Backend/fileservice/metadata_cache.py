@@ -0,0 +1,86 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from .models import BundleFile, FileShare
+
+
+# Columns served from the cache; enough to answer get_file_info
+METADATA_FIELDS = (
+    'id',
+    'code',
+    'original_filename',
+    'file_size',
+    'content_type',
+    'created_at',
+    'is_downloaded',
+    'expires_at',
+    'is_bundle',
+)
+
+
+def _bundle_listing(bundle_id):
+    """Names and sizes of a bundle's files, cached with the bundle"""
+    return [
+        {'name': name, 'size': size}
+        for name, size in BundleFile.objects.filter(bundle_id=bundle_id).order_by('position')
+        .values_list('name', 'file_size')
+    ]
+
+
+def get_cache():
+    """Cache holding FileShare metadata, shared by all workers when Redis is configured"""
+    return caches[getattr(settings, 'FILE_METADATA_CACHE', 'default')]
+
+
+def get_timeout():
+    """Seconds a cached entry may be served"""
+    return getattr(settings, 'FILE_METADATA_CACHE_TIMEOUT', 30)
+
+
+def cache_key(code):
+    return f"fileshare:meta:{code}"
+
+
+def get_file_metadata(code):
+    """
+    Metadata of the share with the given code as a dict, or None if
+    there is no such share. Reads the database only on a cache miss.
+    """
+    cache = get_cache()
+    key = cache_key(code)
+    metadata = cache.get(key)
+    if metadata is None:
+        metadata = FileShare.objects.filter(code=code).values(*METADATA_FIELDS).first()
+        if metadata is not None:
+            if metadata['is_bundle']:
+                metadata['files'] = _bundle_listing(metadata['id'])
+            cache.set(key, metadata, get_timeout())
+    return metadata
+
+
+async def aget_file_metadata(code):
+    """Async version of get_file_metadata"""
+    cache = get_cache()
+    key = cache_key(code)
+    metadata = await cache.aget(key)
+    if metadata is None:
+        metadata = await FileShare.objects.filter(code=code).values(*METADATA_FIELDS).afirst()
+        if metadata is not None:
+            if metadata['is_bundle']:
+                metadata['files'] = await sync_to_async(_bundle_listing)(metadata['id'])
+            await cache.aset(key, metadata, get_timeout())
+    return metadata
+
+
+def is_available(metadata):
+    """Same check as FileShare.is_available, on cached metadata"""
+    if metadata['is_downloaded']:
+        return False
+    return metadata['expires_at'] is None or timezone.now() <= metadata['expires_at']
+
+
+def invalidate(*codes):
+    """Drop cached metadata after the rows changed or were deleted"""
+    if codes:
+        get_cache().delete_many([cache_key(code) for code in codes])
@@ -0,0 +1,390 @@
+"""
+Low-overhead metrics in the Prometheus text format.
+
+Recording a sample only updates a dict in memory. When METRICS_DIR is
+set, a background thread writes each process's values to its own file
+in that directory, and a scrape sums the files of every worker, Celery
+process and cleanup daemon sharing it. Without METRICS_DIR each process
+only reports its own values.
+"""
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+from . import admission
+
+# Values recorded by this process, keyed by sample ('name{labels}')
+_values = defaultdict(float)
+_lock = threading.Lock()
+_dirty = False
+_flusher = None
+
+# name -> (type, help), in registration order
+_families = {}
+
+# Scrape-time gauges: name -> callable returning {labels tuple: value}
+_collectors = {}
+
+# Buckets for request latencies, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Buckets for file sizes, in bytes (1 KB to 1 GB)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+# Buckets for cleanup run durations, in seconds
+CLEANUP_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300)
+
+
+def get_metrics_dir():
+    """Directory shared by all processes for aggregation, or None"""
+    return getattr(settings, 'METRICS_DIR', None) or None
+
+
+def get_flush_interval():
+    """Seconds between writes of this process's values to METRICS_DIR"""
+    return getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _sample(name, labels):
+    return name + _format_labels(sorted(labels.items()))
+
+
+def _add(samples):
+    """Add (sample, amount) pairs to this process's values"""
+    global _dirty
+    with _lock:
+        for sample, amount in samples:
+            _values[sample] += amount
+        _dirty = True
+    if _flusher is None and get_metrics_dir():
+        _start_flusher()
+
+
+class Counter:
+    """A monotonically increasing count"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        _families[name] = ('counter', help_text)
+
+    def inc(self, amount=1, **labels):
+        _add([(_sample(self.name, labels), amount)])
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, with their sum and count"""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.buckets = tuple(sorted(buckets))
+        _families[name] = ('histogram', help_text)
+
+    def observe(self, value, **labels):
+        # Every bucket gets a sample, even when zero, so the series are complete
+        samples = [
+            (_sample(f'{self.name}_bucket', {**labels, 'le': _format_bound(bound)}), int(value <= bound))
+            for bound in self.buckets
+        ]
+        samples.append((_sample(f'{self.name}_bucket', {**labels, 'le': '+Inf'}), 1))
+        samples.append((_sample(f'{self.name}_sum', labels), value))
+        samples.append((_sample(f'{self.name}_count', labels), 1))
+        _add(samples)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+def _format_bound(bound):
+    return repr(float(bound)) if isinstance(bound, float) else str(bound)
+
+
+def gauge(name, help_text):
+    """
+    Register a gauge computed at scrape time. The decorated function
+    returns a number, or a dict mapping label tuples to numbers.
+    """
+    def register(collect):
+        _families[name] = ('gauge', help_text)
+        _collectors[name] = collect
+        return collect
+    return register
+
+
+# File service metrics
+REQUEST_DURATION = Histogram(
+    'fileshare_request_duration_seconds',
+    'Time until the response starts, by endpoint',
+    LATENCY_BUCKETS,
+)
+REQUESTS = Counter('fileshare_requests_total', 'Requests by endpoint and status code')
+UPLOAD_BYTES = Counter('fileshare_upload_bytes_total', 'Bytes of files stored')
+DOWNLOAD_BYTES = Counter('fileshare_download_bytes_total', 'Bytes of files sent, including offloaded ones')
+FILE_SIZE = Histogram('fileshare_file_size_bytes', 'Size of uploaded files', SIZE_BUCKETS)
+CLEANUP_DURATION = Histogram('fileshare_cleanup_duration_seconds', 'Duration of cleanup runs', CLEANUP_BUCKETS)
+CLEANUP_RECORDS = Counter('fileshare_cleanup_records_deleted_total', 'FileShare rows removed by cleanup')
+CLEANUP_FILES = Counter('fileshare_cleanup_files_deleted_total', 'Files removed from disk by cleanup')
+ORPHANS_FOUND = Counter('fileshare_orphans_found_total', 'Files found on disk without a database row')
+ORPHANS_DELETED = Counter('fileshare_orphans_deleted_total', 'Orphaned files removed')
+ADMISSION_REJECTED = Counter('fileshare_admission_rejected_total', 'Transfers turned away over capacity, by kind and limit scope')
+
+
+def record_upload(size):
+    """Count a stored upload"""
+    UPLOAD_BYTES.inc(size)
+    FILE_SIZE.observe(size)
+
+
+_disk_usage = {'at': None, 'bytes': 0, 'files': 0}
+
+
+def _media_usage():
+    """
+    Bytes and files stored, summed from the database instead of walking
+    MEDIA_ROOT, at most every METRICS_DISK_USAGE_TTL seconds
+    """
+    ttl = getattr(settings, 'METRICS_DISK_USAGE_TTL', 60)
+    now = time.monotonic()
+    if _disk_usage['at'] is None or now - _disk_usage['at'] >= ttl:
+        from django.db.models import Count, Sum
+        from django.db.models.functions import Coalesce
+        from .models import BundleFile, FileShare, PackSegment, StoredBlob
+
+        # Every stored file is a blob, a pack segment, or the file of a
+        # share or bundle entry that is neither deduplicated nor packed
+        usages = (
+            FileShare.objects.filter(blob__isnull=True, pack_segment__isnull=True, is_bundle=False)
+            .aggregate(bytes=Sum(Coalesce('stored_size', 'file_size')), files=Count('id')),
+            BundleFile.objects.filter(blob__isnull=True).aggregate(bytes=Sum('stored_size'), files=Count('id')),
+            StoredBlob.objects.aggregate(bytes=Sum('size'), files=Count('id')),
+            PackSegment.objects.aggregate(bytes=Sum('size'), files=Count('id')),
+        )
+        _disk_usage.update(
+            at=now,
+            bytes=sum(usage['bytes'] or 0 for usage in usages),
+            files=sum(usage['files'] for usage in usages),
+        )
+    return _disk_usage
+
+
+@gauge('fileshare_media_bytes', 'Bytes of stored files, from the database')
+def _media_bytes():
+    return _media_usage()['bytes']
+
+
+@gauge('fileshare_media_files', 'Stored files, from the database')
+def _media_files():
+    return _media_usage()['files']
+
+
+@gauge('fileshare_in_flight_requests', 'Transfers admitted and not finished, on the node when ADMISSION_NODE_DIR is set')
+def _in_flight_requests():
+    if not admission.is_enabled():
+        return None
+    return {(('kind', kind),): values[0] for kind, values in admission.in_flight().items()}
+
+
+@gauge('fileshare_in_flight_bytes', 'Declared bytes of uploads admitted and not finished')
+def _in_flight_bytes():
+    if not admission.is_enabled():
+        return None
+    return admission.in_flight()[admission.UPLOAD][1]
+
+
+@gauge('fileshare_filesystem_free_bytes', 'Free space on the filesystem holding MEDIA_ROOT')
+def _filesystem_free():
+    try:
+        return shutil.disk_usage(settings.MEDIA_ROOT).free
+    except OSError:
+        return None
+
+
+def _process_file(metrics_dir):
+    return os.path.join(metrics_dir, f'metrics-{os.getpid()}.json')
+
+
+def flush():
+    """Write this process's values to METRICS_DIR"""
+    global _dirty
+    metrics_dir = get_metrics_dir()
+    if not metrics_dir:
+        return
+    with _lock:
+        snapshot = dict(_values)
+        _dirty = False
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = _process_file(metrics_dir)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def _run_flusher():
+    while True:
+        time.sleep(get_flush_interval())
+        if _dirty:
+            try:
+                flush()
+            except OSError:
+                pass
+
+
+def _start_flusher():
+    global _flusher
+    with _lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=_run_flusher, name='metrics-flusher', daemon=True)
+    _flusher.start()
+
+
+def _reset_after_fork():
+    """A forked child starts from zero; the parent's values are in the parent's file"""
+    global _lock, _dirty, _flusher
+    _lock = threading.Lock()
+    _values.clear()
+    _dirty = False
+    _flusher = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def collect():
+    """Current values of every recorded sample, summed across processes"""
+    metrics_dir = get_metrics_dir()
+    if not metrics_dir:
+        with _lock:
+            return dict(_values)
+
+    flush()
+    _archive_dead(metrics_dir)
+    totals = defaultdict(float)
+    for entry in os.scandir(metrics_dir):
+        if not (entry.name.startswith('metrics-') and entry.name.endswith('.json')):
+            continue
+        samples = _read_samples(entry.path)
+        for sample, value in samples.items():
+            totals[sample] += value
+    return totals
+
+
+def _read_samples(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _archive_dead(metrics_dir):
+    """
+    Fold the files of processes that have exited into metrics-archive.json
+    and remove them, so totals stay monotonic without the directory
+    growing with every worker ever started
+    """
+    dead = []
+    for entry in os.scandir(metrics_dir):
+        pid = entry.name[len('metrics-'):].split('.', 1)[0]
+        if not (entry.name.startswith('metrics-') and pid.isdigit()):
+            continue
+        if int(pid) != os.getpid() and not _pid_alive(int(pid)):
+            dead.append(entry.path)
+    if not dead:
+        return
+
+    with open(os.path.join(metrics_dir, 'archive.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(metrics_dir, 'metrics-archive.json')
+        archive = defaultdict(float, _read_samples(archive_path))
+        dead = [path for path in dead if os.path.exists(path)]  # Another scrape may have got there first
+        for path in dead:
+            if path.endswith('.json'):
+                for sample, value in _read_samples(path).items():
+                    archive[sample] += value
+        tmp_path = f'{archive_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(archive, f)
+        os.replace(tmp_path, archive_path)
+        for path in dead:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _family_of(sample):
+    name = sample.split('{', 1)[0]
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in _families:
+            return name[:-len(suffix)]
+    return name
+
+
+def _sort_key(item):
+    """Order samples by series, with histogram buckets in ascending order"""
+    sample = item[0]
+    head, _, le = sample.partition('le="')
+    if not le:
+        return sample, 0.0
+    bound, _, rest = le.partition('"')
+    return head + rest, float(bound)
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    by_family = defaultdict(list)
+    for sample, value in collect().items():
+        by_family[_family_of(sample)].append((sample, value))
+
+    for name, collect_gauge in _collectors.items():
+        value = collect_gauge()
+        if value is None:
+            continue
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, gauge_value in value.items():
+            by_family[name].append((name + _format_labels(labels), gauge_value))
+
+    lines = []
+    for name, (metric_type, help_text) in _families.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for sample, value in sorted(by_family.get(name, ()), key=_sort_key):
+            lines.append(f'{sample} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
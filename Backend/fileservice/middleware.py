@@ -1,116 +1,315 @@
-import os
 import time
 import threading
-from django.utils import timezone
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.conf import settings
-from django.core.cache import cache
-from fileservice.models import FileShare
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from fileservice import admission, metrics, profiling
+from fileservice.cleanup import run_cleanup
+from fileservice.lease import acquire_lease
+from fileservice.orphans import scan_orphans
+from fileservice.packs import compact_packs, packing_enabled
 
 
 class FileCleanupMiddleware:
     """
-    Middleware that performs automatic cleanup of expired files.
-    Uses caching to prevent excessive cleanup operations.
+    Middleware that triggers automatic cleanup of expired files.
+    Requests only compare a timestamp; the cleanup itself runs in a
+    background thread, and a lease shared through the database makes
+    sure only one worker in the whole cluster runs it per interval.
+    Works natively in both sync and async stacks, so async views are
+    not pushed onto a thread.
     """
     
+    sync_capable = True
+    async_capable = True
+    
+    lease_name = 'file-cleanup'
+    
     def __init__(self, get_response):
         self.get_response = get_response
         self.cleanup_lock = threading.Lock()
+        self.next_check = 0
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
         
     def __call__(self, request):
-        # Perform cleanup check (with rate limiting)
-        self._maybe_cleanup()
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        
+        # Cheap check; at most one background job per interval per process
+        if time.time() >= self.next_check:
+            with profiling.phase('cleanup'):
+                self._maybe_cleanup()
         
         response = self.get_response(request)
         return response
     
+    async def __acall__(self, request):
+        # Only starts a thread, so it is safe to call on the event loop
+        if time.time() >= self.next_check:
+            with profiling.phase('cleanup'):
+                self._maybe_cleanup()
+        
+        return await self.get_response(request)
+    
+    def _get_interval(self):
+        return getattr(settings, 'FILE_CLEANUP_INTERVAL', 300)
+    
     def _maybe_cleanup(self):
         """
-        Check if cleanup should be performed.
-        Only runs cleanup every 5 minutes to avoid performance issues.
+        Start a background cleanup job if none is running in this process.
         """
-        cache_key = 'file_cleanup_last_run'
-        last_cleanup = cache.get(cache_key, 0)
-        current_time = time.time()
-        
-        # Run cleanup every 5 minutes (300 seconds)
-        if current_time - last_cleanup > 300:
-            # Use lock to prevent multiple simultaneous cleanups
-            if self.cleanup_lock.acquire(blocking=False):
-                try:
-                    self._perform_cleanup()
-                    cache.set(cache_key, current_time, timeout=600)  # Cache for 10 minutes
-                finally:
-                    self.cleanup_lock.release()
+        # Use lock to prevent multiple simultaneous cleanups
+        if not self.cleanup_lock.acquire(blocking=False):
+            return
+        self.next_check = time.time() + self._get_interval()
+        try:
+            threading.Thread(
+                target=self._run_background_cleanup, name='file-cleanup', daemon=True
+            ).start()
+        except RuntimeError:
+            self.cleanup_lock.release()
+    
+    def _run_background_cleanup(self):
+        """
+        Run cleanup if this worker wins the cluster-wide lease.
+        """
+        try:
+            if acquire_lease(self.lease_name, self._get_interval()):
+                self._perform_cleanup()
+        except Exception:
+            # Silently handle any errors to avoid breaking the application
+            pass
+        finally:
+            # This thread has its own database connection
+            connections.close_all()
+            self.cleanup_lock.release()
     
     def _perform_cleanup(self):
         """
         Perform the actual cleanup of expired files.
-        This runs in the background to avoid blocking requests.
         """
         try:
-            # Find expired files
-            expired_files = FileShare.objects.filter(
-                expires_at__lt=timezone.now()
-            )
-            
-            deleted_count = 0
-            for file_obj in expired_files:
-                try:
-                    # Delete physical file
-                    file_path = os.path.join(settings.MEDIA_ROOT, file_obj.file_path)
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                    
-                    # Delete database record
-                    file_obj.delete()
-                    deleted_count += 1
-                    
-                except Exception:
-                    # Silently handle errors to avoid breaking the application
-                    continue
+            # Delete expired files, bounded so one run cannot hog the worker
+            run_cleanup(time_budget=getattr(settings, 'CLEANUP_MIDDLEWARE_TIME_BUDGET', 2))
             
             # Optional: Clean up a few orphaned files (limit to prevent performance issues)
             self._cleanup_orphaned_files_limited()
             
+            if packing_enabled():
+                compact_packs()
+            
         except Exception:
             # Silently handle any errors to avoid breaking the application
             pass
     
     def _cleanup_orphaned_files_limited(self):
         """
-        Clean up a limited number of orphaned files to prevent performance issues.
+        Clean up orphaned files from a small slice of the uploads tree,
+        resuming where the previous scan stopped.
         """
         try:
-            uploads_dir = os.path.join(settings.MEDIA_ROOT, 'uploads')
-            if not os.path.exists(uploads_dir):
-                return
-            
-            # Get all file paths from database
-            db_files = set(FileShare.objects.values_list('file_path', flat=True))
-            
-            # Clean up max 10 orphaned files per cleanup cycle
-            cleaned_count = 0
-            max_cleanup = 10
-            
-            for root, dirs, files in os.walk(uploads_dir):
-                if cleaned_count >= max_cleanup:
-                    break
-                    
-                for file in files:
-                    if cleaned_count >= max_cleanup:
-                        break
-                        
-                    full_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(full_path, settings.MEDIA_ROOT)
-                    
-                    if relative_path not in db_files:
-                        try:
-                            os.remove(full_path)
-                            cleaned_count += 1
-                        except OSError:
-                            continue
-                            
+            scan_orphans(max_files=getattr(settings, 'CLEANUP_MIDDLEWARE_ORPHAN_SCAN', 500))
         except Exception:
             # Silently handle errors
-            pass
\ No newline at end of file
+            pass
+
+
+class MetricsMiddleware:
+    """
+    Middleware that records latency and status codes of the file
+    endpoints. Latency runs until the view returns, so streamed
+    download bodies are not included.
+    """
+    
+    sync_capable = True
+    async_capable = True
+    
+    # URL names of the instrumented views and their endpoint label
+    endpoints = {
+        'upload_file': 'upload',
+        'upload_bundle': 'upload_bundle',
+        'complete_upload_session': 'upload_complete',
+        'get_file_info': 'file_info',
+        'download_file': 'download',
+    }
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+    
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self._record(request, response, started)
+        return response
+    
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, started)
+        return response
+    
+    def _record(self, request, response, started):
+        match = getattr(request, 'resolver_match', None)
+        endpoint = self.endpoints.get(match.url_name) if match else None
+        if endpoint is None:
+            return
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - started, endpoint=endpoint)
+        metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+
+
+class RequestProfilingMiddleware:
+    """
+    Middleware that splits each request's time into phases (database,
+    upload receive, storage, cleanup and the rest), counts its queries
+    and the bytes its thread read and wrote, and adds a Server-Timing
+    header. Sampled requests, or requests carrying the X-Profile token,
+    are also run under a profiler. Slow, over-budget and profiled
+    requests are written to a rotating JSON lines file.
+    Not loaded at all unless REQUEST_PROFILING is on.
+    """
+    
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response):
+        if not profiling.is_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        profiling.install_query_wrapper()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+    
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        
+        profile, token = profiling.start_request(request)
+        response = self.get_response(request)
+        return profiling.finish_request(profile, token, response)
+    
+    async def __acall__(self, request):
+        # Requests share the event loop thread, so its I/O counters say nothing per request
+        profile, token = profiling.start_request(request, track_io=False)
+        response = await self.get_response(request)
+        return profiling.finish_request(profile, token, response)
+
+
+class AdmissionControlMiddleware:
+    """
+    Middleware that limits the uploads and downloads in flight per
+    process and per node (see fileservice.admission). A request over
+    capacity gets a 503, or ADMISSION_REJECT_STATUS, with Retry-After
+    before its view runs, so under WSGI its body is never read; Django's
+    ASGI handler has always received the body by then. An admitted
+    request holds its slot until the response is closed, which for
+    downloads is after the last byte was sent.
+    Not loaded at all unless an admission limit is configured.
+    """
+    
+    sync_capable = True
+    async_capable = True
+    
+    # URL names of the limited views and the kind of transfer they are
+    endpoints = {
+        'upload_file': admission.UPLOAD,
+        'upload_bundle': admission.UPLOAD,
+        'upload_chunk': admission.UPLOAD,
+        'complete_upload_session': admission.UPLOAD,
+        'download_file': admission.DOWNLOAD,
+    }
+    
+    def __init__(self, get_response):
+        if not admission.is_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+    
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        
+        ticket, rejection = self._admit(request)
+        if rejection is not None:
+            return rejection
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            if ticket is not None:
+                ticket.release()
+            raise
+        return self._hold(ticket, response)
+    
+    async def __acall__(self, request):
+        # Only touches the ledger file, a few microseconds under its lock
+        ticket, rejection = self._admit(request)
+        if rejection is not None:
+            return rejection
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            if ticket is not None:
+                ticket.release()
+            raise
+        return self._hold(ticket, response)
+    
+    def _kind(self, request):
+        try:
+            match = resolve(request.path_info, getattr(request, 'urlconf', None))
+        except Resolver404:
+            return None
+        return self.endpoints.get(match.url_name)
+    
+    def _admit(self, request):
+        """
+        Returns (ticket, rejection): the slot of an admitted request,
+        which is None for requests that are not limited, or the response
+        that turns the request away
+        """
+        kind = self._kind(request)
+        if kind is None:
+            return None, None
+        
+        size = 0
+        if kind == admission.UPLOAD:
+            try:
+                size = max(int(request.META.get('CONTENT_LENGTH') or 0), 0)
+            except ValueError:
+                size = 0
+        
+        ticket = admission.admit(kind, size)
+        if isinstance(ticket, admission.Ticket):
+            return ticket, None
+        
+        metrics.ADMISSION_REJECTED.inc(kind=kind, scope=ticket)
+        response = JsonResponse(
+            {'error': 'Server is busy, please retry later'},
+            status=admission.get_reject_status(),
+        )
+        response['Retry-After'] = str(admission.get_retry_after())
+        return None, response
+    
+    def _hold(self, ticket, response):
+        if ticket is None:
+            return response
+        close = response.close
+        
+        def close_and_release():
+            try:
+                close()
+            finally:
+                ticket.release()
+        
+        # The server, through Django's handler, closes the response once
+        # its body has been sent
+        response.close = close_and_release
+        return response
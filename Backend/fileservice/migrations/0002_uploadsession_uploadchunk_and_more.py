@@ -0,0 +1,49 @@
+# Generated by Django 4.2.23 on 2026-10-17 01:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileservice', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('original_filename', models.CharField(max_length=255)),
+                ('file_size', models.BigIntegerField()),
+                ('content_type', models.CharField(max_length=100)),
+                ('chunk_size', models.IntegerField()),
+                ('partial_path', models.CharField(max_length=500)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'upload_sessions',
+                'indexes': [models.Index(fields=['expires_at'], name='upload_sess_expires_aebd1e_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='UploadChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('size', models.IntegerField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='fileservice.uploadsession')),
+            ],
+            options={
+                'db_table': 'upload_chunks',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='uploadchunk',
+            constraint=models.UniqueConstraint(fields=('session', 'index'), name='unique_upload_chunk'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-17 01:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileservice', '0002_uploadsession_uploadchunk_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileshare',
+            name='served_ranges',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
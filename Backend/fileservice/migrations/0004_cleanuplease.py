@@ -0,0 +1,24 @@
+# Generated by Django 4.2.23 on 2026-10-17 01:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileservice', '0003_fileshare_served_ranges'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CleanupLease',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('holder', models.CharField(blank=True, max_length=255)),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'cleanup_leases',
+            },
+        ),
+    ]
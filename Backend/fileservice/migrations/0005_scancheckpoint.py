@@ -0,0 +1,25 @@
+# Generated by Django 4.2.23 on 2026-10-17 01:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileservice', '0004_cleanuplease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanCheckpoint',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('cursor', models.CharField(blank=True, max_length=1000)),
+                ('passes_completed', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'scan_checkpoints',
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.23 on 2026-10-17 02:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileservice', '0005_scancheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('file_path', models.CharField(max_length=500)),
+                ('size', models.BigIntegerField()),
+                ('ref_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'stored_blobs',
+                'indexes': [models.Index(fields=['ref_count'], name='stored_blob_ref_cou_87f4ba_idx')],
+            },
+        ),
+        migrations.AddField(
+            model_name='fileshare',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='shares', to='fileservice.storedblob'),
+        ),
+    ]
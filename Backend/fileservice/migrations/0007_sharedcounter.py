@@ -0,0 +1,24 @@
+# Generated by Django 4.2.23 on 2026-10-17 02:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileservice', '0006_storedblob_fileshare_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedCounter',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'shared_counters',
+            },
+        ),
+    ]
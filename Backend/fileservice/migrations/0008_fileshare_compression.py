@@ -0,0 +1,23 @@
+# Generated by Django 4.2.23 on 2026-10-17 02:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileservice', '0007_sharedcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileshare',
+            name='content_encoding',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='fileshare',
+            name='stored_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.23 on 2026-10-17 02:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileservice', '0008_fileshare_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileshare',
+            name='pack_offset',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='PackSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_path', models.CharField(max_length=500)),
+                ('size', models.BigIntegerField(default=0)),
+                ('sealed', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'pack_segments',
+                'indexes': [models.Index(fields=['sealed', 'updated_at'], name='pack_segmen_sealed_7543b7_idx')],
+            },
+        ),
+        migrations.AddField(
+            model_name='fileshare',
+            name='pack_segment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='shares', to='fileservice.packsegment'),
+        ),
+    ]
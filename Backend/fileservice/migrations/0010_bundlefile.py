@@ -0,0 +1,42 @@
+# Generated by Django 4.2.23 on 2026-10-17 02:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileservice', '0009_packsegment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileshare',
+            name='is_bundle',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='BundleFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField()),
+                ('name', models.CharField(max_length=500)),
+                ('file_size', models.BigIntegerField()),
+                ('content_type', models.CharField(max_length=100)),
+                ('content_encoding', models.CharField(blank=True, default='', max_length=16)),
+                ('stored_size', models.BigIntegerField()),
+                ('crc32', models.BigIntegerField()),
+                ('file_path', models.CharField(max_length=500)),
+                ('blob', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='bundle_files', to='fileservice.storedblob')),
+                ('bundle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bundle_files', to='fileservice.fileshare')),
+            ],
+            options={
+                'db_table': 'bundle_files',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='bundlefile',
+            constraint=models.UniqueConstraint(fields=('bundle', 'position'), name='unique_bundle_position'),
+        ),
+    ]
@@ -1,14 +1,16 @@
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
 from django.utils import timezone
-import string
-import random
+import uuid
 from datetime import timedelta
+from .codes import MAX_ALLOCATION_ATTEMPTS, is_code_collision, next_code, record_collision
+from .ranges import merge_ranges, ranges_cover
 
 
 def generate_file_code():
-    """Generate a random 8-character alphanumeric code"""
-    characters = string.ascii_letters + string.digits
-    return ''.join(random.choice(characters) for _ in range(8))
+    """Generate a cryptographically random 8-character alphanumeric code"""
+    return next_code()
 
 
 class FileShare(models.Model):
@@ -17,14 +19,25 @@ class FileShare(models.Model):
     original_filename = models.CharField(max_length=255)
     file_size = models.BigIntegerField()  # Size in bytes
     content_type = models.CharField(max_length=100)
+    content_encoding = models.CharField(max_length=16, blank=True, default='')  # 'gzip' when stored compressed
+    stored_size = models.BigIntegerField(null=True, blank=True)  # Bytes on disk; null on rows from before compression
     
     # File storage path (relative to media root)
     file_path = models.CharField(max_length=500)
+    blob = models.ForeignKey(
+        'StoredBlob', null=True, blank=True, on_delete=models.PROTECT, related_name='shares'
+    )  # Set when the content is stored deduplicated
+    pack_segment = models.ForeignKey(
+        'PackSegment', null=True, blank=True, on_delete=models.PROTECT, related_name='shares'
+    )  # Set when a small file is stored inside a pack segment
+    pack_offset = models.BigIntegerField(null=True, blank=True)  # Where its stored_size bytes start
+    is_bundle = models.BooleanField(default=False)  # Several files, stored as BundleFile rows and sent as a ZIP
     
     # Download tracking
     is_downloaded = models.BooleanField(default=False)
     download_count = models.IntegerField(default=0)
     downloaded_at = models.DateTimeField(null=True, blank=True)
+    served_ranges = models.JSONField(default=list, blank=True)  # Byte ranges delivered by partial downloads
     
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
@@ -55,20 +68,291 @@ class FileShare(models.Model):
         return not self.is_downloaded and not self.is_expired()
     
     def mark_downloaded(self):
-        """Mark file as downloaded and set expiration"""
+        """Mark file as downloaded, set expiration and schedule its deletion"""
         from django.conf import settings
+        from . import metadata_cache
+        from .scheduler import schedule_deletion
         
+        was_downloaded = self.is_downloaded
         self.is_downloaded = True
         self.download_count += 1
         self.downloaded_at = timezone.now()
         # Set expiration to 1 minute after download
         self.expires_at = timezone.now() + timedelta(minutes=getattr(settings, 'FILE_EXPIRE_MINUTES', 1))
-        self.save()
+        self.save(update_fields=['is_downloaded', 'download_count', 'downloaded_at', 'expires_at'])
+        
+        # Cached metadata must not outlive the committed change
+        transaction.on_commit(lambda: metadata_cache.invalidate(self.code))
+        
+        # Queue one deletion per file, once the download is committed
+        if not was_downloaded:
+            transaction.on_commit(lambda: schedule_deletion(self))
+    
+    @classmethod
+    def _claim_update(cls, code, token):
+        """The conditional UPDATE behind claim_download, as (queryset, values)"""
+        from django.conf import settings
+        
+        now = timezone.now()
+        candidates = cls.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gte=now),
+            code=code,
+            is_downloaded=False,
+        )
+        if token is not None:
+            candidates = candidates.filter(download_token=token)
+        return candidates, {
+            'is_downloaded': True,
+            'download_count': F('download_count') + 1,
+            'downloaded_at': now,
+            'expires_at': now + timedelta(minutes=getattr(settings, 'FILE_EXPIRE_MINUTES', 1)),
+        }
+    
+    @classmethod
+    def claim_download(cls, code, token=None):
+        """
+        Atomically consume a one-time download. A single conditional
+        UPDATE flips is_downloaded, so of any number of concurrent
+        callers exactly one wins. Returns the claimed row for the
+        winner and None for everyone else. Pass token=None only when
+        the caller has already verified a signed download token.
+        """
+        candidates, values = cls._claim_update(code, token)
+        if not candidates.update(**values):
+            return None
+        
+        file_share = cls.objects.get(code=code)
+        file_share._claimed()
+        return file_share
+    
+    @classmethod
+    async def aclaim_download(cls, code, token=None):
+        """Async version of claim_download"""
+        candidates, values = cls._claim_update(code, token)
+        if not await candidates.aupdate(**values):
+            return None
+        
+        file_share = await cls.objects.aget(code=code)
+        await sync_to_async(file_share._claimed)()
+        return file_share
+    
+    def _claimed(self):
+        """Invalidate cached metadata and queue deletion once the claim commits"""
+        from . import metadata_cache
+        from .scheduler import schedule_deletion
+        
+        transaction.on_commit(lambda: metadata_cache.invalidate(self.code))
+        transaction.on_commit(lambda: schedule_deletion(self))
+    
+    def start_partial_download(self):
+        """
+        Start the grace window for a download fetched in byte ranges.
+        The file stays available until every byte has been served or
+        the window runs out, whichever comes first.
+        """
+        from django.conf import settings
+        from . import metadata_cache
+        
+        if self.expires_at is None:
+            grace = timedelta(minutes=getattr(settings, 'DOWNLOAD_RANGE_GRACE_MINUTES', 30))
+            if FileShare.objects.filter(pk=self.pk, expires_at__isnull=True).update(
+                expires_at=timezone.now() + grace
+            ):
+                transaction.on_commit(lambda: metadata_cache.invalidate(self.code))
+    
+    def record_served_ranges(self, ranges, size):
+        """
+        Record byte ranges that were fully delivered. The file counts as
+        downloaded once the served ranges cover all of it.
+        """
+        with transaction.atomic():
+            try:
+                file_share = FileShare.objects.select_for_update().get(pk=self.pk)
+            except FileShare.DoesNotExist:
+                return
+            if file_share.is_downloaded:
+                return
+            
+            served = [tuple(r) for r in file_share.served_ranges] + [tuple(r) for r in ranges]
+            file_share.served_ranges = [list(r) for r in merge_ranges(served)]
+            if ranges_cover(file_share.served_ranges, size):
+                file_share.mark_downloaded()
+            else:
+                file_share.save(update_fields=['served_ranges'])
     
     def save(self, *args, **kwargs):
-        # Ensure code is unique
-        if not self.code:
-            self.code = generate_file_code()
-            while FileShare.objects.filter(code=self.code).exists():
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        
+        # Uniqueness is enforced by the INSERT itself; on a duplicate code
+        # retry with a fresh one instead of checking with a SELECT first
+        for attempt in range(MAX_ALLOCATION_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError as e:
+                if not is_code_collision(e) or attempt == MAX_ALLOCATION_ATTEMPTS - 1:
+                    raise
+                record_collision(self.code)
                 self.code = generate_file_code()
-        super().save(*args, **kwargs)
+
+
+class UploadSession(models.Model):
+    """A resumable upload that is received as numbered chunks"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    
+    # Declared file metadata
+    original_filename = models.CharField(max_length=255)
+    file_size = models.BigIntegerField()  # Total size in bytes
+    content_type = models.CharField(max_length=100)
+    chunk_size = models.IntegerField()
+    
+    # Partial file the chunks are written into (relative to media root)
+    partial_path = models.CharField(max_length=500)
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    
+    class Meta:
+        db_table = 'upload_sessions'
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.id} - {self.original_filename}"
+    
+    @property
+    def total_chunks(self):
+        """Number of chunks needed to cover the whole file"""
+        return max(1, -(-self.file_size // self.chunk_size))
+    
+    def chunk_length(self, index):
+        """Expected length in bytes of the chunk at the given index"""
+        return min(self.chunk_size, self.file_size - index * self.chunk_size)
+    
+    def received_indexes(self):
+        """Indexes of chunks that have been fully received"""
+        return list(self.chunks.order_by('index').values_list('index', flat=True))
+    
+    def is_expired(self):
+        """Check if the upload session has expired"""
+        return timezone.now() > self.expires_at
+
+
+class UploadChunk(models.Model):
+    """A chunk of an upload session that has been written to disk"""
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name='chunks')
+    index = models.IntegerField()
+    size = models.IntegerField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'upload_chunks'
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'index'], name='unique_upload_chunk'),
+        ]
+
+
+class CleanupLease(models.Model):
+    """A named lease that lets one worker in the cluster run a periodic job"""
+    name = models.CharField(max_length=100, primary_key=True)
+    holder = models.CharField(max_length=255, blank=True)
+    expires_at = models.DateTimeField()
+    
+    class Meta:
+        db_table = 'cleanup_leases'
+    
+    def __str__(self):
+        return f"{self.name} - {self.holder}"
+
+
+class ScanCheckpoint(models.Model):
+    """Where an incremental scan of the media tree should resume"""
+    name = models.CharField(max_length=100, primary_key=True)
+    cursor = models.CharField(max_length=1000, blank=True)  # Last path processed, relative to media root
+    passes_completed = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'scan_checkpoints'
+    
+    def __str__(self):
+        return f"{self.name} - {self.cursor or '(start)'}"
+
+
+class StoredBlob(models.Model):
+    """Deduplicated file content shared by every FileShare with the same digest"""
+    digest = models.CharField(max_length=64, unique=True)  # SHA-256 of the content, keyed by its stored encoding
+    file_path = models.CharField(max_length=500)  # Relative to media root
+    size = models.BigIntegerField()
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'stored_blobs'
+        indexes = [
+            models.Index(fields=['ref_count']),
+        ]
+    
+    def __str__(self):
+        return f"{self.digest[:12]} ({self.ref_count} refs)"
+
+
+class SharedCounter(models.Model):
+    """A named counter shared by every worker"""
+    name = models.CharField(max_length=100, primary_key=True)
+    value = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'shared_counters'
+    
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+
+class PackSegment(models.Model):
+    """Append-only file holding many small uploads back to back"""
+    file_path = models.CharField(max_length=500)  # Relative to media root
+    size = models.BigIntegerField(default=0)  # Bytes claimed by appends so far
+    sealed = models.BooleanField(default=False)  # Takes no more appends; only the compactor touches it
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'pack_segments'
+        indexes = [
+            models.Index(fields=['sealed', 'updated_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.file_path} ({self.size} bytes{', sealed' if self.sealed else ''})"
+
+
+class BundleFile(models.Model):
+    """One file of a bundle share; the bundle's FileShare row carries the code and expiry"""
+    bundle = models.ForeignKey(FileShare, on_delete=models.CASCADE, related_name='bundle_files')
+    position = models.IntegerField()  # Order of the entry in the archive
+    name = models.CharField(max_length=500)  # Path of the entry inside the archive
+    file_size = models.BigIntegerField()  # Size in bytes
+    content_type = models.CharField(max_length=100)
+    content_encoding = models.CharField(max_length=16, blank=True, default='')
+    stored_size = models.BigIntegerField()  # Bytes on disk
+    crc32 = models.BigIntegerField()  # CRC-32 of the original content, as ZIP headers need it up front
+    
+    # File storage path (relative to media root)
+    file_path = models.CharField(max_length=500)
+    blob = models.ForeignKey(
+        'StoredBlob', null=True, blank=True, on_delete=models.PROTECT, related_name='bundle_files'
+    )
+    
+    class Meta:
+        db_table = 'bundle_files'
+        constraints = [
+            models.UniqueConstraint(fields=['bundle', 'position'], name='unique_bundle_position'),
+        ]
+    
+    def __str__(self):
+        return f"{self.bundle_id} - {self.name}"
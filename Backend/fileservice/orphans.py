@@ -0,0 +1,212 @@
+import heapq
+import os
+import time
+from django.conf import settings
+from . import metrics
+from .models import BundleFile, FileShare, ScanCheckpoint, StoredBlob, UploadSession
+from .storage import path_aliases
+from .upload_handlers import is_partial_file
+
+
+CHECKPOINT_NAME = 'orphaned-files'
+
+
+def get_scan_max_files():
+    """Files examined per scanner run"""
+    return getattr(settings, 'ORPHAN_SCAN_MAX_FILES', 5000)
+
+
+def get_min_age():
+    """Files younger than this many seconds are never treated as orphans"""
+    return getattr(settings, 'ORPHAN_MIN_AGE_SECONDS', 3600)
+
+
+def get_partial_min_age():
+    """
+    Partial files of uploads that are still running are never this old:
+    chunked upload sessions expire after UPLOAD_SESSION_EXPIRE_HOURS
+    """
+    return getattr(settings, 'UPLOAD_SESSION_EXPIRE_HOURS', 24) * 3600
+
+
+def get_db_batch_size():
+    """Paths checked against the database per IN query"""
+    return getattr(settings, 'ORPHAN_DB_BATCH_SIZE', 500)
+
+
+class OrphanScanResult:
+    """Counters for one scanner run"""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.scanned = 0
+        self.orphaned = 0
+        self.deleted = 0
+        self.skipped_young = 0
+        self.pass_completed = False
+        self.errors = []
+
+    def __str__(self):
+        verb = 'would delete' if self.dry_run else 'deleted'
+        return f"Scanned {self.scanned} files, {verb} {self.orphaned} orphans"
+
+
+def _iter_files(base, rel_parts, after):
+    """
+    Yield (relative parts, DirEntry) for every file below ``base``, in
+    sorted order, starting after the ``after`` cursor. Directories that
+    sort entirely before the cursor are skipped without being listed.
+    A directory is still read in full, since scandir cannot start
+    part-way, but entries before the cursor are dropped as they are
+    read and the rest are ordered lazily with a heap, so a bounded
+    scan of a large shard directory pays only for the entries it visits.
+    """
+    floor = after[len(rel_parts)] if after is not None and len(after) > len(rel_parts) else None
+    try:
+        with os.scandir(os.path.join(base, *rel_parts)) as it:
+            # Names are unique within a directory, so entries are never compared
+            entries = [(entry.name, entry) for entry in it if floor is None or entry.name >= floor]
+    except FileNotFoundError:
+        return
+    heapq.heapify(entries)
+
+    while entries:
+        _, entry = heapq.heappop(entries)
+        parts = rel_parts + (entry.name,)
+        if entry.is_dir(follow_symlinks=False):
+            sub_after = None
+            if after is not None:
+                prefix = after[:len(parts)]
+                if parts < prefix:
+                    continue
+                if parts == prefix:
+                    sub_after = after
+            yield from _iter_files(base, parts, sub_after)
+        elif entry.is_file(follow_symlinks=False):
+            if after is not None and parts <= after:
+                continue
+            yield parts, entry
+
+
+def referenced_paths(paths):
+    """
+    Return the subset of media-relative paths still referenced in the
+    database, counting a file as referenced under any of its layout
+    aliases so files mid-migration are never mistaken for orphans.
+    """
+    aliases = {path: path_aliases(path) for path in paths}
+    candidates = {alias for group in aliases.values() for alias in group}
+    stored = set(
+        FileShare.objects
+        .filter(file_path__in=candidates)
+        .values_list('file_path', flat=True)
+    )
+    stored.update(
+        BundleFile.objects
+        .filter(file_path__in=candidates)
+        .values_list('file_path', flat=True)
+    )
+    stored.update(
+        UploadSession.objects
+        .filter(partial_path__in=candidates)
+        .values_list('partial_path', flat=True)
+    )
+    # Deduplicated content stays while any share holds a reference to it
+    stored.update(
+        StoredBlob.objects
+        .filter(file_path__in=candidates, ref_count__gt=0)
+        .values_list('file_path', flat=True)
+    )
+    return {path for path, group in aliases.items() if group & stored}
+
+
+def _process_candidates(candidates, result, dry_run, on_orphan):
+    """Check a batch of candidate files in one query and delete the orphans"""
+    referenced = referenced_paths([path for path, _ in candidates])
+    for path, full_path in candidates:
+        if path in referenced:
+            continue
+        result.orphaned += 1
+        if dry_run:
+            error = None
+        else:
+            try:
+                os.remove(full_path)
+                result.deleted += 1
+                error = None
+            except FileNotFoundError:
+                error = None
+            except OSError as e:
+                error = str(e)
+                result.errors.append(f'Error deleting orphaned file {path}: {error}')
+        if on_orphan is not None:
+            on_orphan(path, error)
+
+
+def scan_orphans(max_files=None, min_age=None, dry_run=False, time_budget=None, on_orphan=None):
+    """
+    Remove files under MEDIA_ROOT/uploads that no row references.
+
+    Each run examines at most ``max_files`` files with os.scandir,
+    continuing from the cursor saved by the previous run, and checks
+    them against the database in batched ``IN`` queries. Files younger
+    than ``min_age`` seconds are always kept, and partial files of
+    uploads until their session could no longer be alive. When the
+    end of the tree is reached the cursor wraps around to the start.
+    ``on_orphan(path, error)`` is called for every orphan found.
+    """
+    max_files = max_files or get_scan_max_files()
+    min_age = get_min_age() if min_age is None else min_age
+    batch_size = get_db_batch_size()
+
+    result = OrphanScanResult(dry_run=dry_run)
+    uploads_dir = os.path.join(settings.MEDIA_ROOT, 'uploads')
+    if not os.path.isdir(uploads_dir):
+        result.pass_completed = True
+        return result
+
+    checkpoint, _ = ScanCheckpoint.objects.get_or_create(name=CHECKPOINT_NAME)
+    after = tuple(checkpoint.cursor.split('/')) if checkpoint.cursor else None
+
+    started = time.monotonic()
+    cutoff = time.time() - min_age
+    partial_cutoff = time.time() - max(min_age, get_partial_min_age())
+    last_path = checkpoint.cursor
+    candidates = []
+    result.pass_completed = True
+
+    for parts, entry in _iter_files(uploads_dir, (), after):
+        if result.scanned >= max_files or (time_budget and time.monotonic() - started >= time_budget):
+            result.pass_completed = False
+            break
+
+        result.scanned += 1
+        last_path = '/'.join(parts)
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime > (
+                partial_cutoff if is_partial_file(entry.name) else cutoff
+            ):
+                result.skipped_young += 1
+                continue
+        except FileNotFoundError:
+            continue
+
+        candidates.append((f'uploads/{last_path}', entry.path))
+        if len(candidates) >= batch_size:
+            _process_candidates(candidates, result, dry_run, on_orphan)
+            candidates = []
+
+    if candidates:
+        _process_candidates(candidates, result, dry_run, on_orphan)
+
+    if not dry_run:
+        if result.pass_completed:
+            checkpoint.cursor = ''
+            checkpoint.passes_completed += 1
+        else:
+            checkpoint.cursor = last_path
+        checkpoint.save()
+        metrics.ORPHANS_FOUND.inc(result.orphaned)
+        metrics.ORPHANS_DELETED.inc(result.deleted)
+
+    return result
@@ -0,0 +1,304 @@
+"""
+Packed storage for small files.
+
+Uploads of at most PACK_MAX_FILE_SIZE bytes are appended to a segment
+file under MEDIA_ROOT/packs/ instead of getting a file of their own.
+The FileShare row records the segment and offset, and a download reads
+the bytes back with a single positioned read.
+
+Each process appends only to the segment it opened itself, so appends
+need no cross-process file locking. Every append first claims its space
+with a conditional UPDATE that fails once the segment is sealed; the
+compactor seals a segment the same way before deleting or rewriting it,
+so it never removes a segment a worker is still writing to.
+"""
+import os
+import threading
+import time
+import uuid
+import zlib
+from datetime import timedelta
+from types import SimpleNamespace
+from django.conf import settings
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import FileShare, PackSegment
+from .storage import media_path
+
+PACKS_DIR = 'packs'
+
+
+def packing_enabled():
+    """Whether small uploads are stored in pack segments"""
+    return getattr(settings, 'STORAGE_PACKING', False)
+
+
+def get_max_file_size():
+    """Largest upload, in bytes, that is packed"""
+    return getattr(settings, 'PACK_MAX_FILE_SIZE', 64 * 1024)
+
+
+def get_segment_size():
+    """Size at which a segment stops taking appends"""
+    return getattr(settings, 'PACK_SEGMENT_SIZE', 64 * 1024 * 1024)
+
+
+def get_segment_max_age():
+    """
+    Seconds a segment takes appends for. Idle segments older than this
+    are sealed by the compactor, and emptied ones are kept this long
+    before their file is removed.
+    """
+    return getattr(settings, 'PACK_SEGMENT_MAX_AGE', 3600)
+
+
+def get_compact_threshold():
+    """Sealed segments with less than this fraction of live bytes are rewritten"""
+    return getattr(settings, 'PACK_COMPACT_THRESHOLD', 0.5)
+
+
+def should_pack(file_size):
+    """Check whether a file of this original size goes into a pack segment"""
+    return packing_enabled() and file_size is not None and file_size <= get_max_file_size()
+
+
+class _ActiveSegment:
+    """The segment this process appends to"""
+
+    def __init__(self, segment, fd):
+        self.segment = segment
+        self.fd = fd
+        self.size = 0
+        self.opened = time.monotonic()
+
+    def is_full(self, length):
+        return (self.size + length > get_segment_size()
+                or time.monotonic() - self.opened >= get_segment_max_age())
+
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+_lock = threading.Lock()
+_active = None
+
+
+def _reset_after_fork():
+    """A forked child must not append to its parent's segment"""
+    global _lock, _active
+    _lock = threading.Lock()
+    _active = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _open_segment():
+    relative_path = f'{PACKS_DIR}/{uuid.uuid4().hex}.pack'
+    full_path = media_path(relative_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    # The file exists before its row, so a failed insert only leaves a stray file
+    fd = os.open(full_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        segment = PackSegment.objects.create(file_path=relative_path)
+    except Exception:
+        os.close(fd)
+        raise
+    return _ActiveSegment(segment, fd)
+
+
+def _retire(active):
+    """Stop appending to a segment; the compactor takes it from here"""
+    PackSegment.objects.filter(pk=active.segment.pk).update(sealed=True, updated_at=timezone.now())
+    active.close()
+
+
+def append(data):
+    """Append bytes to this process's segment. Returns (segment, offset)"""
+    global _active
+    with _lock:
+        while True:
+            if _active is not None and _active.is_full(len(data)):
+                _retire(_active)
+                _active = None
+            if _active is None:
+                _active = _open_segment()
+
+            claimed = PackSegment.objects.filter(pk=_active.segment.pk, sealed=False).update(
+                size=F('size') + len(data), updated_at=timezone.now()
+            )
+            if not claimed:
+                # Sealed by the compactor while this process was idle
+                _active.close()
+                _active = None
+                continue
+
+            offset = _active.size
+            _active.size += len(data)
+            written = 0
+            while written < len(data):
+                written += os.pwrite(_active.fd, data[written:], offset + written)
+            return _active.segment, offset
+
+
+def store_packed(partial_path):
+    """
+    Move a fully written small partial file into a pack segment.
+    Returns the FileShare fields that locate it.
+    """
+    with open(partial_path, 'rb') as f:
+        data = f.read()
+    segment, offset = append(data)
+    os.remove(partial_path)
+    return {
+        'file_path': segment.file_path,
+        'pack_segment': segment,
+        'pack_offset': offset,
+    }
+
+
+def entry_stat(file_share):
+    """Stand-in for os.stat of a packed file, for validators and range checks"""
+    modified = file_share.created_at.timestamp()
+    return SimpleNamespace(
+        st_size=file_share.stored_size,
+        st_mtime=modified,
+        st_mtime_ns=int(modified * 1_000_000_000),
+    )
+
+
+def _read(file_path, offset, length):
+    fd = os.open(media_path(file_path), os.O_RDONLY)
+    try:
+        data = os.pread(fd, length, offset)
+    finally:
+        os.close(fd)
+    if len(data) != length:
+        raise OSError(f'Packed entry at {file_path}:{offset} is truncated')
+    return data
+
+
+def read_entry(file_share, decompress=False):
+    """The stored bytes of a packed file, inflated when ``decompress`` is set"""
+    data = _read(file_share.file_path, file_share.pack_offset, file_share.stored_size)
+    if decompress:
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return data
+
+
+class CompactionResult:
+    """Counters for one compactor run"""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.sealed = 0
+        self.rewritten = 0
+        self.entries_moved = 0
+        self.segments_deleted = 0
+        self.bytes_reclaimed = 0
+        self.stray_files_deleted = 0
+        self.errors = []
+
+    def __str__(self):
+        verb = 'Would delete' if self.dry_run else 'Deleted'
+        return (
+            f"{verb} {self.segments_deleted} pack segments ({self.bytes_reclaimed} bytes), "
+            f"rewrote {self.rewritten}"
+        )
+
+
+def _rewrite(segment, result):
+    """Copy a sparse segment's live entries to the active segment and repoint their rows"""
+    entries = FileShare.objects.filter(pack_segment=segment).values_list('id', 'pack_offset', 'stored_size')
+    for file_id, offset, length in entries:
+        data = _read(segment.file_path, offset, length)
+        target, target_offset = append(data)
+        # Only if the row still points at the old copy; it may have been cleaned up meanwhile
+        result.entries_moved += FileShare.objects.filter(
+            pk=file_id, pack_segment=segment, pack_offset=offset
+        ).update(pack_segment=target, pack_offset=target_offset, file_path=target.file_path)
+    # Restart the grace period, so readers that looked up the old offset can finish
+    PackSegment.objects.filter(pk=segment.pk).update(updated_at=timezone.now())
+    result.rewritten += 1
+
+
+def compact_packs(dry_run=False):
+    """
+    Reclaim pack segment space.
+
+    Idle segments are sealed, sealed segments whose live bytes fell
+    below PACK_COMPACT_THRESHOLD are rewritten, and sealed segments no
+    row references any more are deleted once they have been idle for
+    PACK_SEGMENT_MAX_AGE seconds. Files under packs/ without a segment
+    row are removed after the same grace period.
+    """
+    result = CompactionResult(dry_run=dry_run)
+    cutoff = timezone.now() - timedelta(seconds=get_segment_max_age())
+
+    idle = PackSegment.objects.filter(sealed=False, updated_at__lt=cutoff)
+    result.sealed = idle.count() if dry_run else idle.update(sealed=True)
+
+    segments = (
+        PackSegment.objects
+        .filter(sealed=True)
+        .annotate(live_entries=Count('shares'), live_bytes=Coalesce(Sum('shares__stored_size'), 0))
+        .order_by('id')
+    )
+    threshold = get_compact_threshold()
+    for segment in segments:
+        if segment.live_entries == 0:
+            if segment.updated_at >= cutoff:
+                continue
+            if not dry_run:
+                deleted, _ = PackSegment.objects.filter(pk=segment.pk, shares__isnull=True).delete()
+                if not deleted:
+                    continue
+                try:
+                    os.remove(media_path(segment.file_path))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    result.errors.append(f'Error deleting pack segment {segment.file_path}: {e}')
+            result.segments_deleted += 1
+            result.bytes_reclaimed += segment.size
+        elif segment.size and segment.live_bytes < segment.size * threshold:
+            if dry_run:
+                result.rewritten += 1
+                continue
+            try:
+                _rewrite(segment, result)
+            except OSError as e:
+                result.errors.append(f'Error rewriting pack segment {segment.file_path}: {e}')
+
+    result.stray_files_deleted = _remove_stray_files(cutoff, dry_run, result)
+    return result
+
+
+def _remove_stray_files(cutoff, dry_run, result):
+    """Remove segment files whose row was never written or is gone"""
+    packs_dir = media_path(PACKS_DIR)
+    try:
+        entries = [entry for entry in os.scandir(packs_dir) if entry.is_file(follow_symlinks=False)]
+    except FileNotFoundError:
+        return 0
+
+    known = set(PackSegment.objects.values_list('file_path', flat=True))
+    removed = 0
+    for entry in entries:
+        if f'{PACKS_DIR}/{entry.name}' in known:
+            continue
+        try:
+            if entry.stat().st_mtime >= cutoff.timestamp():
+                continue
+            if not dry_run:
+                os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            result.errors.append(f'Error deleting stray pack file {entry.name}: {e}')
+    return removed
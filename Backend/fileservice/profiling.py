@@ -0,0 +1,339 @@
+"""
+Per-request timing, query counts and optional profiling, used by
+RequestProfilingMiddleware.
+
+The profile of the running request lives in a context variable, so
+code anywhere below the view can attribute time to a phase with
+``phase('name')``. Phases are exclusive: time spent in a nested phase
+(database queries inside storage, for example) is only counted once,
+under the innermost one. Outside an instrumented request ``phase`` and
+the query wrapper only do a context variable lookup.
+"""
+import cProfile
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+PROFILER_CPROFILE = 'cprofile'
+PROFILER_SAMPLE = 'sample'
+
+# Header that turns on profiling for one request; its value must match REQUEST_PROFILING_TOKEN
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+_current = contextvars.ContextVar('request_profile', default=None)
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def is_enabled():
+    """Whether requests are instrumented at all"""
+    return getattr(settings, 'REQUEST_PROFILING', False)
+
+
+def get_sample_rate():
+    """Fraction of requests profiled without being asked to"""
+    return getattr(settings, 'REQUEST_PROFILING_SAMPLE_RATE', 0.0)
+
+
+def get_profiler():
+    """Profiler used for profiled requests: 'cprofile' or 'sample'"""
+    return getattr(settings, 'REQUEST_PROFILING_PROFILER', PROFILER_CPROFILE)
+
+
+def get_token():
+    """Secret that enables profiling through the X-Profile header, or None"""
+    return getattr(settings, 'REQUEST_PROFILING_TOKEN', None) or None
+
+
+def get_slow_threshold():
+    """Requests taking at least this many milliseconds are written to the sink"""
+    return getattr(settings, 'REQUEST_PROFILING_SLOW_MS', 500)
+
+
+def get_query_budget():
+    """Queries a request may run before it is reported, or None for no budget"""
+    return getattr(settings, 'REQUEST_QUERY_BUDGET', None) or None
+
+
+@contextmanager
+def phase(name):
+    """Attribute the time spent in the block to ``name``"""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    profile.enter(name)
+    try:
+        yield
+    finally:
+        profile.exit()
+
+
+def _thread_io():
+    """Bytes read and written by the current thread, where Linux reports them"""
+    try:
+        with open('/proc/thread-self/io', 'rb') as f:
+            fields = dict(line.split(b':') for line in f.read().splitlines())
+        return int(fields[b'rchar']), int(fields[b'wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class StackSampler:
+    """
+    Sample the stack of one thread at a fixed interval from a helper
+    thread, counting collapsed stacks ('outer;inner;leaf') as used by
+    flame graph tools. Cheaper than cProfile on deep call chains.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._target = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='request-stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def report(self, limit):
+        return {
+            'profiler': PROFILER_SAMPLE,
+            'interval_ms': self.interval * 1000,
+            'stacks': [
+                {'stack': stack, 'samples': count}
+                for stack, count in self.samples.most_common(limit)
+            ],
+        }
+
+
+class CProfiler:
+    """cProfile around one request, reported as its most expensive functions"""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def report(self, limit):
+        stats = pstats.Stats(self.profile).stats
+        top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        return {
+            'profiler': PROFILER_CPROFILE,
+            'functions': [
+                {
+                    'function': f'{os.path.basename(filename)}:{line}({name})',
+                    'calls': calls,
+                    'own_ms': round(own * 1000, 3),
+                    'cumulative_ms': round(cumulative * 1000, 3),
+                }
+                for (filename, line, name), (_, calls, own, cumulative, _) in top
+            ],
+        }
+
+
+class RequestProfile:
+    """Timings, query count and I/O of one request"""
+
+    def __init__(self, request, profiler=None, track_io=True):
+        self.method = request.method
+        self.path = request.path
+        self.profiler = profiler
+        self.phases = defaultdict(float)
+        self.queries = 0
+        self.total = None
+        self.io = None
+
+        self._stack = []
+        self._io_start = _thread_io() if track_io else None
+        self._started = time.perf_counter()
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            parent, resumed = self._stack[-1]
+            self.phases[parent] += now - resumed
+        self._stack.append((name, now))
+
+    def exit(self):
+        now = time.perf_counter()
+        name, resumed = self._stack.pop()
+        self.phases[name] += now - resumed
+        if self._stack:
+            self._stack[-1] = (self._stack[-1][0], now)
+
+    def finish(self):
+        self.total = time.perf_counter() - self._started
+        if self._io_start is not None:
+            io_end = _thread_io()
+            if io_end is not None:
+                self.io = {
+                    'read_bytes': io_end[0] - self._io_start[0],
+                    'written_bytes': io_end[1] - self._io_start[1],
+                }
+
+    @property
+    def over_budget(self):
+        budget = get_query_budget()
+        return budget is not None and self.queries > budget
+
+    def server_timing(self):
+        """Value for the Server-Timing response header"""
+        entries = []
+        for name, seconds in self.phases.items():
+            entry = f'{name};dur={seconds * 1000:.2f}'
+            if name == 'db':
+                entry += f';desc="{self.queries} queries"'
+            entries.append(entry)
+        app = self.total - sum(self.phases.values())
+        entries.append(f'app;dur={app * 1000:.2f}')
+        entries.append(f'total;dur={self.total * 1000:.2f}')
+        return ', '.join(entries)
+
+    def to_dict(self, status_code):
+        record = {
+            'time': time.time(),
+            'method': self.method,
+            'path': self.path,
+            'status': status_code,
+            'total_ms': round(self.total * 1000, 3),
+            'phases_ms': {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()},
+            'queries': self.queries,
+            'over_query_budget': self.over_budget,
+            'io': self.io,
+        }
+        if self.profiler is not None:
+            record['profile'] = self.profiler.report(getattr(settings, 'REQUEST_PROFILING_TOP', 30))
+        return record
+
+
+def _query_wrapper(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    profile.queries += 1
+    profile.enter('db')
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.exit()
+
+
+def _install_on_connection(sender, connection, **kwargs):
+    if _query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_query_wrapper)
+
+
+def install_query_wrapper():
+    """Count and time the queries of instrumented requests on every connection"""
+    connection_created.connect(_install_on_connection, dispatch_uid='fileservice.profiling')
+    for connection in connections.all(initialized_only=True):
+        _install_on_connection(None, connection)
+
+
+def _wants_profile(request):
+    token = get_token()
+    if token and request.META.get(PROFILE_HEADER) == token:
+        return True
+    rate = get_sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+def start_request(request, track_io=True):
+    """Start instrumenting a request. Returns (profile, context token)"""
+    profiler = None
+    if _wants_profile(request):
+        profiler = StackSampler() if get_profiler() == PROFILER_SAMPLE else CProfiler()
+    profile = RequestProfile(request, profiler=profiler, track_io=track_io)
+    token = _current.set(profile)
+    if profiler is not None:
+        profiler.start()
+    return profile, token
+
+
+def finish_request(profile, token, response):
+    """Stop instrumenting a request, annotate the response and write the record if needed"""
+    if profile.profiler is not None:
+        profile.profiler.stop()
+    _current.reset(token)
+    profile.finish()
+
+    if getattr(settings, 'REQUEST_PROFILING_SERVER_TIMING', True):
+        response['Server-Timing'] = profile.server_timing()
+
+    if profile.over_budget:
+        logger.warning(
+            '%s %s ran %d queries, over the budget of %d',
+            profile.method, profile.path, profile.queries, get_query_budget(),
+        )
+    if (profile.profiler is not None or profile.over_budget
+            or profile.total * 1000 >= get_slow_threshold()):
+        write_record(profile.to_dict(response.status_code))
+    return response
+
+
+def _get_sink():
+    """Logger writing JSON lines to the rotating REQUEST_PROFILING_FILE"""
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            path = getattr(settings, 'REQUEST_PROFILING_FILE', None) or os.path.join(
+                settings.BASE_DIR, 'profiles', 'requests.jsonl'
+            )
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                path,
+                maxBytes=getattr(settings, 'REQUEST_PROFILING_MAX_BYTES', 10 * 1024 * 1024),
+                backupCount=getattr(settings, 'REQUEST_PROFILING_BACKUP_COUNT', 5),
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            sink = logging.getLogger('fileservice.profiling.sink')
+            sink.addHandler(handler)
+            sink.setLevel(logging.INFO)
+            sink.propagate = False
+            _sink = sink
+        return _sink
+
+
+def write_record(record):
+    """Append one request record to the sink"""
+    try:
+        _get_sink().info(json.dumps(record, default=str))
+    except OSError:
+        logger.exception('Could not write request profile')
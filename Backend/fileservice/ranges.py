@@ -0,0 +1,211 @@
+import secrets
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+
+# Size of the blocks read from disk while streaming a range
+RANGE_CHUNK_SIZE = 64 * 1024
+
+# More ranges than this in one request are ignored and the whole file is sent
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when none of the requested byte ranges overlap the file"""
+
+
+def file_etag(stat_result):
+    """Build a strong validator from the file's size and modification time"""
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def merge_ranges(ranges):
+    """Sort byte ranges and coalesce any that overlap or touch"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def ranges_cover(ranges, size):
+    """Check whether a set of byte ranges covers the whole file"""
+    merged = merge_ranges(ranges)
+    if size == 0:
+        return True
+    return len(merged) == 1 and merged[0][0] == 0 and merged[0][1] >= size - 1
+
+
+def parse_range_header(header, size):
+    """
+    Parse a ``Range: bytes=...`` header into a list of inclusive
+    (start, end) pairs clamped to the file size, with overlapping ranges
+    coalesced. Returns None if the header should be ignored, and raises
+    RangeNotSatisfiable if no range overlaps the file.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if not first:
+                # Suffix range: the last N bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(0, size - length), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if start < 0 or (last and end < start):
+                    return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size and start <= end:
+            ranges.append((start, end))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges = merge_ranges(ranges)
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def if_range_matches(if_range, etag, mtime):
+    """
+    Check an ``If-Range`` precondition. Ranges are only honoured when the
+    validator still matches the file; otherwise the whole file is sent.
+    """
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Weak validators never match for range requests
+        return if_range == etag
+    if_range_time = parse_http_date_safe(if_range)
+    return if_range_time is not None and int(mtime) <= if_range_time
+
+
+def _iter_file_range(file_obj, start, end):
+    """Yield the bytes between start and end (inclusive) of an open file"""
+    file_obj.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        data = file_obj.read(min(RANGE_CHUNK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def _multipart_headers(boundary, content_type, start, end, size):
+    return (
+        f"--{boundary}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+    ).encode()
+
+
+def multipart_length(ranges, boundary, content_type, size):
+    """Exact length of a multipart/byteranges body"""
+    length = len(f"--{boundary}--\r\n")
+    for start, end in ranges:
+        length += len(_multipart_headers(boundary, content_type, start, end, size))
+        length += end - start + 1 + 2
+    return length
+
+
+def _iter_ranges(file_path, ranges, boundary, content_type, size, on_complete):
+    with open(file_path, 'rb') as file_obj:
+        if boundary is None:
+            start, end = ranges[0]
+            yield from _iter_file_range(file_obj, start, end)
+        else:
+            for start, end in ranges:
+                yield _multipart_headers(boundary, content_type, start, end, size)
+                yield from _iter_file_range(file_obj, start, end)
+                yield b"\r\n"
+            yield f"--{boundary}--\r\n".encode()
+    # Only reached when the client received every byte
+    if on_complete is not None:
+        on_complete(ranges)
+
+
+async def _aiter_ranges(file_path, ranges, boundary, content_type, size, on_complete):
+    """Async version of _iter_ranges; reads and on_complete run in worker threads"""
+    blocks = _iter_ranges(file_path, ranges, boundary, content_type, size, None)
+    next_block = sync_to_async(next, thread_sensitive=False)
+    while True:
+        block = await next_block(blocks, None)
+        if block is None:
+            break
+        yield block
+    if on_complete is not None:
+        await sync_to_async(on_complete)(ranges)
+
+
+def range_response(file_path, ranges, size, content_type, head=False, on_complete=None,
+                   asynchronous=False):
+    """
+    Build a 206 Partial Content response for one or more byte ranges.
+    A single range is sent as-is; several ranges are sent as a
+    multipart/byteranges body. ``on_complete`` is called with the ranges
+    once the whole body has been streamed. Async views pass
+    ``asynchronous=True`` to get a body that doesn't block the event loop.
+    """
+    if len(ranges) == 1:
+        boundary = None
+        start, end = ranges[0]
+        response_type = content_type
+        length = end - start + 1
+    else:
+        boundary = secrets.token_hex(16)
+        response_type = f'multipart/byteranges; boundary={boundary}'
+        length = multipart_length(ranges, boundary, content_type, size)
+
+    if head:
+        response = HttpResponse(status=206, content_type=response_type)
+    else:
+        iter_ranges = _aiter_ranges if asynchronous else _iter_ranges
+        response = StreamingHttpResponse(
+            iter_ranges(file_path, ranges, boundary, content_type, size, on_complete),
+            status=206,
+            content_type=response_type,
+        )
+    if boundary is None:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(length)
+    return response
+
+
+def add_validator_headers(response, stat_result):
+    """Advertise range support and the validators If-Range can use"""
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = file_etag(stat_result)
+    response['Last-Modified'] = http_date(stat_result.st_mtime)
+    return response
+
+
+def not_satisfiable_response(size):
+    """Build a 416 response for a range request that misses the file"""
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f'bytes */{size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
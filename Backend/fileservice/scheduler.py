@@ -0,0 +1,127 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Delay after expires_at before deleting, so the row is reliably expired
+DELETION_SLACK_SECONDS = 1
+
+# How long to stop trying Celery after the broker could not be reached
+CELERY_RETRY_AFTER_SECONDS = 60
+
+# Connect timeout for the broker, so an outage never stalls a download
+BROKER_CONNECT_TIMEOUT = 1
+
+
+class DeletionTimer:
+    """
+    In-process fallback for when Celery is unavailable: one background
+    thread that sleeps until the next scheduled expiry, instead of a
+    thread per download. Pending deletions are lost on restart; the
+    periodic cleanup picks those files up.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._scheduled = set()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, file_id, when):
+        """Delete the file at the given epoch time. Returns False if already scheduled."""
+        with self._condition:
+            if file_id in self._scheduled:
+                return False
+            heapq.heappush(self._heap, (when, file_id))
+            self._scheduled.add(file_id)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='file-deletion-timer', daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+        return True
+
+    def pending(self):
+        """Number of deletions waiting to run"""
+        with self._condition:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                when, file_id = self._heap[0]
+                delay = when - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                self._scheduled.discard(file_id)
+            self._delete(file_id)
+
+    def _delete(self, file_id):
+        from .tasks import schedule_file_deletion
+
+        try:
+            schedule_file_deletion(file_id)
+        except Exception:
+            logger.exception('Scheduled deletion of file %s failed', file_id)
+        finally:
+            # Long-lived thread: don't sit on a (pooled) connection between jobs
+            connections.close_all()
+
+
+deletion_timer = DeletionTimer()
+
+
+def _send_celery_deletion(file_id, eta):
+    """
+    Publish the deletion task with an ETA through the app's producer
+    pool, so a download reuses an open broker connection. A pooled
+    connection that is not up yet is connected once without kombu's
+    default retry loop, so an unreachable broker fails fast instead of
+    holding up the request.
+    """
+    from .tasks import schedule_file_deletion
+
+    with schedule_file_deletion.app.producer_or_acquire() as producer:
+        if not producer.connection.connected:
+            producer.connection.ensure_connection(
+                max_retries=1, interval_start=0, interval_step=0, timeout=BROKER_CONNECT_TIMEOUT
+            )
+        schedule_file_deletion.apply_async(
+            (file_id,), eta=eta, producer=producer, retry=False, ignore_result=True
+        )
+
+
+_celery_unavailable_until = 0
+
+
+def schedule_deletion(file_share):
+    """
+    Queue exactly one deletion of a downloaded file, timed to its
+    expires_at. Uses a Celery ETA task when the broker is reachable
+    and the in-process timer otherwise. Returns the backend used.
+    """
+    global _celery_unavailable_until
+
+    eta = file_share.expires_at + timedelta(seconds=DELETION_SLACK_SECONDS)
+    backend = getattr(settings, 'FILE_DELETION_SCHEDULER', 'auto')
+
+    if backend == 'celery' or (backend == 'auto' and time.time() >= _celery_unavailable_until):
+        try:
+            _send_celery_deletion(file_share.id, eta)
+            return 'celery'
+        except Exception as e:
+            _celery_unavailable_until = time.time() + CELERY_RETRY_AFTER_SECONDS
+            logger.warning('Celery unavailable, deleting file %s in-process: %s', file_share.code, e)
+
+    deletion_timer.schedule(file_share.id, eta.timestamp())
+    return 'timer'
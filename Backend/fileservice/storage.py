@@ -0,0 +1,58 @@
+import hashlib
+import os
+import posixpath
+from django.conf import settings
+
+
+def get_shard_levels():
+    """Number of directory levels uploads are spread over (0 = flat)"""
+    return getattr(settings, 'UPLOAD_SHARD_LEVELS', 2)
+
+
+def get_shard_width():
+    """Hex characters per directory level; 2 gives 256 directories per level"""
+    return getattr(settings, 'UPLOAD_SHARD_WIDTH', 2)
+
+
+def media_path(relative_path):
+    """Absolute path of a path stored relative to MEDIA_ROOT"""
+    return os.path.join(settings.MEDIA_ROOT, *relative_path.split('/'))
+
+
+def shard_dirs(file_name):
+    """Shard directories for a stored file name, derived from its hash"""
+    digest = hashlib.sha256(file_name.encode()).hexdigest()
+    width = get_shard_width()
+    return [digest[i * width:(i + 1) * width] for i in range(get_shard_levels())]
+
+
+def upload_path_for(file_name):
+    """Path relative to MEDIA_ROOT where a stored file name belongs, e.g. uploads/ab/cd/name"""
+    return posixpath.join('uploads', *shard_dirs(file_name), file_name)
+
+
+def path_aliases(file_path):
+    """
+    Stored paths that may refer to the same file while uploads are being
+    migrated between layouts: the path itself, the flat legacy path and
+    the path in the current layout.
+    """
+    file_name = posixpath.basename(file_path)
+    return {file_path, posixpath.join('uploads', file_name), upload_path_for(file_name)}
+
+
+def resolve_path(file_path):
+    """
+    Absolute path of a stored upload. Every read of an upload goes
+    through here so both layouts stay readable: if the file is not at
+    its recorded path it has been moved by a layout migration, and is
+    looked up in the current layout instead.
+    """
+    full_path = media_path(file_path)
+    if os.path.exists(full_path):
+        return full_path
+
+    migrated_path = media_path(upload_path_for(posixpath.basename(file_path)))
+    if migrated_path != full_path and os.path.exists(migrated_path):
+        return migrated_path
+    return full_path
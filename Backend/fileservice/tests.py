@@ -1,3 +1,1448 @@
-from django.test import TestCase
+import gzip
+import importlib
+import io
+import os
+import shutil
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+import zlib
+from datetime import timedelta
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopUpload
+from django.db import IntegrityError, OperationalError, connection, connections
+from django.test.utils import CaptureQueriesContext
+from django.test import (
+    AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, modify_settings, override_settings,
+)
+from django.urls import clear_url_caches, resolve
+from django.utils import timezone
+from django.utils.http import base36_to_int, int_to_base36
+from . import (
+    admission, chunked_uploads, cleanup, codes, compression, metadata_cache, metrics, packs, tokens, upload_handlers,
+    urls, views, zipstream,
+)
+from .delivery import SendfileASGIHandler
+from .cleanup_daemon import CleanupDaemon
+from .counters import get_counter
+from .db import pool
+from .db.sqlite3.base import DatabaseWrapper as PooledSQLiteWrapper
+from .lease import acquire_lease
+from .middleware import FileCleanupMiddleware
+from .models import BundleFile, CleanupLease, FileShare, PackSegment, ScanCheckpoint, StoredBlob, UploadSession
+from .orphans import CHECKPOINT_NAME, scan_orphans
+from .storage import media_path, upload_path_for
 
-# Create your tests here.
+
+def resolve_accel_redirect(uri):
+    """
+    Stand-in for the internal location in deploy/nginx-offload.conf:
+    map an X-Accel-Redirect URI back to a file under MEDIA_ROOT.
+    """
+    prefix = settings.DOWNLOAD_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/'
+    assert uri.startswith(prefix), uri
+    return os.path.join(settings.MEDIA_ROOT, urllib.parse.unquote(uri[len(prefix):]))
+
+
+# The background cleanup thread would race the test's own queries
+@modify_settings(MIDDLEWARE={'remove': ['fileservice.middleware.FileCleanupMiddleware']})
+class FileServiceTestCase(TestCase):
+    """Base test case with an isolated MEDIA_ROOT"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_override.enable()
+
+    def tearDown(self):
+        self.media_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def upload(self, name='report.txt', content=b'hello world'):
+        response = self.client.post('/api/upload/', {'file': SimpleUploadedFile(name, content)})
+        self.assertEqual(response.status_code, 201)
+        return response.json()['code']
+
+    def download_url(self, code):
+        token = self.client.get(f'/api/file/{code}/').json()['download_token']
+        return f'/api/download/{code}/{token}/'
+
+
+@override_settings(DOWNLOAD_DELIVERY_MODE='x-accel-redirect', DOWNLOAD_ACCEL_REDIRECT_PREFIX='/protected/')
+class OffloadDeliveryTests(FileServiceTestCase):
+
+    def test_accel_redirect_points_at_stored_file(self):
+        code = self.upload('notes v2.txt', b'offloaded bytes')
+        response = self.client.get(self.download_url(code))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+        self.assertIn('notes v2.txt', response['Content-Disposition'])
+        with open(resolve_accel_redirect(response['X-Accel-Redirect']), 'rb') as f:
+            self.assertEqual(f.read(), b'offloaded bytes')
+
+    def test_offloaded_download_is_still_one_time(self):
+        code = self.upload()
+        url = self.download_url(code)
+
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertTrue(FileShare.objects.get(code=code).is_downloaded)
+        self.assertEqual(self.client.get(url).status_code, 410)
+
+    def test_range_requests_are_served_by_django(self):
+        code = self.upload(content=b'0123456789')
+        response = self.client.get(self.download_url(code), HTTP_RANGE='bytes=2-4')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+
+    @override_settings(DOWNLOAD_DELIVERY_MODE='x-sendfile')
+    def test_x_sendfile_uses_absolute_path(self):
+        code = self.upload(content=b'abc')
+        response = self.client.get(self.download_url(code))
+
+        path = response['X-Sendfile']
+        self.assertTrue(os.path.isabs(path))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'abc')
+
+
+class DownloadTests(FileServiceTestCase):
+
+    def test_missing_file_does_not_use_up_the_download(self):
+        code = self.upload(content=b'gone')
+        url = self.download_url(code)
+        stored_path = os.path.join(self.media_root, FileShare.objects.get(code=code).file_path)
+        os.rename(stored_path, stored_path + '.moved')
+
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertFalse(FileShare.objects.get(code=code).is_downloaded)
+
+        os.rename(stored_path + '.moved', stored_path)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'gone')
+        self.assertEqual(self.client.get(url).status_code, 410)
+
+
+class MetadataCacheTests(FileServiceTestCase):
+    """Share metadata is cached for info lookups but never trusted for downloads"""
+
+    def setUp(self):
+        super().setUp()
+        metadata_cache.get_cache().clear()
+
+    def cached(self, code):
+        return metadata_cache.get_cache().get(metadata_cache.cache_key(code))
+
+    def share_selects(self, captured_queries):
+        return [
+            query for query in captured_queries
+            if query['sql'].startswith('SELECT') and '"file_shares"' in query['sql']
+        ]
+
+    def test_info_lookups_hit_the_cache(self):
+        code = self.upload()
+        with CaptureQueriesContext(connection) as first:
+            self.assertEqual(self.client.get(f'/api/file/{code}/').status_code, 200)
+        with CaptureQueriesContext(connection) as second:
+            self.assertEqual(self.client.get(f'/api/file/{code}/').status_code, 200)
+
+        self.assertEqual(len(self.share_selects(first.captured_queries)), 1)
+        self.assertEqual(self.share_selects(second.captured_queries), [])
+        self.assertEqual(self.cached(code)['code'], code)
+
+    def test_download_invalidates_the_entry(self):
+        code = self.upload()
+        url = self.download_url(code)
+        self.assertIsNotNone(self.cached(code))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(url)
+            self.assertEqual(b''.join(response.streaming_content), b'hello world')
+
+        self.assertIsNone(self.cached(code))
+        self.assertEqual(self.client.get(f'/api/file/{code}/').status_code, 410)
+
+    def test_cleanup_invalidates_the_entry(self):
+        code = self.upload()
+        self.assertEqual(self.client.get(f'/api/file/{code}/').status_code, 200)
+        FileShare.objects.filter(code=code).update(expires_at=timezone.now() - timedelta(minutes=1))
+
+        cleanup.run_cleanup()
+
+        self.assertIsNone(self.cached(code))
+        self.assertEqual(self.client.get(f'/api/file/{code}/').status_code, 404)
+
+    def test_stale_entry_never_serves_a_downloaded_file(self):
+        code = self.upload()
+        # Claimed elsewhere; this process's cached entry still says available
+        self.assertEqual(self.client.get(f'/api/file/{code}/').status_code, 200)
+        FileShare.objects.filter(code=code).update(is_downloaded=True)
+        self.assertFalse(self.cached(code)['is_downloaded'])
+
+        url = self.download_url(code)
+
+        self.assertEqual(self.client.get(url).status_code, 410)
+        self.assertEqual(self.client.head(url).status_code, 410)
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=0-4').status_code, 410)
+
+
+@override_settings(STORAGE_COMPRESSION=True)
+class CompressedStorageTests(FileServiceTestCase):
+
+    # Compresses far below READ_SIZE, so inflating it would overshoot
+    # READ_SIZE without a limit on the decompressed block size
+    content = b'id,name\n' + b''.join(b'%d,row\n' % i for i in range(100_000))
+
+    def test_text_is_stored_gzip_compressed(self):
+        code = self.upload('rows.csv', self.content)
+        file_share = FileShare.objects.get(code=code)
+
+        self.assertEqual(file_share.content_encoding, 'gzip')
+        self.assertLess(file_share.stored_size, file_share.file_size)
+        with open(os.path.join(self.media_root, file_share.file_path), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), self.content)
+
+    def test_gzip_client_gets_stored_bytes(self):
+        code = self.upload('rows.csv', self.content)
+        response = self.client.get(self.download_url(code), HTTP_ACCEPT_ENCODING='gzip, br')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.content)
+
+    def test_other_clients_get_decompressed_content(self):
+        code = self.upload('rows.csv', self.content)
+        response = self.client.get(self.download_url(code), HTTP_ACCEPT_ENCODING='gzip;q=0')
+        blocks = list(response.streaming_content)
+
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(b''.join(blocks), self.content)
+        self.assertLessEqual(max(map(len, blocks)), compression.READ_SIZE)
+
+    def test_only_gzip_clients_are_offloaded(self):
+        with override_settings(DOWNLOAD_DELIVERY_MODE='x-accel-redirect', DOWNLOAD_ACCEL_REDIRECT_PREFIX='/protected/'):
+            encoded = self.client.get(
+                self.download_url(self.upload('rows.csv', self.content)), HTTP_ACCEPT_ENCODING='gzip'
+            )
+            decoded = self.client.get(self.download_url(self.upload('rows.csv', self.content)))
+
+        self.assertEqual(encoded['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', encoded['Vary'])
+        with open(resolve_accel_redirect(encoded['X-Accel-Redirect']), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), self.content)
+        self.assertNotIn('X-Accel-Redirect', decoded)
+        self.assertEqual(b''.join(decoded.streaming_content), self.content)
+
+
+class RangeRequestTests(FileServiceTestCase):
+
+    content = b'0123456789'
+
+    def get_range(self, header, **extra):
+        code = self.upload(content=self.content)
+        return self.client.get(self.download_url(code), HTTP_RANGE=header, **extra)
+
+    def test_single_range(self):
+        response = self.get_range('bytes=2-4')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(response['Content-Length'], '3')
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+
+    def test_suffix_range(self):
+        response = self.get_range('bytes=-3')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 7-9/10')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+
+    def test_unsatisfiable_range(self):
+        response = self.get_range('bytes=20-30')
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_stale_if_range_sends_whole_file(self):
+        response = self.get_range('bytes=2-4', HTTP_IF_RANGE='"0-0"')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_matching_if_range_sends_range(self):
+        code = self.upload(content=self.content)
+        url = self.download_url(code)
+        etag = self.client.head(url)['ETag']
+        response = self.client.get(url, HTTP_RANGE='bytes=0-0', HTTP_IF_RANGE=etag)
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'0')
+
+    def test_multiple_ranges(self):
+        response = self.get_range('bytes=0-1,5-6')
+
+        self.assertEqual(response.status_code, 206)
+        content_type, _, boundary = response['Content-Type'].partition('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        body = b''.join(response.streaming_content)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        self.assertIn(b'Content-Range: bytes 0-1/10\r\n\r\n01\r\n', body)
+        self.assertIn(b'Content-Range: bytes 5-6/10\r\n\r\n56\r\n', body)
+        self.assertTrue(body.endswith(f'--{boundary}--\r\n'.encode()))
+
+    def test_file_is_consumed_once_all_ranges_are_served(self):
+        code = self.upload(content=self.content)
+        url = self.download_url(code)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=0-4')
+        self.assertEqual(b''.join(response.streaming_content), b'01234')
+        response.close()
+        self.assertFalse(FileShare.objects.get(code=code).is_downloaded)
+        self.assertEqual(self.client.head(url).status_code, 200)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=5-9')
+        self.assertEqual(b''.join(response.streaming_content), b'56789')
+        response.close()
+
+        self.assertTrue(FileShare.objects.get(code=code).is_downloaded)
+        self.assertEqual(self.client.head(url).status_code, 410)
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=0-0').status_code, 410)
+
+
+@override_settings(STORAGE_PACKING=True, PACK_MAX_FILE_SIZE=1024)
+class PackedStorageTests(FileServiceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(self.retire_active_segment)
+
+    def retire_active_segment(self):
+        # The segment this process appends to outlives the test's MEDIA_ROOT
+        if packs._active is not None:
+            packs._active.close()
+            packs._active = None
+
+    def body(self, response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def age_segments(self):
+        PackSegment.objects.update(updated_at=timezone.now() - timedelta(seconds=packs.get_segment_max_age() + 1))
+
+    def test_small_uploads_share_a_segment(self):
+        first = FileShare.objects.get(code=self.upload(content=b'first'))
+        second = FileShare.objects.get(code=self.upload(content=b'second'))
+        large = FileShare.objects.get(code=self.upload(content=b'x' * 2048))
+
+        self.assertEqual(first.pack_segment_id, second.pack_segment_id)
+        self.assertEqual((first.pack_offset, second.pack_offset), (0, 5))
+        self.assertIsNone(large.pack_segment_id)
+        response = self.client.get(self.download_url(second.code))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), b'second')
+
+    def test_range_of_packed_entry_sends_it_whole(self):
+        self.upload(content=b'padding')
+        code = self.upload(content=b'0123456789')
+        url = self.download_url(code)
+
+        self.assertEqual(self.client.head(url)['Accept-Ranges'], 'none')
+        response = self.client.get(url, HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(self.body(response), b'0123456789')
+
+    def test_compaction_keeps_open_downloads_readable(self):
+        share_codes = [self.upload(content=f'entry {i}'.encode()) for i in range(4)]
+        FileShare.objects.filter(code__in=share_codes[:3]).delete()
+        # A download that looked up the entry before the rewrite
+        before = FileShare.objects.get(code=share_codes[3])
+        self.age_segments()
+
+        result = packs.compact_packs()
+
+        after = FileShare.objects.get(code=share_codes[3])
+        self.assertEqual((result.sealed, result.rewritten, result.entries_moved), (1, 1, 1))
+        self.assertNotEqual(after.pack_segment_id, before.pack_segment_id)
+        self.assertEqual(packs.read_entry(before), b'entry 3')
+        self.assertEqual(packs.read_entry(after), b'entry 3')
+
+        # The old segment outlives the grace period only
+        old_path = os.path.join(self.media_root, before.file_path)
+        self.assertEqual(packs.compact_packs().segments_deleted, 0)
+        self.assertTrue(os.path.exists(old_path))
+        PackSegment.objects.filter(pk=before.pack_segment_id).update(updated_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(packs.compact_packs().segments_deleted, 1)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual(self.body(self.client.get(self.download_url(after.code))), b'entry 3')
+
+
+class BundleTests(FileServiceTestCase):
+
+    binary = os.urandom(3000)
+    text = b'line of text\n' * 500
+
+    def upload_bundle(self, files, **fields):
+        data = {'files': [SimpleUploadedFile(name, content, content_type=content_type)
+                          for name, content, content_type in files], **fields}
+        response = self.client.post('/api/upload/bundle/', data)
+        self.assertEqual(response.status_code, 201)
+        return response.json()['code']
+
+    def download(self, code):
+        url = self.download_url(code)
+        head = self.client.head(url)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        body = b''.join(response.streaming_content)
+        return head, response, body
+
+    def assert_archive(self, body, expected):
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), list(expected))
+            for name, (content, compress_type) in expected.items():
+                info = archive.getinfo(name)
+                self.assertEqual(info.CRC, zlib.crc32(content))
+                self.assertEqual(info.compress_type, compress_type)
+                self.assertEqual(archive.read(name), content)
+
+    def test_stored_entries_have_a_known_length(self):
+        code = self.upload_bundle(
+            [('a.bin', self.binary, 'application/octet-stream'), ('b.bin', b'', 'application/octet-stream')],
+            name='photos',
+        )
+        head, response, body = self.download(code)
+
+        self.assertIn('photos.zip', response['Content-Disposition'])
+        self.assertEqual(head['Content-Length'], str(len(body)))
+        self.assertEqual(response['Content-Length'], str(len(body)))
+        self.assert_archive(body, {
+            'a.bin': (self.binary, zipfile.ZIP_STORED),
+            'b.bin': (b'', zipfile.ZIP_STORED),
+        })
+
+    def test_compressible_entries_are_deflated_while_sent(self):
+        code = self.upload_bundle([('notes.txt', self.text, 'text/plain'), ('a.bin', self.binary, 'application/octet-stream')])
+        head, response, body = self.download(code)
+
+        self.assertNotIn('Content-Length', head)
+        self.assert_archive(body, {
+            'notes.txt': (self.text, zipfile.ZIP_DEFLATED),
+            'a.bin': (self.binary, zipfile.ZIP_STORED),
+        })
+
+    @override_settings(STORAGE_COMPRESSION=True)
+    def test_gzip_stored_entries_are_copied_as_deflate(self):
+        code = self.upload_bundle([('notes.txt', self.text, 'text/plain')])
+        self.assertEqual(BundleFile.objects.get(bundle__code=code).content_encoding, 'gzip')
+        head, response, body = self.download(code)
+
+        self.assertEqual(head['Content-Length'], str(len(body)))
+        self.assert_archive(body, {'notes.txt': (self.text, zipfile.ZIP_DEFLATED)})
+
+    def test_entry_paths_are_sanitised_and_unique(self):
+        code = self.upload_bundle(
+            [(name, name.encode(), 'application/octet-stream') for name in ('a.bin', 'b.bin', 'c.bin')],
+            paths=['../docs/a.bin', 'docs/a.bin', '/etc/./c.bin'],
+        )
+        _, _, body = self.download(code)
+
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertEqual(archive.namelist(), ['docs/a.bin', 'docs/a (2).bin', 'etc/c.bin'])
+
+    def test_bundle_downloads_once(self):
+        code = self.upload_bundle([('a.bin', self.binary, 'application/octet-stream')])
+        url = self.download_url(code)
+
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.get(url).status_code, 410)
+
+    def test_cleanup_removes_entry_files(self):
+        code = self.upload_bundle([('a.bin', self.binary, 'application/octet-stream'), ('notes.txt', self.text, 'text/plain')])
+        stored_paths = [
+            os.path.join(self.media_root, file_path)
+            for file_path in BundleFile.objects.filter(bundle__code=code).values_list('file_path', flat=True)
+        ]
+        FileShare.objects.filter(code=code).update(expires_at=timezone.now() - timedelta(minutes=1))
+
+        result = cleanup.run_cleanup()
+
+        self.assertEqual(result.errors, [])
+        self.assertEqual((result.records_deleted, result.files_deleted), (1, 2))
+        self.assertFalse(any(os.path.exists(path) for path in stored_paths))
+        self.assertFalse(BundleFile.objects.exists())
+
+
+class ZipStreamTests(SimpleTestCase):
+
+    modified = timezone.now()
+
+    def entry(self, name, content=b''):
+        return zipstream.ZipEntry(name, len(content), zlib.crc32(content), self.modified, lambda: iter([content]))
+
+    def test_entry_count_over_the_classic_limit_uses_zip64_end_records(self):
+        stream = zipstream.ZipStream([self.entry(f'{i}.txt') for i in range(zipstream.ZIP32_COUNT_LIMIT + 1)])
+        body = b''.join(stream)
+
+        self.assertEqual(len(body), stream.size)
+        self.assertIn(struct.pack('<I', zipstream._END64_SIGNATURE), body)
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertEqual(len(archive.infolist()), zipstream.ZIP32_COUNT_LIMIT + 1)
+
+    def test_large_entry_header_carries_zip64_sizes(self):
+        size = zipstream.ZIP32_LIMIT + 1
+        entry = zipstream.ZipEntry('big.bin', size, 0, self.modified, lambda: iter(()))
+        header = entry.local_header()
+
+        fields = zipstream._LOCAL_HEADER.unpack_from(header)
+        self.assertEqual((fields[7], fields[8]), (zipstream.ZIP32_LIMIT, zipstream.ZIP32_LIMIT))
+        extra = header[zipstream._LOCAL_HEADER.size + len('big.bin'):]
+        self.assertEqual(extra, struct.pack('<HHQQ', zipstream.ZIP64_EXTRA_ID, 16, size, size))
+
+
+@override_settings(FILE_UPLOAD_MAX_SIZE=1024, ASGI_BODY_SPOOL_SIZE=1024)
+class AsgiRequestBodyTests(FileServiceTestCase):
+    """The ASGI handler enforces upload limits while it receives the body"""
+
+    def post(self, messages, headers=()):
+        received = []
+        sent = []
+
+        async def receive():
+            message = messages[len(received)]
+            received.append(message)
+            return message
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'POST',
+            'scheme': 'http',
+            'path': '/api/upload/',
+            'raw_path': b'/api/upload/',
+            'query_string': b'',
+            'root_path': '',
+            'headers': [(b'host', b'testserver'), *headers],
+            'client': ('127.0.0.1', 0),
+            'server': ('testserver', 80),
+        }
+        async_to_sync(SendfileASGIHandler())(scope, receive, send)
+        return sent[0]['status'], len(received)
+
+    def body_messages(self, count, size=1024):
+        return [{'type': 'http.request', 'body': b'x' * size, 'more_body': True} for _ in range(count)] + [
+            {'type': 'http.request', 'body': b'', 'more_body': False}
+        ]
+
+    def test_declared_oversize_body_is_not_read(self):
+        messages = self.body_messages(100)
+        status_code, received = self.post(messages, [(b'content-length', str(100 * 1024).encode())])
+
+        self.assertEqual(status_code, 413)
+        self.assertEqual(received, 0)
+
+    def test_undeclared_oversize_body_stops_at_the_limit(self):
+        messages = self.body_messages(1000)
+        status_code, received = self.post(messages)
+
+        self.assertEqual(status_code, 413)
+        # 1 KB file limit plus 64 KB for multipart framing
+        self.assertLess(received, 70)
+
+
+class StreamingUploadHandlerTests(FileServiceTestCase):
+    """StreamingFileUploadHandler stops oversize uploads and leaves no partial files"""
+
+    max_size = 1024
+
+    def upload_request(self, content):
+        return RequestFactory().post('/api/upload/', {'file': SimpleUploadedFile('big.bin', content)})
+
+    def partial_files(self):
+        uploads_dir = upload_handlers.get_uploads_dir()
+        return [name for name in os.listdir(uploads_dir) if upload_handlers.is_partial_file(name)]
+
+    def test_declared_oversize_is_rejected_before_reading(self):
+        request = self.upload_request(b'x' * (self.max_size + upload_handlers.MULTIPART_OVERHEAD))
+        with mock.patch.object(request, 'read', wraps=request.read) as read:
+            with self.assertRaisesMessage(upload_handlers.UploadRejected, 'File size exceeds 1KB limit'):
+                upload_handlers.receive_upload(request, max_size=self.max_size)
+
+        read.assert_not_called()
+        self.assertEqual(self.partial_files(), [])
+
+    def test_undeclared_oversize_stops_at_the_limit(self):
+        handler = upload_handlers.StreamingFileUploadHandler(max_size=self.max_size)
+        handler.new_file('file', 'big.bin', 'application/octet-stream', None)
+        partial_path = handler.file.temporary_file_path()
+        handler.receive_data_chunk(b'x' * 1000, 0)
+        self.assertTrue(os.path.exists(partial_path))
+
+        with self.assertRaises(StopUpload):
+            handler.receive_data_chunk(b'x' * 1000, 1000)
+
+        self.assertTrue(handler.exceeded)
+        self.assertFalse(os.path.exists(partial_path))
+
+    def test_oversize_upload_within_the_multipart_allowance_is_removed(self):
+        # Declared small enough to be parsed; stopped once the file crosses the limit
+        request = self.upload_request(b'x' * (self.max_size * 4))
+        with self.assertRaisesMessage(upload_handlers.UploadRejected, 'File size exceeds 1KB limit'):
+            upload_handlers.receive_upload(request, max_size=self.max_size)
+
+        self.assertEqual(self.partial_files(), [])
+
+    def test_interrupted_upload_removes_its_partial_files(self):
+        handler = upload_handlers.StreamingFileUploadHandler(max_size=self.max_size)
+        handler.new_file('file', 'first.bin', 'application/octet-stream', None)
+        handler.receive_data_chunk(b'first', 0)
+        handler.file_complete(5)
+        handler.new_file('file', 'second.bin', 'application/octet-stream', None)
+        handler.receive_data_chunk(b'sec', 0)
+        self.assertEqual(len(self.partial_files()), 2)
+
+        handler.upload_interrupted()
+
+        self.assertEqual(self.partial_files(), [])
+
+    def test_size_limit_message_units(self):
+        self.assertEqual(upload_handlers.size_limit_message(50 * 1024 * 1024), 'File size exceeds 50MB limit')
+        self.assertEqual(upload_handlers.size_limit_message(1536), 'File size exceeds 1KB limit')
+        self.assertEqual(upload_handlers.size_limit_message(512), 'File size exceeds 512 byte limit')
+
+
+@override_settings(DOWNLOAD_MAX_IN_FLIGHT=1)
+class AdmissionControlTests(FileServiceTestCase):
+
+    def downloads_in_flight(self):
+        return admission.in_flight()[admission.DOWNLOAD][0]
+
+    def test_slot_is_held_until_the_response_is_closed(self):
+        first, second = self.upload(content=b'first'), self.upload(content=b'second')
+        response = self.client.get(self.download_url(first))
+
+        self.assertEqual(self.downloads_in_flight(), 1)
+        self.assertEqual(self.client.get(self.download_url(second)).status_code, 503)
+
+        # The test client closes a streaming response once it is consumed
+        self.assertEqual(b''.join(response.streaming_content), b'first')
+        self.assertEqual(self.downloads_in_flight(), 0)
+        self.assertTrue(response.closed)
+        self.assertEqual(self.client.get(self.download_url(second)).status_code, 200)
+
+
+class AsyncViewTests(FileServiceTestCase):
+    """The native async views fileservice.urls routes to when ASYNC_VIEWS is set"""
+
+    content = b'0123456789'
+
+    def setUp(self):
+        super().setUp()
+        self.use_async_views(True)
+        self.addCleanup(self.use_async_views, False)
+
+    def use_async_views(self, enabled):
+        with override_settings(ASYNC_VIEWS=enabled):
+            importlib.reload(urls)
+        # The root URLconf holds a resolver that cached the old patterns
+        importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+        clear_url_caches()
+
+    async def async_upload(self):
+        response = await self.async_client.post('/api/upload/', {'file': SimpleUploadedFile('digits.txt', self.content)})
+        self.assertEqual(response.status_code, 201)
+        return response.json()['code']
+
+    async def async_download_url(self, code):
+        response = await self.async_client.get(f'/api/file/{code}/')
+        self.assertEqual(response.status_code, 200)
+        return f"/api/download/{code}/{response.json()['download_token']}/"
+
+    async def body(self, response):
+        return b''.join([chunk async for chunk in response])
+
+    def test_async_views_are_routed(self):
+        self.assertIs(resolve('/api/upload/').func, views.upload_file_async)
+        self.assertIs(resolve('/api/download/AbCd1234/token/').func, views.download_file_async)
+
+    async def test_upload_info_and_download(self):
+        code = await self.async_upload()
+        info = await self.async_client.get(f'/api/file/{code}/')
+
+        self.assertEqual(info.json()['size'], len(self.content))
+        response = await self.async_client.get(await self.async_download_url(code))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await self.body(response), self.content)
+
+    async def test_download_is_one_time(self):
+        url = await self.async_download_url(await self.async_upload())
+
+        self.assertEqual((await self.async_client.get(url)).status_code, 200)
+        self.assertEqual((await self.async_client.get(url)).status_code, 410)
+
+    async def test_range_download(self):
+        url = await self.async_download_url(await self.async_upload())
+        # AsyncClient in Django 4.2 ignores HTTP_RANGE passed as extra
+        response = await self.async_client.get(url, headers={'Range': 'bytes=2-4'})
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(await self.body(response), b'234')
+
+
+@override_settings(CHUNKED_UPLOAD_CHUNK_SIZE=4)
+class ChunkedUploadTests(FileServiceTestCase):
+
+    content = b'0123456789'
+
+    def create_session(self):
+        response = self.client.post('/api/upload/sessions/', {'filename': 'digits.txt', 'size': len(self.content)})
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def put_chunk(self, session_id, index):
+        chunk = self.content[index * 4:(index + 1) * 4]
+        return self.client.put(
+            f'/api/upload/sessions/{session_id}/chunks/{index}/', chunk, content_type='application/octet-stream'
+        )
+
+    def complete(self, session_id):
+        return self.client.post(f'/api/upload/sessions/{session_id}/complete/')
+
+    def test_create_session_reports_chunks(self):
+        session = self.create_session()
+
+        self.assertEqual(session['chunk_size'], 4)
+        self.assertEqual(session['total_chunks'], 3)
+        self.assertEqual(session['missing_chunks'], [0, 1, 2])
+
+    def test_out_of_order_and_duplicate_chunks(self):
+        session_id = self.create_session()['session_id']
+        for index in (2, 0, 2):
+            self.assertEqual(self.put_chunk(session_id, index).status_code, 200)
+
+        status_response = self.client.get(f'/api/upload/sessions/{session_id}/').json()
+        self.assertEqual(status_response['missing_chunks'], [1])
+        self.assertEqual(self.complete(session_id).status_code, 409)
+
+        self.assertEqual(self.put_chunk(session_id, 1).status_code, 200)
+        response = self.complete(session_id)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(UploadSession.objects.filter(id=session_id).exists())
+        download = self.client.get(self.download_url(response.json()['code']))
+        self.assertEqual(b''.join(download.streaming_content), self.content)
+        self.assertEqual(self.complete(session_id).status_code, 404)
+
+    def test_chunk_of_wrong_length_is_rejected(self):
+        session_id = self.create_session()['session_id']
+        response = self.client.put(
+            f'/api/upload/sessions/{session_id}/chunks/0/', b'01', content_type='application/octet-stream'
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_failed_store_keeps_session(self):
+        session_id = self.create_session()['session_id']
+        for index in range(3):
+            self.put_chunk(session_id, index)
+        session = UploadSession.objects.get(id=session_id)
+
+        with mock.patch.object(chunked_uploads, 'store_upload', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                chunked_uploads.complete_session(session)
+
+        self.assertTrue(UploadSession.objects.filter(id=session_id).exists())
+        self.assertFalse(FileShare.objects.exists())
+        self.assertEqual(self.complete(session_id).status_code, 201)
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media_root)
+            for root, _, names in os.walk(self.media_root) for name in names
+        )
+
+    def fail_to_share(self, session_id):
+        for index in range(3):
+            self.put_chunk(session_id, index)
+        session = UploadSession.objects.get(id=session_id)
+        with mock.patch.object(FileShare.objects, 'create', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                chunked_uploads.complete_session(session)
+        return session
+
+    def test_failed_share_puts_the_file_back(self):
+        session = self.fail_to_share(self.create_session()['session_id'])
+
+        self.assertEqual(self.stored_files(), [session.partial_path])
+        with open(os.path.join(self.media_root, session.partial_path), 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        response = self.complete(session.id)
+        self.assertEqual(response.status_code, 201)
+        download = self.client.get(self.download_url(response.json()['code']))
+        self.assertEqual(b''.join(download.streaming_content), self.content)
+
+    @override_settings(UPLOAD_DEDUPLICATE=True)
+    def test_failed_share_of_duplicate_keeps_the_blob(self):
+        blob = FileShare.objects.get(code=self.upload('digits.txt', self.content)).blob
+        session = self.fail_to_share(self.create_session()['session_id'])
+
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertEqual(self.stored_files(), sorted([blob.file_path, session.partial_path]))
+        self.assertEqual(self.complete(session.id).status_code, 201)
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 2)
+
+    @override_settings(UPLOAD_DEDUPLICATE=True)
+    def test_failed_share_of_new_content_drops_the_blob(self):
+        session = self.fail_to_share(self.create_session()['session_id'])
+
+        self.assertEqual(self.stored_files(), [session.partial_path])
+        self.assertEqual(self.complete(session.id).status_code, 201)
+
+
+class CleanupTests(FileServiceTestCase):
+
+    def expire(self, *share_codes):
+        FileShare.objects.filter(code__in=share_codes).update(expires_at=timezone.now() - timedelta(minutes=1))
+
+    def test_expired_files_are_removed_without_errors(self):
+        expired, kept = self.upload(content=b'old'), self.upload(content=b'new')
+        stored_path = os.path.join(self.media_root, FileShare.objects.get(code=expired).file_path)
+        self.expire(expired)
+
+        result = cleanup.run_cleanup()
+
+        self.assertEqual(result.errors, [])
+        self.assertEqual((result.records_deleted, result.files_deleted, result.files_missing), (1, 1, 0))
+        self.assertFalse(os.path.exists(stored_path))
+        self.assertEqual(list(FileShare.objects.values_list('code', flat=True)), [kept])
+
+    def test_rows_are_deleted_in_batches_of_one_delete_each(self):
+        share_codes = [self.upload(content=b'old') for _ in range(5)]
+        self.expire(*share_codes)
+
+        with CaptureQueriesContext(connection) as queries:
+            result = cleanup.run_cleanup(batch_size=2)
+
+        self.assertEqual((result.batches, result.records_deleted, result.files_deleted), (3, 5, 5))
+        deletes = [query['sql'] for query in queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+        self.assertFalse(FileShare.objects.exists())
+
+    def test_time_budget_leaves_the_rest_for_the_next_run(self):
+        share_codes = [self.upload(content=b'old') for _ in range(5)]
+        self.expire(*share_codes)
+
+        result = cleanup.run_cleanup(batch_size=2, time_budget=0.05, on_file=lambda *args: time.sleep(0.03))
+
+        self.assertTrue(result.budget_exhausted)
+        self.assertEqual((result.batches, result.records_deleted), (1, 2))
+        self.assertEqual(FileShare.objects.count(), 3)
+        self.assertEqual(cleanup.run_cleanup().records_deleted, 3)
+
+    def test_missing_file_is_not_an_error(self):
+        code = self.upload()
+        os.remove(os.path.join(self.media_root, FileShare.objects.get(code=code).file_path))
+        self.expire(code)
+
+        result = cleanup.run_cleanup()
+
+        self.assertEqual(result.errors, [])
+        self.assertEqual((result.records_deleted, result.files_missing), (1, 1))
+
+
+@override_settings(UPLOAD_DEDUPLICATE=True)
+class DeduplicationTests(FileServiceTestCase):
+
+    def blob_path(self, blob):
+        return os.path.join(self.media_root, blob.file_path)
+
+    def expire(self, *share_codes):
+        FileShare.objects.filter(code__in=share_codes).update(expires_at=timezone.now() - timedelta(minutes=1))
+
+    def test_identical_uploads_share_one_blob(self):
+        first, second = self.upload(content=b'same bytes'), self.upload(content=b'same bytes')
+        other = self.upload(content=b'other bytes')
+
+        shares = {share.code: share for share in FileShare.objects.select_related('blob')}
+        self.assertEqual(shares[first].blob_id, shares[second].blob_id)
+        self.assertNotEqual(shares[first].blob_id, shares[other].blob_id)
+        self.assertEqual(shares[first].blob.ref_count, 2)
+        self.assertEqual(StoredBlob.objects.count(), 2)
+        for code in (first, second):
+            response = self.client.get(self.download_url(code))
+            self.assertEqual(b''.join(response.streaming_content), b'same bytes')
+
+    def test_blob_file_goes_with_its_last_reference(self):
+        first, second = self.upload(content=b'same bytes'), self.upload(content=b'same bytes')
+        blob = FileShare.objects.get(code=first).blob
+
+        self.expire(first)
+        result = cleanup.run_cleanup()
+        blob.refresh_from_db()
+        self.assertEqual((blob.ref_count, result.files_deleted), (1, 0))
+        self.assertTrue(os.path.exists(self.blob_path(blob)))
+
+        self.expire(second)
+        result = cleanup.run_cleanup()
+        self.assertEqual((result.references_released, result.files_deleted), (1, 1))
+        self.assertFalse(StoredBlob.objects.exists())
+        self.assertFalse(os.path.exists(self.blob_path(blob)))
+
+    def test_released_blob_is_replaced_with_its_file(self):
+        # Released, but delete_unreferenced_blobs has not run for it yet
+        blob = FileShare.objects.get(code=self.upload(content=b'same bytes')).blob
+        FileShare.objects.all().delete()
+        StoredBlob.objects.filter(pk=blob.pk).update(ref_count=0)
+
+        new_blob = FileShare.objects.get(code=self.upload(content=b'same bytes')).blob
+
+        self.assertNotEqual(new_blob.pk, blob.pk)
+        self.assertEqual(new_blob.ref_count, 1)
+        self.assertFalse(StoredBlob.objects.filter(pk=blob.pk).exists())
+        self.assertFalse(os.path.exists(self.blob_path(blob)))
+        self.assertTrue(os.path.exists(self.blob_path(new_blob)))
+
+
+class CleanupDaemonTests(FileServiceTestCase):
+
+    def share(self, expires_in):
+        code = self.upload(content=b'expiring')
+        FileShare.objects.filter(code=code).update(expires_at=timezone.now() + timedelta(seconds=expires_in))
+        return FileShare.objects.get(code=code)
+
+    def test_only_due_rows_within_the_horizon_are_deleted(self):
+        due, upcoming, later = self.share(-5), self.share(60), self.share(3600)
+        daemon = CleanupDaemon(horizon=300)
+
+        daemon.refresh()
+        self.assertEqual(sorted(daemon._expiries), sorted([due.id, upcoming.id]))
+        daemon.delete_due()
+
+        self.assertEqual(sorted(FileShare.objects.values_list('id', flat=True)), sorted([upcoming.id, later.id]))
+        self.assertEqual(daemon.stats['records_deleted'], 1)
+        self.assertEqual(daemon.stats['tracked'], 1)
+
+    def test_moved_expiry_replaces_the_heap_entry(self):
+        file_share = self.share(60)
+        daemon = CleanupDaemon(horizon=300)
+        daemon.refresh()
+
+        FileShare.objects.filter(pk=file_share.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+        daemon.refresh()
+        daemon.delete_due()
+
+        self.assertFalse(FileShare.objects.exists())
+        # The entry for the old expiry stays in the heap, and is skipped when it comes up
+        self.assertEqual(daemon._expiries, {})
+
+    def test_failing_rows_do_not_hide_the_rest_of_the_window(self):
+        stuck = [self.share(-20), self.share(-10)]
+        behind = self.share(-1)
+        stuck_paths = {os.path.join(self.media_root, share.file_path) for share in stuck}
+        remove_file = cleanup._remove_file
+
+        def fail_stuck(full_path, dry_run):
+            if full_path in stuck_paths:
+                return cleanup.FILE_ERROR, 'device busy'
+            return remove_file(full_path, dry_run)
+
+        daemon = CleanupDaemon(horizon=300, batch_size=2)
+        with mock.patch.object(cleanup, '_remove_file', side_effect=fail_stuck):
+            for _ in range(2):
+                daemon.refresh()
+                daemon.delete_due()
+
+        self.assertEqual(
+            sorted(FileShare.objects.values_list('id', flat=True)), sorted(share.id for share in stuck)
+        )
+        self.assertFalse(FileShare.objects.filter(pk=behind.pk).exists())
+
+    def test_command_passes_batch_size_and_rejects_time_budget(self):
+        with self.assertRaises(CommandError):
+            call_command('cleanup_files', daemon=True, time_budget=5)
+
+        with mock.patch('fileservice.management.commands.cleanup_files.CleanupDaemon') as daemon_class:
+            daemon_class.return_value.stats = {'records_deleted': 0, 'files_deleted': 0, 'max_lag_seconds': 0}
+            call_command('cleanup_files', daemon=True, batch_size=7, stdout=io.StringIO())
+
+        self.assertEqual(daemon_class.call_args.kwargs['batch_size'], 7)
+
+
+class OrphanScanTests(FileServiceTestCase):
+    """Bounded orphan scans resume from their checkpoint and wrap around"""
+
+    paths = ('a/1.bin', 'a/2.bin', 'b/1.bin', 'b/2.bin', 'c.bin')
+
+    def setUp(self):
+        super().setUp()
+        for path in self.paths:
+            full_path = os.path.join(self.media_root, 'uploads', path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'wb') as f:
+                f.write(b'orphan')
+        self.orphans = []
+
+    def scan(self):
+        result = scan_orphans(max_files=2, on_orphan=lambda path, error: self.orphans.append(path))
+        return result, ScanCheckpoint.objects.get(name=CHECKPOINT_NAME)
+
+    def test_bounded_scans_resume_and_wrap_around(self):
+        # Only old files are orphans; the rest are scanned and kept
+        old = time.time() - 2 * 3600
+        os.utime(os.path.join(self.media_root, 'uploads', 'b', '1.bin'), (old, old))
+
+        result, checkpoint = self.scan()
+        self.assertEqual((result.scanned, result.pass_completed, checkpoint.cursor), (2, False, 'a/2.bin'))
+        self.assertEqual(self.orphans, [])
+
+        result, checkpoint = self.scan()
+        self.assertEqual((result.scanned, result.pass_completed, checkpoint.cursor), (2, False, 'b/2.bin'))
+        self.assertEqual(self.orphans, ['uploads/b/1.bin'])
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'uploads', 'b', '1.bin')))
+
+        result, checkpoint = self.scan()
+        self.assertEqual((result.scanned, result.pass_completed, checkpoint.cursor), (1, True, ''))
+        self.assertEqual(checkpoint.passes_completed, 1)
+
+        result, checkpoint = self.scan()
+        self.assertEqual((result.scanned, checkpoint.cursor), (2, 'a/2.bin'))
+
+    def test_scan_resumes_after_a_removed_cursor_path(self):
+        ScanCheckpoint.objects.create(name=CHECKPOINT_NAME, cursor='a/3.bin')
+
+        result, checkpoint = self.scan()
+
+        self.assertEqual(checkpoint.cursor, 'b/2.bin')
+
+
+class ConnectionPoolTests(SimpleTestCase):
+
+    def connect(self):
+        return sqlite3.connect(':memory:', check_same_thread=False)
+
+    def test_released_connection_is_reused(self):
+        connection_pool = pool.ConnectionPool(max_size=2)
+        first = connection_pool.acquire(self.connect)
+        connection_pool.release(first)
+
+        self.assertIs(connection_pool.acquire(self.connect), first)
+        stats = connection_pool.stats()
+        self.assertEqual((stats['created'], stats['reused'], stats['in_use'], stats['idle']), (1, 1, 1, 0))
+
+    def test_full_pool_waits_for_a_release(self):
+        connection_pool = pool.ConnectionPool(max_size=1, timeout=5)
+        first = connection_pool.acquire(self.connect)
+        releaser = threading.Timer(0.05, connection_pool.release, args=(first,))
+        releaser.start()
+
+        self.assertIs(connection_pool.acquire(self.connect), first)
+        releaser.join()
+        self.assertEqual(connection_pool.stats()['waits'], 1)
+
+    def test_full_pool_times_out(self):
+        connection_pool = pool.ConnectionPool(max_size=1, timeout=0.01)
+        connection_pool.acquire(self.connect)
+
+        with self.assertRaises(pool.PoolTimeout):
+            connection_pool.acquire(self.connect)
+        stats = connection_pool.stats()
+        self.assertEqual((stats['waits'], stats['timeouts'], stats['in_use']), (1, 1, 1))
+
+    def test_unusable_connection_is_closed_on_release(self):
+        connection_pool = pool.ConnectionPool(max_size=1)
+        first = connection_pool.acquire(self.connect)
+        connection_pool.release(first, reusable=False)
+
+        with self.assertRaises(sqlite3.ProgrammingError):
+            first.execute('SELECT 1')
+        self.assertIsNot(connection_pool.acquire(self.connect), first)
+        self.assertEqual(connection_pool.stats()['created'], 2)
+
+    def test_idle_connection_failing_its_ping_is_replaced(self):
+        connection_pool = pool.ConnectionPool(max_size=1, ping_after=0)
+        first = connection_pool.acquire(self.connect)
+        connection_pool.release(first)
+
+        def ping(raw_connection):
+            raise sqlite3.OperationalError('server has gone away')
+
+        self.assertIsNot(connection_pool.acquire(self.connect, ping=ping), first)
+        self.assertEqual(connection_pool.stats()['health_check_failures'], 1)
+
+    def test_backend_returns_connections_to_the_pool(self):
+        database_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, database_dir, ignore_errors=True)
+        alias = 'pooled-test'
+        self.addCleanup(pool._pools.pop, alias, None)
+        settings_dict = {
+            **connections['default'].settings_dict,
+            'NAME': os.path.join(database_dir, 'pooled.sqlite3'),
+            'POOL': {'MAX_SIZE': 1, 'TIMEOUT': 0.01},
+        }
+        wrapper = PooledSQLiteWrapper(settings_dict, alias=alias)
+
+        wrapper.ensure_connection()
+        raw_connection = wrapper.connection
+        wrapper.close()
+        wrapper.ensure_connection()
+
+        self.assertIs(wrapper.connection, raw_connection)
+        wrapper.close()
+        stats = pool.pool_stats()[alias]
+        self.assertEqual((stats['created'], stats['reused'], stats['idle']), (1, 1, 1))
+        pool.get_pool(alias, settings_dict['POOL']).close_idle()
+
+
+class UploadLayoutMigrationTests(FileServiceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with override_settings(UPLOAD_SHARD_LEVELS=0):
+            self.codes = [self.upload('a.txt', b'first'), self.upload('b.txt', b'second')]
+
+    def stored_paths(self):
+        return dict(FileShare.objects.filter(code__in=self.codes).values_list('code', 'file_path'))
+
+    def migrate_layout(self, **options):
+        out = io.StringIO()
+        call_command('migrate_upload_layout', stdout=out, **options)
+        return out.getvalue()
+
+    def assert_downloads(self):
+        for code, content in zip(self.codes, (b'first', b'second')):
+            FileShare.objects.filter(code=code).update(is_downloaded=False, download_count=0)
+            response = self.client.get(self.download_url(code))
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_dry_run_moves_nothing(self):
+        flat_paths = self.stored_paths()
+
+        self.assertIn('Would move 2 files', self.migrate_layout(dry_run=True))
+        self.assertEqual(self.stored_paths(), flat_paths)
+        self.assertTrue(all(os.path.exists(media_path(path)) for path in flat_paths.values()))
+
+    def test_flat_uploads_are_moved_into_shards(self):
+        flat_paths = self.stored_paths()
+        self.assertTrue(all(path.count('/') == 1 for path in flat_paths.values()))
+
+        self.assertIn('Moved 2 files', self.migrate_layout(batch_size=1))
+
+        for code, flat_path in flat_paths.items():
+            sharded_path = upload_path_for(os.path.basename(flat_path))
+            self.assertEqual(self.stored_paths()[code], sharded_path)
+            self.assertFalse(os.path.exists(media_path(flat_path)))
+            self.assertTrue(os.path.exists(media_path(sharded_path)))
+        self.assert_downloads()
+        sharded_paths = self.stored_paths()
+        self.assertIn('Moved 0 files', self.migrate_layout())
+        self.assertEqual(self.stored_paths(), sharded_paths)
+
+    def test_interrupted_move_still_resolves_and_is_finished(self):
+        flat_path = self.stored_paths()[self.codes[0]]
+        sharded_path = upload_path_for(os.path.basename(flat_path))
+        # The file was renamed but the run stopped before updating the row
+        os.makedirs(os.path.dirname(media_path(sharded_path)))
+        os.rename(media_path(flat_path), media_path(sharded_path))
+
+        self.assert_downloads()
+        self.migrate_layout()
+        self.assertEqual(self.stored_paths()[self.codes[0]], sharded_path)
+        self.assert_downloads()
+
+
+class ShareCodeTests(TestCase):
+    """Codes are unique by the INSERT itself; collisions are retried with a new code"""
+
+    def create_share(self):
+        return FileShare.objects.create(
+            original_filename='report.txt',
+            file_size=11,
+            content_type='text/plain',
+            file_path='uploads/report.txt',
+        )
+
+    def test_collision_is_retried_with_a_new_code(self):
+        with mock.patch('fileservice.models.next_code', side_effect=['AAAAAAAA', 'AAAAAAAA', 'BBBBBBBB']):
+            self.create_share()
+            file_share = self.create_share()
+
+        self.assertEqual(file_share.code, 'BBBBBBBB')
+        self.assertEqual(FileShare.objects.count(), 2)
+        self.assertEqual(get_counter(codes.COLLISIONS_COUNTER), 1)
+
+    def test_exhausted_retries_raise(self):
+        with mock.patch('fileservice.models.next_code', return_value='AAAAAAAA') as next_code:
+            self.create_share()
+            next_code.reset_mock()
+            with self.assertRaises(IntegrityError):
+                self.create_share()
+
+        # One code from the field default, then a new one per retry
+        self.assertEqual(next_code.call_count, codes.MAX_ALLOCATION_ATTEMPTS)
+        self.assertEqual(FileShare.objects.count(), 1)
+
+
+@override_settings(SECRET_KEY='current-key', SECRET_KEY_FALLBACKS=[], DOWNLOAD_TOKEN_MAX_AGE=60)
+class SignedTokenTests(SimpleTestCase):
+
+    now = 1_700_000_000
+
+    def test_issued_token_verifies(self):
+        token = tokens.issue_token('AbCd1234', now=self.now)
+
+        self.assertTrue(tokens.is_signed_token(token))
+        self.assertTrue(tokens.verify_token('AbCd1234', token, now=self.now + 59))
+        self.assertFalse(tokens.verify_token('AbCd1235', token, now=self.now))
+
+    def test_expired_token_is_rejected(self):
+        token = tokens.issue_token('AbCd1234', now=self.now)
+
+        self.assertFalse(tokens.verify_token('AbCd1234', token, now=self.now + 61))
+
+    def test_tampered_token_is_rejected(self):
+        token = tokens.issue_token('AbCd1234', now=self.now)
+        expires, signature = token.split('-')
+        later = int_to_base36(base36_to_int(expires) + 3600)
+        flipped = signature[:-1] + ('0' if signature[-1] != '0' else '1')
+
+        self.assertFalse(tokens.verify_token('AbCd1234', f'{later}-{signature}', now=self.now))
+        self.assertFalse(tokens.verify_token('AbCd1234', f'{expires}-{flipped}', now=self.now))
+        self.assertFalse(tokens.verify_token('AbCd1234', 'not-a-token!', now=self.now))
+        self.assertFalse(tokens.verify_token('AbCd1234', '-', now=self.now))
+
+    def test_fallback_key_verifies_after_rotation(self):
+        token = tokens.issue_token('AbCd1234', now=self.now)
+
+        with override_settings(SECRET_KEY='rotated-key', SECRET_KEY_FALLBACKS=['current-key']):
+            self.assertTrue(tokens.verify_token('AbCd1234', token, now=self.now))
+        with override_settings(SECRET_KEY='rotated-key'):
+            self.assertFalse(tokens.verify_token('AbCd1234', token, now=self.now))
+
+    @override_settings(DOWNLOAD_TOKEN_MODE='signed', DOWNLOAD_TOKEN_ACCEPT_STORED=False)
+    def test_download_lookup(self):
+        token = tokens.issue_token('AbCd1234')
+
+        self.assertEqual(tokens.download_lookup('AbCd1234', token), {'code': 'AbCd1234'})
+        self.assertIsNone(tokens.download_lookup('AbCd1235', token))
+        self.assertIsNone(tokens.download_lookup('AbCd1234', 'a' * 64))
+        with override_settings(DOWNLOAD_TOKEN_ACCEPT_STORED=True):
+            self.assertEqual(
+                tokens.download_lookup('AbCd1234', 'a' * 64), {'code': 'AbCd1234', 'download_token': 'a' * 64}
+            )
+
+
+@override_settings(FILE_DELETION_SCHEDULER='timer')
+class ClaimDownloadTests(TransactionTestCase):
+    """One-time downloads must be handed out exactly once under concurrency"""
+
+    workers = 16
+    rounds = 5
+
+    def create_share(self, token='token'):
+        return FileShare.objects.create(
+            original_filename='report.txt',
+            file_size=11,
+            content_type='text/plain',
+            file_path='uploads/report.txt',
+            download_token=token,
+        )
+
+    def claim_concurrently(self, code, token):
+        barrier = threading.Barrier(self.workers)
+        winners = []
+        errors = []
+
+        def claim():
+            try:
+                barrier.wait()
+                if self.claim_with_retry(code, token) is not None:
+                    winners.append(threading.get_ident())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return winners
+
+    def claim_with_retry(self, code, token):
+        # SQLite's shared in-memory test database reports table locks
+        # instead of waiting for them; the UPDATE did not run, so retry
+        for _ in range(100):
+            try:
+                return FileShare.claim_download(code, token)
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+        return FileShare.claim_download(code, token)
+
+    def test_exactly_one_concurrent_claim_wins(self):
+        for _ in range(self.rounds):
+            file_share = self.create_share()
+            winners = self.claim_concurrently(file_share.code, 'token')
+
+            self.assertEqual(len(winners), 1)
+            file_share.refresh_from_db()
+            self.assertTrue(file_share.is_downloaded)
+            self.assertEqual(file_share.download_count, 1)
+            self.assertIsNotNone(file_share.expires_at)
+
+    def test_claim_requires_matching_token(self):
+        file_share = self.create_share()
+
+        self.assertIsNone(FileShare.claim_download(file_share.code, 'wrong'))
+        self.assertIsNotNone(FileShare.claim_download(file_share.code, 'token'))
+        self.assertIsNone(FileShare.claim_download(file_share.code, 'token'))
+
+
+class CleanupLeaseTests(TransactionTestCase):
+    """A cleanup lease is held by one worker at a time until it expires"""
+
+    workers = 16
+
+    def acquire_concurrently(self, name, ttl=60):
+        barrier = threading.Barrier(self.workers)
+        winners = []
+        errors = []
+
+        def acquire():
+            try:
+                barrier.wait()
+                if self.acquire_with_retry(name, ttl):
+                    winners.append(threading.get_ident())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=acquire) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return winners
+
+    def acquire_with_retry(self, name, ttl):
+        # As in ClaimDownloadTests: SQLite's shared in-memory test database
+        # reports table locks instead of waiting for them
+        for _ in range(100):
+            try:
+                return acquire_lease(name, ttl)
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+        return acquire_lease(name, ttl)
+
+    def test_one_worker_takes_a_new_lease(self):
+        self.assertEqual(len(self.acquire_concurrently('job')), 1)
+        self.assertFalse(acquire_lease('job', 60))
+
+    def test_one_worker_takes_over_an_expired_lease(self):
+        CleanupLease.objects.create(name='job', holder='gone:1', expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(len(self.acquire_concurrently('job')), 1)
+        lease = CleanupLease.objects.get(name='job')
+        self.assertNotEqual(lease.holder, 'gone:1')
+        self.assertGreater(lease.expires_at, timezone.now())
+
+    def test_held_lease_is_not_taken_over(self):
+        CleanupLease.objects.create(name='job', holder='other:1', expires_at=timezone.now() + timedelta(seconds=60))
+
+        self.assertFalse(acquire_lease('job', 60))
+        self.assertEqual(CleanupLease.objects.get(name='job').holder, 'other:1')
+
+
+@override_settings(FILE_CLEANUP_INTERVAL=300)
+class CleanupMiddlewareTests(SimpleTestCase):
+    """Requests only start the cleanup thread; the lease decides whether it does anything"""
+
+    def setUp(self):
+        self.middleware = FileCleanupMiddleware(lambda request: 'response')
+
+    def test_request_only_starts_a_background_thread(self):
+        with mock.patch('fileservice.middleware.threading.Thread') as thread, \
+                mock.patch('fileservice.middleware.run_cleanup') as run_cleanup:
+            self.assertEqual(self.middleware(None), 'response')
+
+        thread.assert_called_once_with(
+            target=self.middleware._run_background_cleanup, name='file-cleanup', daemon=True
+        )
+        thread.return_value.start.assert_called_once_with()
+        run_cleanup.assert_not_called()
+
+    def test_one_thread_per_interval(self):
+        with mock.patch('fileservice.middleware.threading.Thread') as thread:
+            self.middleware(None)
+            # The first job has finished, but the interval has not passed
+            self.middleware.cleanup_lock.release()
+            self.middleware(None)
+
+        self.assertEqual(thread.call_count, 1)
+
+    def test_cleanup_runs_only_for_the_lease_holder(self):
+        self.middleware.cleanup_lock.acquire()
+        with mock.patch('fileservice.middleware.acquire_lease', return_value=False) as acquire, \
+                mock.patch.object(self.middleware, '_perform_cleanup') as perform_cleanup:
+            self.middleware._run_background_cleanup()
+
+        acquire.assert_called_once_with(FileCleanupMiddleware.lease_name, 300)
+        perform_cleanup.assert_not_called()
+        # The lock is free for the next interval's thread
+        self.assertTrue(self.middleware.cleanup_lock.acquire(blocking=False))
+
+
+@override_settings(METRICS_DISK_USAGE_TTL=0)
+class MetricsTests(FileServiceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir, ignore_errors=True)
+
+    def test_media_usage_is_summed_from_the_database(self):
+        self.upload(content=b'a' * 100)
+        self.upload(content=b'b' * 50)
+
+        usage = metrics._media_usage()
+
+        self.assertEqual((usage['bytes'], usage['files']), (150, 2))
+
+    def test_dead_process_counters_are_archived(self):
+        exited = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True)
+        dead_file = os.path.join(self.metrics_dir, f'metrics-{int(exited.stdout)}.json')
+        with open(dead_file, 'w') as f:
+            f.write('{"fileshare_upload_bytes_total": 7}')
+
+        with override_settings(METRICS_DIR=self.metrics_dir):
+            before = metrics.collect()['fileshare_upload_bytes_total']
+            after = metrics.collect()['fileshare_upload_bytes_total']
+
+        self.assertFalse(os.path.exists(dead_file))
+        self.assertEqual(before, after)
+        self.assertTrue(os.path.exists(os.path.join(self.metrics_dir, 'metrics-archive.json')))
@@ -0,0 +1,89 @@
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import base36_to_int, int_to_base36
+
+
+# Download token modes
+TOKEN_DATABASE = 'database'
+TOKEN_SIGNED = 'signed'
+
+TOKEN_MODES = (TOKEN_DATABASE, TOKEN_SIGNED)
+
+# Namespaces the HMAC so these signatures can't be replayed elsewhere
+KEY_SALT = 'fileservice.tokens.download'
+
+
+def get_token_mode():
+    """How download tokens are issued"""
+    mode = getattr(settings, 'DOWNLOAD_TOKEN_MODE', TOKEN_DATABASE)
+    if mode not in TOKEN_MODES:
+        raise ImproperlyConfigured(
+            f"DOWNLOAD_TOKEN_MODE must be one of {', '.join(TOKEN_MODES)}, got {mode!r}"
+        )
+    return mode
+
+
+def get_token_max_age():
+    """Seconds a signed token stays valid"""
+    return getattr(settings, 'DOWNLOAD_TOKEN_MAX_AGE', 3600)
+
+
+def accepts_stored_tokens():
+    """
+    Check if tokens stored in the download_token column are honoured.
+    After switching to signed tokens this keeps links issued before the
+    switch working until DOWNLOAD_TOKEN_ACCEPT_STORED is turned off.
+    """
+    return get_token_mode() == TOKEN_DATABASE or getattr(settings, 'DOWNLOAD_TOKEN_ACCEPT_STORED', True)
+
+
+def _signing_keys():
+    """Current key first, then the fallbacks of a key rotation"""
+    return [settings.SECRET_KEY, *getattr(settings, 'SECRET_KEY_FALLBACKS', [])]
+
+
+def _signature(code, expires, key):
+    return salted_hmac(KEY_SALT, f"{code}:{expires}", secret=key, algorithm='sha256').hexdigest()
+
+
+def issue_token(code, now=None):
+    """Sign a download token for the share with the given code"""
+    expires = int(now or time.time()) + get_token_max_age()
+    return f"{int_to_base36(expires)}-{_signature(code, expires, settings.SECRET_KEY)}"
+
+
+def is_signed_token(token):
+    """Signed tokens carry their expiry; stored tokens are plain hex digests"""
+    return '-' in token
+
+
+def verify_token(code, token, now=None):
+    """
+    Check a signed token against every signing key in constant time.
+    Needs no database access.
+    """
+    try:
+        expires_b36, signature = token.split('-', 1)
+        expires = base36_to_int(expires_b36)
+    except ValueError:
+        return False
+    if expires < (now or time.time()):
+        return False
+    # Compare against every key so timing doesn't reveal which one matched
+    matches = [constant_time_compare(signature, _signature(code, expires, key)) for key in _signing_keys()]
+    return any(matches)
+
+
+def download_lookup(code, token):
+    """
+    Validate a download link's token. Signed tokens are verified without
+    touching the database; other tokens must match the stored one.
+    Returns the lookup for the share, or None for an invalid link.
+    """
+    if is_signed_token(token):
+        return {'code': code} if verify_token(code, token) else None
+    if accepts_stored_tokens():
+        return {'code': code, 'download_token': token}
+    return None
@@ -0,0 +1,334 @@
+import hashlib
+import os
+import pathlib
+import uuid
+import zlib
+from django.conf import settings
+from django.core.exceptions import TooManyFilesSent
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import QueryDict
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+from .blobs import dedup_enabled, hash_file, store_blob
+from .compression import ENCODING_GZIP, compressor, looks_compressed, should_compress
+from .packs import should_pack, store_packed
+from .profiling import phase
+from .storage import media_path, upload_path_for
+
+
+# Prefix used for uploads that are still being received
+PARTIAL_PREFIX = '.partial-'
+
+# Allowance for multipart boundaries and part headers on top of the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadRejected(Exception):
+    """Raised when an uploaded file cannot be accepted"""
+
+
+def get_max_upload_size():
+    """Maximum accepted file size in bytes"""
+    return getattr(settings, 'FILE_UPLOAD_MAX_SIZE', 50 * 1024 * 1024)
+
+
+def get_uploads_dir():
+    """Absolute path of the uploads directory, created on demand"""
+    uploads_dir = os.path.join(settings.MEDIA_ROOT, 'uploads')
+    os.makedirs(uploads_dir, exist_ok=True)
+    return uploads_dir
+
+
+def size_limit_message(max_size):
+    """Error message for an upload over the size limit"""
+    for unit, factor in (('MB', 1024 * 1024), ('KB', 1024)):
+        if max_size >= factor:
+            return f'File size exceeds {max_size // factor}{unit} limit'
+    return f'File size exceeds {max_size} byte limit'
+
+
+def content_length_exceeds_limit(meta, max_size=None):
+    """
+    Check the declared request body size against the upload limit,
+    so oversize requests can be rejected before any of the body is read.
+    """
+    max_size = max_size or get_max_upload_size()
+    try:
+        content_length = int(meta.get('CONTENT_LENGTH') or 0)
+    except (TypeError, ValueError):
+        return False
+    return content_length > max_size + MULTIPART_OVERHEAD
+
+
+class StreamedUploadedFile(UploadedFile):
+    """
+    A file that was written straight into the uploads directory while
+    the request body was being parsed.
+    """
+
+    # Hex SHA-256 of the content, when the handler was asked to hash it
+    sha256 = None
+    
+    # CRC-32 of the content as received, when the handler was asked for it
+    crc32 = None
+    
+    # Encoding of the bytes on disk ('' when stored as received)
+    content_encoding = ''
+
+    def temporary_file_path(self):
+        """Return the full path of the partial file on disk"""
+        return self.file.name
+
+    def discard(self):
+        """Close and remove the partial file"""
+        try:
+            self.close()
+        except OSError:
+            pass
+        try:
+            os.remove(self.temporary_file_path())
+        except OSError:
+            pass
+
+
+def build_upload_name(original_name):
+    """Build the stored file name, preserving the original extension"""
+    original = pathlib.Path(original_name)
+    timestamp = timezone.now().strftime('%Y%m%d_%H%M%S_%f')
+    return f"{timestamp}_{original.stem}{original.suffix}"
+
+
+def store_partial_file(partial_path, original_name):
+    """
+    Move a fully written partial file to its final name in the uploads
+    directory and return the path relative to MEDIA_ROOT. The rename
+    stays within one filesystem, so no data is copied.
+    """
+    relative_path = default_storage.get_available_name(
+        upload_path_for(build_upload_name(original_name))
+    )
+    full_path = media_path(relative_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    os.replace(partial_path, full_path)
+    return relative_path
+
+
+def store_upload(partial_path, original_name, digest=None, file_size=None, pack=True):
+    """
+    Store a fully written partial file: deduplicated by content when
+    UPLOAD_DEDUPLICATE is on, appended to a pack segment when it is
+    small enough, STORAGE_PACKING is on and ``pack`` allows it, and
+    under its own name otherwise. ``file_size`` is the original size of
+    the upload. Returns the FileShare fields that locate the stored bytes.
+    """
+    stored_size = os.path.getsize(partial_path)
+    if dedup_enabled():
+        blob = store_blob(partial_path, digest or hash_file(partial_path), stored_size)
+        return {'file_path': blob.file_path, 'blob': blob, 'stored_size': stored_size}
+    if pack and should_pack(file_size):
+        return {**store_packed(partial_path), 'stored_size': stored_size}
+    return {'file_path': store_partial_file(partial_path, original_name), 'stored_size': stored_size}
+
+
+def finalize_upload(uploaded_file, pack=True):
+    """Store a streamed upload and return the FileShare fields that locate it"""
+    partial_path = uploaded_file.temporary_file_path()
+    uploaded_file.close()
+    stored = store_upload(partial_path, uploaded_file.name, uploaded_file.sha256, uploaded_file.size, pack)
+    return {**stored, 'content_encoding': uploaded_file.content_encoding}
+
+
+def is_partial_file(file_name):
+    """Check whether a file in the uploads directory is still being received"""
+    return os.path.basename(file_name).startswith(PARTIAL_PREFIX)
+
+
+class StreamingFileUploadHandler(FileUploadHandler):
+    """
+    Upload handler that writes each chunk to a partial file under
+    MEDIA_ROOT/uploads/ as it arrives, keeping memory use per request
+    bounded by the chunk size. Uploads larger than the configured limit
+    are aborted as soon as the running byte count crosses it. With
+    ``hash_content`` the SHA-256 of each file is computed on the way
+    through, so deduplication needs no second read of the file, and
+    with ``track_crc32`` its CRC-32 likewise. ``max_total_size`` bounds
+    the bytes of all files in the request together.
+    Compressible content is gzipped on its way to disk when
+    STORAGE_COMPRESSION is on, unless its first bytes show it is
+    already compressed.
+    """
+
+    def __init__(self, request=None, max_size=None, hash_content=False, max_total_size=None,
+                 track_crc32=False):
+        super().__init__(request)
+        self.max_size = max_size or get_max_upload_size()
+        self.max_total_size = max_total_size
+        self.hash_content = hash_content
+        self.track_crc32 = track_crc32
+        self.hasher = None
+        self.crc32 = None
+        self.compressor = None
+        self.compress_candidate = False
+        self.exceeded = False
+        self.file = None
+        self.bytes_received = 0
+        self.total_received = 0
+        self.completed_files = []
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length_exceeds_limit(META, self.max_size):
+            # Skip parsing entirely; nothing of the body gets buffered
+            self.exceeded = True
+            return QueryDict(encoding=encoding), MultiValueDict()
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.bytes_received = 0
+        self.hasher = hashlib.sha256() if self.hash_content else None
+        self.crc32 = 0 if self.track_crc32 else None
+        self.compressor = None
+        self.compress_candidate = should_compress(self.content_type, self.file_name)
+        partial_path = os.path.join(get_uploads_dir(), f"{PARTIAL_PREFIX}{uuid.uuid4().hex}")
+        self.file = StreamedUploadedFile(
+            open(partial_path, 'wb+'),
+            self.file_name,
+            self.content_type,
+            0,
+            self.charset,
+            self.content_type_extra,
+        )
+
+    def receive_data_chunk(self, raw_data, start):
+        self.bytes_received += len(raw_data)
+        self.total_received += len(raw_data)
+        if self.bytes_received > self.max_size or (
+            self.max_total_size is not None and self.total_received > self.max_total_size
+        ):
+            self.exceeded = True
+            self._discard_all()
+            raise StopUpload(connection_reset=True)
+        if self.compress_candidate:
+            # Decided on the first chunk, once the file's signature is known
+            self.compress_candidate = False
+            if not looks_compressed(raw_data[:8]):
+                self.compressor = compressor()
+                if self.hasher is not None:
+                    # Compressed and raw copies of the same content are different blobs
+                    self.hasher.update(f'{ENCODING_GZIP}\0'.encode())
+        if self.hasher is not None:
+            self.hasher.update(raw_data)
+        if self.crc32 is not None:
+            self.crc32 = zlib.crc32(raw_data, self.crc32)
+        if self.compressor is not None:
+            raw_data = self.compressor.compress(raw_data)
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+            self.file.content_encoding = ENCODING_GZIP
+            self.compressor = None
+        self.file.seek(0)
+        self.file.size = file_size
+        if self.hasher is not None:
+            self.file.sha256 = self.hasher.hexdigest()
+        self.file.crc32 = self.crc32
+        self.completed_files.append(self.file)
+        completed, self.file = self.file, None
+        return completed
+
+    def upload_interrupted(self):
+        self._discard_all()
+
+    def _discard_all(self):
+        """Remove every partial file written by this handler"""
+        if self.file is not None:
+            # Kept, closed: the multipart parser closes handler.file after StopUpload
+            self.file.discard()
+        for uploaded in self.completed_files:
+            uploaded.discard()
+        self.completed_files = []
+
+
+def receive_upload(request, max_size=None):
+    """
+    Stream the file in the request's ``file`` field to disk and store it.
+    Returns (uploaded_file, FileShare storage fields) and raises
+    UploadRejected when there is no file or it is too large.
+    """
+    max_size = max_size or get_max_upload_size()
+    
+    # Stream chunks straight to disk instead of buffering them in memory
+    upload_handler = StreamingFileUploadHandler(
+        request, max_size=max_size, hash_content=dedup_enabled()
+    )
+    request.upload_handlers = [upload_handler]
+    
+    # Reading the body, parsing it and writing the partial file
+    with phase('receive'):
+        files = request.FILES
+    
+    if upload_handler.exceeded or 'file' not in files:
+        if upload_handler.exceeded:
+            raise UploadRejected(size_limit_message(max_size))
+        raise UploadRejected('No file provided')
+    
+    uploaded_file = files['file']
+    
+    # Drop any extra files that came along with the request
+    for field_name, field_files in files.lists():
+        for extra_file in field_files:
+            if extra_file is not uploaded_file:
+                extra_file.discard()
+    
+    # Check file size against the configured limit
+    if uploaded_file.size > max_size:
+        uploaded_file.discard()
+        raise UploadRejected(size_limit_message(max_size))
+    
+    # Move the finished file to its final name in the uploads directory
+    with phase('storage'):
+        stored = finalize_upload(uploaded_file)
+    return uploaded_file, stored
+
+
+def receive_bundle(request, max_total_size):
+    """
+    Stream every file in the request's ``files`` field to disk and store
+    them, none of them in a pack segment. Returns a list of
+    (uploaded_file, storage fields) in upload order and raises
+    UploadRejected when there are no files, too many, or they are too
+    large together.
+    """
+    upload_handler = StreamingFileUploadHandler(
+        request,
+        max_size=max_total_size,
+        hash_content=dedup_enabled(),
+        max_total_size=max_total_size,
+        track_crc32=True,
+    )
+    request.upload_handlers = [upload_handler]
+    
+    with phase('receive'):
+        try:
+            files = request.FILES
+        except TooManyFilesSent:
+            upload_handler.upload_interrupted()
+            raise UploadRejected(f'Too many files; at most {settings.DATA_UPLOAD_MAX_NUMBER_FILES} are accepted')
+    
+    if upload_handler.exceeded:
+        raise UploadRejected(size_limit_message(max_total_size))
+    
+    uploaded_files = files.getlist('files')
+    for field_name, field_files in files.lists():
+        if field_name != 'files':
+            for extra_file in field_files:
+                extra_file.discard()
+    if not uploaded_files:
+        raise UploadRejected('No files provided')
+    
+    with phase('storage'):
+        return [(uploaded_file, finalize_upload(uploaded_file, pack=False)) for uploaded_file in uploaded_files]
@@ -1,9 +1,26 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# Under ASGI the transfer endpoints can run as native async views
+if getattr(settings, 'ASYNC_VIEWS', False):
+    upload_file = views.upload_file_async
+    get_file_info = views.get_file_info_async
+    download_file = views.download_file_async
+else:
+    upload_file = views.upload_file
+    get_file_info = views.get_file_info
+    download_file = views.download_file
+
 urlpatterns = [
-    path('upload/', views.upload_file, name='upload_file'),
-    path('file/<str:code>/', views.get_file_info, name='get_file_info'),
-    path('download/<str:code>/<str:token>/', views.download_file, name='download_file'),
+    path('upload/', upload_file, name='upload_file'),
+    path('upload/bundle/', views.upload_bundle, name='upload_bundle'),
+    path('upload/sessions/', views.create_upload_session, name='create_upload_session'),
+    path('upload/sessions/<uuid:session_id>/', views.upload_session_status, name='upload_session_status'),
+    path('upload/sessions/<uuid:session_id>/chunks/<int:index>/', views.upload_chunk, name='upload_chunk'),
+    path('upload/sessions/<uuid:session_id>/complete/', views.complete_upload_session, name='complete_upload_session'),
+    path('file/<str:code>/', get_file_info, name='get_file_info'),
+    path('download/<str:code>/<str:token>/', download_file, name='download_file'),
     path('health/', views.health_check, name='health_check'),
+    path('metrics/', views.service_metrics, name='metrics'),
 ]
\ No newline at end of file
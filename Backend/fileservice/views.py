@@ -1,18 +1,44 @@
 import os
 import hashlib
-from django.shortcuts import render
-from django.http import Http404, FileResponse, JsonResponse
-from django.conf import settings
+import mimetypes
+import urllib.parse
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.utils import timezone
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
 from rest_framework import status
 from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
-from .models import FileShare
-from .tasks import schedule_file_deletion
-from datetime import timedelta
+from . import bundles, chunked_uploads, metadata_cache, metrics, packs, tokens
+from .chunked_uploads import ChunkedUploadError
+from .compression import accepts_encoding, add_encoding_headers
+from .delivery import (
+    AsyncSendfileResponse,
+    DecompressedFileResponse,
+    SendfileResponse,
+    ZipStreamResponse,
+    is_offloaded,
+    offload_response,
+)
+from .models import FileShare, UploadSession
+from .ranges import (
+    RangeNotSatisfiable,
+    add_validator_headers,
+    file_etag,
+    if_range_matches,
+    not_satisfiable_response,
+    parse_range_header,
+    range_response,
+)
+from .storage import resolve_path
+from .upload_handlers import (
+    UploadRejected,
+    content_length_exceeds_limit,
+    get_max_upload_size,
+    receive_bundle,
+    receive_upload,
+    size_limit_message,
+)
 
 
 @api_view(['POST'])
@@ -21,44 +47,31 @@ def upload_file(request):
     """
     Upload a file and return a sharing code
     """
-    if 'file' not in request.FILES:
+    max_size = get_max_upload_size()
+    
+    # Reject oversize bodies before reading any of them
+    if content_length_exceeds_limit(request.META, max_size):
         return Response(
-            {'error': 'No file provided'}, 
+            {'error': size_limit_message(max_size)},
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    uploaded_file = request.FILES['file']
-    
-    # Check file size (50MB limit)
-    if uploaded_file.size > 50 * 1024 * 1024:  # 50MB in bytes
+    try:
+        uploaded_file, stored = receive_upload(request, max_size)
+    except UploadRejected as e:
         return Response(
-            {'error': 'File size exceeds 50MB limit'}, 
+            {'error': str(e)}, 
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    # Generate unique filename while preserving extension
-    import pathlib
-    original_name = pathlib.Path(uploaded_file.name)
-    file_extension = original_name.suffix  # Gets .pdf, .jpg, .txt, etc.
-    file_stem = original_name.stem  # Gets filename without extension
-    
-    timestamp = timezone.now().strftime('%Y%m%d_%H%M%S_%f')  # More unique timestamp
-    # Ensure we always have the original extension
-    unique_filename = f"{timestamp}_{file_stem}{file_extension}"
-    
-    # Save file to media directory
-    file_path = default_storage.save(
-        f"uploads/{unique_filename}",
-        ContentFile(uploaded_file.read())
-    )
-    
     # Create database record
     file_share = FileShare.objects.create(
         original_filename=uploaded_file.name,
         file_size=uploaded_file.size,
         content_type=uploaded_file.content_type or 'application/octet-stream',
-        file_path=file_path,
+        **stored,
     )
+    metrics.record_upload(file_share.file_size)
     
     return Response({
         'code': file_share.code,
@@ -68,52 +81,370 @@ def upload_file(request):
     }, status=status.HTTP_201_CREATED)
 
 
+@api_view(['POST'])
+@parser_classes([MultiPartParser, FormParser])
+def upload_bundle(request):
+    """
+    Upload several files in one request and return a single sharing
+    code for all of them. Files go in the ``files`` field; optional
+    ``paths`` fields give each file's path inside the archive, and
+    ``name`` names the archive.
+    """
+    max_size = bundles.get_max_bundle_size()
+    
+    # Reject oversize bodies before reading any of them
+    if content_length_exceeds_limit(request.META, max_size):
+        return Response(
+            {'error': size_limit_message(max_size)},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    try:
+        received = receive_bundle(request, max_size)
+    except UploadRejected as e:
+        return Response(
+            {'error': str(e)}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    # One row for the bundle, batched inserts for its files
+    bundle = bundles.create_bundle(
+        received,
+        name=request.POST.get('name'),
+        paths=request.POST.getlist('paths'),
+    )
+    for uploaded_file, _ in received:
+        metrics.record_upload(uploaded_file.size)
+    
+    return Response({
+        'code': bundle.code,
+        'filename': bundle.original_filename,
+        'size': bundle.file_size,
+        'files': len(received),
+        'message': 'Files uploaded successfully'
+    }, status=status.HTTP_201_CREATED)
+
+
+def _session_status(session):
+    """Describe the progress of an upload session"""
+    received = session.received_indexes()
+    received_set = set(received)
+    return {
+        'session_id': str(session.id),
+        'filename': session.original_filename,
+        'size': session.file_size,
+        'chunk_size': session.chunk_size,
+        'total_chunks': session.total_chunks,
+        'received_chunks': received,
+        'missing_chunks': [i for i in range(session.total_chunks) if i not in received_set],
+        'expires_at': session.expires_at,
+    }
+
+
+def _get_active_session(session_id):
+    """Look up an upload session that has not expired yet"""
+    try:
+        session = UploadSession.objects.get(id=session_id)
+    except UploadSession.DoesNotExist:
+        return None
+    if session.is_expired():
+        return None
+    return session
+
+
+@api_view(['POST'])
+def create_upload_session(request):
+    """
+    Start a resumable chunked upload
+    """
+    try:
+        file_size = int(request.data.get('size'))
+        chunk_size = int(request.data['chunk_size']) if request.data.get('chunk_size') else None
+    except (TypeError, ValueError):
+        return Response(
+            {'error': 'A numeric file size is required'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    try:
+        session = chunked_uploads.create_session(
+            request.data.get('filename'),
+            file_size,
+            content_type=request.data.get('content_type'),
+            chunk_size=chunk_size,
+        )
+    except ChunkedUploadError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    return Response(_session_status(session), status=status.HTTP_201_CREATED)
+
+
+@api_view(['GET', 'DELETE'])
+def upload_session_status(request, session_id):
+    """
+    Report which chunks of an upload session have been received, or abort it
+    """
+    session = _get_active_session(session_id)
+    if session is None:
+        return Response(
+            {'error': 'Upload session not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    if request.method == 'DELETE':
+        chunked_uploads.abort_session(session)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    
+    return Response(_session_status(session))
+
+
+@api_view(['PUT'])
+def upload_chunk(request, session_id, index):
+    """
+    Receive one chunk of an upload session as the raw request body
+    """
+    session = _get_active_session(session_id)
+    if session is None:
+        return Response(
+            {'error': 'Upload session not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        written = chunked_uploads.write_chunk(session, index, request._request, content_length)
+    except ValueError:
+        return Response(
+            {'error': 'Invalid Content-Length'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    except ChunkedUploadError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except FileNotFoundError:
+        return Response(
+            {'error': 'Upload session not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    return Response({'index': index, 'size': written})
+
+
+@api_view(['POST'])
+def complete_upload_session(request, session_id):
+    """
+    Assemble a fully received upload session and return a sharing code
+    """
+    session = _get_active_session(session_id)
+    if session is None:
+        return Response(
+            {'error': 'Upload session not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    try:
+        file_share = chunked_uploads.complete_session(session)
+    except ChunkedUploadError as e:
+        return Response(
+            {'error': str(e), **_session_status(session)},
+            status=status.HTTP_409_CONFLICT
+        )
+    
+    if file_share is None:
+        return Response(
+            {'error': 'Upload session not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    return Response({
+        'code': file_share.code,
+        'filename': file_share.original_filename,
+        'size': file_share.file_size,
+        'message': 'File uploaded successfully'
+    }, status=status.HTTP_201_CREATED)
+
+
+def _stored_download_token(code):
+    """Generate a download token to be stored on the row"""
+    return hashlib.sha256(
+        f"{code}{timezone.now().isoformat()}".encode()
+    ).hexdigest()
+
+
+def _file_info(file_share, download_token):
+    """Body of a file info response, listing the files of a bundle"""
+    info = {
+        'filename': file_share['original_filename'],
+        'size': file_share['file_size'],
+        'content_type': file_share['content_type'],
+        'download_token': download_token,
+        'created_at': file_share['created_at'],
+    }
+    if file_share.get('is_bundle'):
+        info['files'] = file_share['files']
+    return info
+
+
 @api_view(['GET'])
 def get_file_info(request, code):
     """
     Get file information by code
     """
-    try:
-        file_share = FileShare.objects.get(code=code)
-    except FileShare.DoesNotExist:
+    file_share = metadata_cache.get_file_metadata(code)
+    if file_share is None:
         return Response(
             {'error': 'File not found'}, 
             status=status.HTTP_404_NOT_FOUND
         )
     
-    if not file_share.is_available():
+    if not metadata_cache.is_available(file_share):
         return Response(
             {'error': 'File no longer available'}, 
             status=status.HTTP_410_GONE
         )
     
-    # Generate download token
-    download_token = hashlib.sha256(
-        f"{file_share.code}{timezone.now().isoformat()}".encode()
-    ).hexdigest()
+    if tokens.get_token_mode() == tokens.TOKEN_SIGNED:
+        # Stateless token; the request needs no write at all
+        download_token = tokens.issue_token(file_share['code'])
+    else:
+        download_token = _stored_download_token(file_share['code'])
+        
+        # Write only the token column; the row itself stays cached
+        if not FileShare.objects.filter(pk=file_share['id']).update(download_token=download_token):
+            metadata_cache.invalidate(code)
+            return Response(
+                {'error': 'File not found'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
     
-    file_share.download_token = download_token
-    file_share.save()
+    return Response(_file_info(file_share, download_token))
+
+
+def _add_download_headers(response, file_share, content_type):
+    """Add CORS and Content-Disposition headers to a download response"""
+    response['Access-Control-Allow-Origin'] = '*'
+    response['Access-Control-Allow-Methods'] = 'GET, HEAD, OPTIONS'
+    response['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Range, If-Range'
+    response['Access-Control-Expose-Headers'] = (
+        'Content-Disposition, Content-Type, Content-Length, Content-Range, Accept-Ranges, ETag'
+    )
     
-    return Response({
-        'filename': file_share.original_filename,
-        'size': file_share.file_size,
-        'content_type': file_share.content_type,
-        'download_token': download_token,
-        'created_at': file_share.created_at,
-    })
+    # Ensure proper Content-Disposition header with filename and extension
+    safe_filename = urllib.parse.quote(file_share.original_filename)
+    response['Content-Disposition'] = f'attachment; filename="{file_share.original_filename}"; filename*=UTF-8\'\'\'{safe_filename}'
+    return response
+
+
+def _detect_content_type(file_share):
+    """Detect MIME type from file extension if not available"""
+    detected_content_type = file_share.content_type
+    if not detected_content_type or detected_content_type == 'application/octet-stream':
+        detected_content_type, _ = mimetypes.guess_type(file_share.original_filename)
+        detected_content_type = detected_content_type or 'application/octet-stream'
+    return detected_content_type
+
+
+def _sends_encoded(request, file_share):
+    """Whether a compressed file can be sent as stored, with Content-Encoding"""
+    encoding = file_share.content_encoding
+    return bool(encoding) and accepts_encoding(request.META.get('HTTP_ACCEPT_ENCODING'), encoding)
+
+
+def _sent_whole(file_share):
+    """Compressed and packed files are always sent whole, never in byte ranges"""
+    return bool(file_share.content_encoding) or file_share.pack_segment_id is not None
+
+
+def _add_representation_headers(response, file_share, encoded, stat_result):
+    """Validators for a whole-file response, and its encoding for compressed files"""
+    add_validator_headers(response, stat_result)
+    if file_share.content_encoding:
+        add_encoding_headers(response, file_share.content_encoding, encoded, stat_result)
+    elif _sent_whole(file_share):
+        response['Accept-Ranges'] = 'none'
+    return response
+
+
+def _requested_ranges(request, stat_result):
+    """
+    Byte ranges asked for by the request, or None to send the whole
+    file. Raises RangeNotSatisfiable when no range overlaps the file.
+    """
+    range_header = request.META.get('HTTP_RANGE')
+    if range_header and if_range_matches(
+        request.META.get('HTTP_IF_RANGE'), file_etag(stat_result), stat_result.st_mtime
+    ):
+        return parse_range_header(range_header, stat_result.st_size)
+    return None
+
+
+def _ranges_length(ranges):
+    """Bytes of file content covered by the served ranges"""
+    return sum(end - start + 1 for start, end in ranges)
+
+
+def _unclaimed_response(lookup):
+    """Error response for a download that could not be claimed"""
+    if FileShare.objects.filter(**lookup).exists():
+        return Response(
+            {'error': 'File no longer available'}, 
+            status=status.HTTP_410_GONE
+        )
+    return Response(
+        {'error': 'Invalid download link'}, 
+        status=status.HTTP_404_NOT_FOUND
+    )
+
+
+def _bundle_response(request, file_share, code, lookup):
+    """
+    Send a bundle as a ZIP archive generated while it streams. Archives
+    are always sent whole, so a Range request still has to win the claim.
+    """
+    try:
+        archive = bundles.build_archive(file_share)
+    except OSError:
+        return Response(
+            {'error': 'File not found on server'}, 
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    if request.method == 'HEAD':
+        if archive.size is None:
+            # Deflated while it is sent; streaming keeps a Content-Length from being made up
+            response = StreamingHttpResponse((), content_type=bundles.BUNDLE_CONTENT_TYPE)
+        else:
+            response = HttpResponse(status=status.HTTP_200_OK, content_type=bundles.BUNDLE_CONTENT_TYPE)
+            response['Content-Length'] = str(archive.size)
+    else:
+        file_share = FileShare.claim_download(code, lookup.get('download_token'))
+        if file_share is None:
+            return _unclaimed_response(lookup)
+        metrics.DOWNLOAD_BYTES.inc(archive.size or file_share.file_size)
+        response = ZipStreamResponse(archive, content_type=bundles.BUNDLE_CONTENT_TYPE)
+    response['Accept-Ranges'] = 'none'
+    return _add_download_headers(response, file_share, bundles.BUNDLE_CONTENT_TYPE)
 
 
 @api_view(['GET', 'HEAD'])
 def download_file(request, code, token):
     """
-    Download file using code and token
+    Download file using code and token.
+    Supports Range and If-Range requests; a file fetched in ranges is
+    consumed once every byte has been served or its grace window ends.
     """
-    try:
-        file_share = FileShare.objects.get(
-            code=code, 
-            download_token=token
+    lookup = tokens.download_lookup(code, token)
+    if lookup is None:
+        return Response(
+            {'error': 'Invalid download link'}, 
+            status=status.HTTP_404_NOT_FOUND
         )
+    
+    range_header = request.META.get('HTTP_RANGE')
+    
+    # The download is only claimed once its file is known to be there,
+    # so a missing file doesn't use up the one allowed download
+    try:
+        file_share = FileShare.objects.get(**lookup)
     except FileShare.DoesNotExist:
         return Response(
             {'error': 'Invalid download link'}, 
@@ -126,70 +457,112 @@ def download_file(request, code, token):
             status=status.HTTP_410_GONE
         )
     
-    # Check if file exists on disk
-    file_path = os.path.join(settings.MEDIA_ROOT, file_share.file_path)
+    if file_share.is_bundle:
+        return _bundle_response(request, file_share, code, lookup)
+    
+    # Check if file exists on disk. Packed small files live inside a
+    # segment, so their row already says all a stat would
+    file_path = resolve_path(file_share.file_path)
+    packed = file_share.pack_segment_id is not None
     
-    if not os.path.exists(file_path):
+    try:
+        stat_result = packs.entry_stat(file_share) if packed else os.stat(file_path)
+    except OSError:
         return Response(
             {'error': 'File not found on server'}, 
             status=status.HTTP_404_NOT_FOUND
         )
     
+    file_size = stat_result.st_size
+    content_type = _detect_content_type(file_share)
+    
+    # Compressed files go out as stored, or inflated for clients without gzip
+    encoded = _sends_encoded(request, file_share)
+    decompress = bool(file_share.content_encoding) and not encoded
+    body_size = file_share.file_size if decompress else file_size
+    
+    # Work out which byte ranges were asked for, if any
+    try:
+        ranges = None if _sent_whole(file_share) else _requested_ranges(request, stat_result)
+    except RangeNotSatisfiable:
+        response = not_satisfiable_response(file_size)
+        return _add_download_headers(response, file_share, content_type)
+    
     # Handle HEAD requests (for testing download availability)
     if request.method == 'HEAD':
-        response = Response(status=status.HTTP_200_OK)
-        response['Content-Type'] = file_share.content_type or 'application/octet-stream'
-        response['Content-Length'] = str(file_share.file_size)
-        response['Access-Control-Allow-Origin'] = '*'
-        response['Access-Control-Allow-Methods'] = 'GET, HEAD, OPTIONS'
-        response['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-        return response
-    
-    # Mark as downloaded and schedule deletion
-    file_share.mark_downloaded()
-    
-    # Trigger immediate cleanup of expired files (non-blocking)
-    from django.core.management import call_command
-    import threading
-    
-    def cleanup_background():
+        if ranges:
+            response = range_response(file_path, ranges, file_size, content_type, head=True)
+            add_validator_headers(response, stat_result)
+        else:
+            response = HttpResponse(status=status.HTTP_200_OK, content_type=content_type)
+            response['Content-Length'] = str(body_size)
+            _add_representation_headers(response, file_share, encoded, stat_result)
+        return _add_download_headers(response, file_share, content_type)
+    
+    if ranges:
+        # Partial fetch: ranges are never claimed; the file is consumed once
+        # the ranges served cover all of it, or when the grace period ends
+        file_share.start_partial_download()
         try:
-            # Clean up expired files in background
-            call_command('cleanup_files', verbosity=0)
-        except Exception:
-            pass  # Silently handle errors
+            response = range_response(
+                file_path,
+                ranges,
+                file_size,
+                content_type,
+                on_complete=lambda served: file_share.record_served_ranges(served, file_size),
+            )
+        except Exception as e:
+            return Response(
+                {'error': f'Error serving file: {str(e)}'}, 
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        metrics.DOWNLOAD_BYTES.inc(_ranges_length(ranges))
+        add_validator_headers(response, stat_result)
+        return _add_download_headers(response, file_share, content_type)
     
-    # Start cleanup in background thread
-    threading.Thread(target=cleanup_background, daemon=True).start()
+    if packed:
+        # A single positioned read; small enough to send from memory
+        try:
+            content = packs.read_entry(file_share, decompress=decompress)
+        except OSError:
+            return Response(
+                {'error': 'File not found on server'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+    
+    # Claim in one conditional UPDATE, so the whole file is served exactly
+    # once; a Range request that fell back to the whole file claims too
+    file_share = FileShare.claim_download(code, lookup.get('download_token'))
+    if file_share is None:
+        return _unclaimed_response(lookup)
+    
+    # Let the reverse proxy stream the bytes when offload is configured.
+    # Ranged requests stay in Django so partial consumption is tracked.
+    metrics.DOWNLOAD_BYTES.inc(body_size)
+    if packed:
+        response = HttpResponse(content, content_type=content_type)
+        _add_representation_headers(response, file_share, encoded, stat_result)
+        return _add_download_headers(response, file_share, content_type)
+    
+    if is_offloaded() and not range_header and not decompress:
+        response = offload_response(file_path, content_type)
+        if encoded:
+            add_encoding_headers(response, file_share.content_encoding, encoded)
+        return _add_download_headers(response, file_share, content_type)
     
     try:
-        # Detect MIME type from file extension if not available
-        import mimetypes
-        detected_content_type = file_share.content_type
-        if not detected_content_type or detected_content_type == 'application/octet-stream':
-            detected_content_type, _ = mimetypes.guess_type(file_share.original_filename)
-            detected_content_type = detected_content_type or 'application/octet-stream'
-        
-        # Return file response with proper filename handling
-        response = FileResponse(
-            open(file_path, 'rb'),
-            as_attachment=True,
-            filename=file_share.original_filename,
-            content_type=detected_content_type
-        )
-        
-        # Add CORS headers manually
-        response['Access-Control-Allow-Origin'] = '*'
-        response['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-        response['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-        response['Access-Control-Expose-Headers'] = 'Content-Disposition, Content-Type'
-        
-        # Ensure proper Content-Disposition header with filename and extension
-        import urllib.parse
-        safe_filename = urllib.parse.quote(file_share.original_filename)
-        response['Content-Disposition'] = f'attachment; filename="{file_share.original_filename}"; filename*=UTF-8\'\'\'{safe_filename}'
-        
-        return response
+        if decompress:
+            response = DecompressedFileResponse(file_path, size=body_size, content_type=content_type)
+        else:
+            # Return file response with proper filename handling
+            response = SendfileResponse(
+                file_path,
+                as_attachment=True,
+                filename=file_share.original_filename,
+                content_type=content_type
+            )
+        _add_representation_headers(response, file_share, encoded, stat_result)
+        return _add_download_headers(response, file_share, content_type)
         
     except Exception as e:
         return Response(
@@ -208,3 +581,202 @@ def health_check(request):
         'timestamp': timezone.now(),
         'version': '1.0.0'
     })
+
+
+def service_metrics(request):
+    """
+    Service metrics in the Prometheus text format, summed across every
+    process that shares METRICS_DIR
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Async versions of the transfer endpoints, routed instead of the sync
+# ones when ASYNC_VIEWS is on. Under ASGI they wait on the database,
+# the disk and the client without holding a worker thread.
+
+async def upload_file_async(request):
+    """
+    Upload a file and return a sharing code.
+    The ASGI handler has already received the body without a thread,
+    spooled to disk and within the upload limit; only parsing it into
+    the uploads directory runs in a worker thread.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    
+    max_size = get_max_upload_size()
+    if content_length_exceeds_limit(request.META, max_size):
+        return JsonResponse({'error': size_limit_message(max_size)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        uploaded_file, stored = await sync_to_async(
+            receive_upload, thread_sensitive=False
+        )(request, max_size)
+    except UploadRejected as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    file_share = await FileShare.objects.acreate(
+        original_filename=uploaded_file.name,
+        file_size=uploaded_file.size,
+        content_type=uploaded_file.content_type or 'application/octet-stream',
+        **stored,
+    )
+    metrics.record_upload(file_share.file_size)
+    
+    return JsonResponse({
+        'code': file_share.code,
+        'filename': uploaded_file.name,
+        'size': uploaded_file.size,
+        'message': 'File uploaded successfully'
+    }, status=status.HTTP_201_CREATED)
+
+
+async def get_file_info_async(request, code):
+    """
+    Get file information by code
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    
+    file_share = await metadata_cache.aget_file_metadata(code)
+    if file_share is None:
+        return JsonResponse({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    if not metadata_cache.is_available(file_share):
+        return JsonResponse({'error': 'File no longer available'}, status=status.HTTP_410_GONE)
+    
+    if tokens.get_token_mode() == tokens.TOKEN_SIGNED:
+        download_token = tokens.issue_token(file_share['code'])
+    else:
+        download_token = _stored_download_token(file_share['code'])
+        if not await FileShare.objects.filter(pk=file_share['id']).aupdate(download_token=download_token):
+            metadata_cache.invalidate(code)
+            return JsonResponse({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    return JsonResponse(_file_info(file_share, download_token))
+
+
+async def download_file_async(request, code, token):
+    """
+    Download file using code and token.
+    HEAD requests go through the sync view; downloads, ranged or not,
+    are served without holding a thread per client.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    if request.method == 'HEAD':
+        return await sync_to_async(download_file)(request, code, token)
+    
+    lookup = tokens.download_lookup(code, token)
+    if lookup is None:
+        return JsonResponse({'error': 'Invalid download link'}, status=status.HTTP_404_NOT_FOUND)
+    
+    range_header = request.META.get('HTTP_RANGE')
+    
+    # Claimed only once the file is known to be there, as in download_file
+    file_share = await FileShare.objects.filter(**lookup).afirst()
+    if file_share is None:
+        return JsonResponse({'error': 'Invalid download link'}, status=status.HTTP_404_NOT_FOUND)
+    if not file_share.is_available():
+        return JsonResponse({'error': 'File no longer available'}, status=status.HTTP_410_GONE)
+    
+    if file_share.is_bundle:
+        return await _bundle_response_async(file_share, code, lookup)
+    
+    file_path = resolve_path(file_share.file_path)
+    packed = file_share.pack_segment_id is not None
+    try:
+        if packed:
+            stat_result = packs.entry_stat(file_share)
+        else:
+            stat_result = await sync_to_async(os.stat, thread_sensitive=False)(file_path)
+    except OSError:
+        return JsonResponse({'error': 'File not found on server'}, status=status.HTTP_404_NOT_FOUND)
+    
+    file_size = stat_result.st_size
+    content_type = _detect_content_type(file_share)
+    
+    encoded = _sends_encoded(request, file_share)
+    decompress = bool(file_share.content_encoding) and not encoded
+    body_size = file_share.file_size if decompress else file_size
+    
+    try:
+        ranges = None if _sent_whole(file_share) else _requested_ranges(request, stat_result)
+    except RangeNotSatisfiable:
+        response = not_satisfiable_response(file_size)
+        return _add_download_headers(response, file_share, content_type)
+    
+    if ranges:
+        # Partial fetch: ranges are never claimed; the file is consumed once
+        # the ranges served cover all of it, or when the grace period ends
+        await sync_to_async(file_share.start_partial_download)()
+        response = range_response(
+            file_path,
+            ranges,
+            file_size,
+            content_type,
+            on_complete=lambda served: file_share.record_served_ranges(served, file_size),
+            asynchronous=True,
+        )
+        metrics.DOWNLOAD_BYTES.inc(_ranges_length(ranges))
+        add_validator_headers(response, stat_result)
+        return _add_download_headers(response, file_share, content_type)
+    
+    if packed:
+        try:
+            content = await sync_to_async(packs.read_entry, thread_sensitive=False)(
+                file_share, decompress=decompress
+            )
+        except OSError:
+            return JsonResponse({'error': 'File not found on server'}, status=status.HTTP_404_NOT_FOUND)
+    
+    file_share = await FileShare.aclaim_download(code, lookup.get('download_token'))
+    if file_share is None:
+        return await _unclaimed_response_async(lookup)
+    
+    metrics.DOWNLOAD_BYTES.inc(body_size)
+    if packed:
+        response = HttpResponse(content, content_type=content_type)
+        _add_representation_headers(response, file_share, encoded, stat_result)
+        return _add_download_headers(response, file_share, content_type)
+    
+    if is_offloaded() and not range_header and not decompress:
+        response = offload_response(file_path, content_type)
+        if encoded:
+            add_encoding_headers(response, file_share.content_encoding, encoded)
+        return _add_download_headers(response, file_share, content_type)
+    
+    if decompress:
+        response = DecompressedFileResponse(
+            file_path, size=body_size, content_type=content_type, asynchronous=True
+        )
+    else:
+        response = AsyncSendfileResponse(file_path, size=file_size, content_type=content_type)
+    _add_representation_headers(response, file_share, encoded, stat_result)
+    return _add_download_headers(response, file_share, content_type)
+
+
+async def _bundle_response_async(file_share, code, lookup):
+    """Async version of _bundle_response, for GET requests"""
+    try:
+        archive = await sync_to_async(bundles.build_archive)(file_share)
+    except OSError:
+        return JsonResponse({'error': 'File not found on server'}, status=status.HTTP_404_NOT_FOUND)
+    
+    file_share = await FileShare.aclaim_download(code, lookup.get('download_token'))
+    if file_share is None:
+        return await _unclaimed_response_async(lookup)
+    metrics.DOWNLOAD_BYTES.inc(archive.size or file_share.file_size)
+    response = ZipStreamResponse(archive, content_type=bundles.BUNDLE_CONTENT_TYPE, asynchronous=True)
+    response['Accept-Ranges'] = 'none'
+    return _add_download_headers(response, file_share, bundles.BUNDLE_CONTENT_TYPE)
+
+
+async def _unclaimed_response_async(lookup):
+    """Async version of _unclaimed_response"""
+    if await FileShare.objects.filter(**lookup).aexists():
+        return JsonResponse({'error': 'File no longer available'}, status=status.HTTP_410_GONE)
+    return JsonResponse({'error': 'Invalid download link'}, status=status.HTTP_404_NOT_FOUND)
@@ -0,0 +1,247 @@
+"""
+ZIP archives written while they are being sent.
+
+An archive is produced entry by entry from blocks read off disk, so
+sending one takes memory for a block and the central directory, never
+a temporary archive. Sizes and CRC-32 go into each local header when
+they are known up front; entries deflated on the fly are followed by a
+data descriptor instead. ZIP64 records are only written where a size,
+an offset or the entry count does not fit the classic format.
+"""
+import struct
+import zlib
+from functools import cached_property
+from asgiref.sync import sync_to_async
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Largest size, offset and entry count the classic format can record
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_COUNT_LIMIT = 0xFFFF
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+MADE_BY_UNIX = 3 << 8
+FILE_ATTRIBUTES = 0o100644 << 16  # Regular file, rw-r--r--
+
+ZIP64_EXTRA_ID = 0x0001
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_DATA_DESCRIPTOR = struct.Struct('<IIII')
+_DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END = struct.Struct('<IHHHHIIH')
+_END64 = struct.Struct('<IQHHIIQQQQ')
+_END64_LOCATOR = struct.Struct('<IIQI')
+
+_LOCAL_HEADER_SIGNATURE = 0x04034b50
+_DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+_CENTRAL_HEADER_SIGNATURE = 0x02014b50
+_END_SIGNATURE = 0x06054b50
+_END64_SIGNATURE = 0x06064b50
+_END64_LOCATOR_SIGNATURE = 0x07064b50
+
+
+def _dos_date_time(modified):
+    """MS-DOS (time, date) fields for a datetime, clamped to the years they can hold"""
+    year = min(max(modified.year, 1980), 2107)
+    return (
+        (modified.hour << 11) | (modified.minute << 5) | (modified.second // 2),
+        ((year - 1980) << 9) | (modified.month << 5) | modified.day,
+    )
+
+
+class ZipEntry:
+    """
+    One file of an archive. ``read`` is called when the entry is
+    written and returns an iterator over its bytes: the content itself,
+    or for a DEFLATED entry with a known ``compressed_size``, a raw
+    deflate stream that is copied as is. Other DEFLATED entries are
+    compressed while they are sent.
+    """
+
+    def __init__(self, name, size, crc32, modified, read, method=ZIP_STORED, compressed_size=None):
+        self.name = name.encode('utf-8')
+        self.size = size
+        self.crc32 = crc32
+        self.time, self.date = _dos_date_time(modified)
+        self.read = read
+        self.method = method
+        self.compressed_size = size if method == ZIP_STORED else compressed_size
+        if self.crc32 is None and not self.streamed:
+            raise ValueError('A ZIP entry written with its sizes up front needs its CRC-32')
+
+    @property
+    def streamed(self):
+        """Deflated while sent; its CRC and sizes follow the data"""
+        return self.compressed_size is None
+
+    @property
+    def zip64(self):
+        # Deflate output can be a little larger than its input
+        largest = self.size + (self.size >> 10) + 64 if self.streamed else max(self.size, self.compressed_size)
+        return largest >= ZIP32_LIMIT
+
+    @property
+    def flags(self):
+        return FLAG_UTF8 | (FLAG_DATA_DESCRIPTOR if self.streamed else 0)
+
+    def local_header(self):
+        extra = b''
+        if self.streamed:
+            crc32 = compressed_size = size = 0
+        else:
+            crc32, compressed_size, size = self.crc32, self.compressed_size, self.size
+        if self.zip64:
+            extra = struct.pack('<HHQQ', ZIP64_EXTRA_ID, 16, size, compressed_size)
+            compressed_size = size = ZIP32_LIMIT
+        return _LOCAL_HEADER.pack(
+            _LOCAL_HEADER_SIGNATURE,
+            VERSION_ZIP64 if self.zip64 else VERSION_DEFAULT,
+            self.flags,
+            self.method,
+            self.time,
+            self.date,
+            crc32,
+            compressed_size,
+            size,
+            len(self.name),
+            len(extra),
+        ) + self.name + extra
+
+    def data_descriptor(self, crc32, compressed_size):
+        if self.zip64:
+            return _DATA_DESCRIPTOR64.pack(_DATA_DESCRIPTOR_SIGNATURE, crc32, compressed_size, self.size)
+        return _DATA_DESCRIPTOR.pack(_DATA_DESCRIPTOR_SIGNATURE, crc32, compressed_size, self.size)
+
+    def central_header(self, crc32, compressed_size, offset):
+        # ZIP64 extra field: only the values that overflow, in this order
+        large = [value for value in (self.size, compressed_size, offset) if value >= ZIP32_LIMIT]
+        extra = struct.pack(f'<HH{len(large)}Q', ZIP64_EXTRA_ID, 8 * len(large), *large) if large else b''
+        version = VERSION_ZIP64 if self.zip64 or large else VERSION_DEFAULT
+        return _CENTRAL_HEADER.pack(
+            _CENTRAL_HEADER_SIGNATURE,
+            MADE_BY_UNIX | version,
+            version,
+            self.flags,
+            self.method,
+            self.time,
+            self.date,
+            crc32,
+            min(compressed_size, ZIP32_LIMIT),
+            min(self.size, ZIP32_LIMIT),
+            len(self.name),
+            len(extra),
+            0,  # Comment length
+            0,  # Disk number
+            0,  # Internal attributes
+            FILE_ATTRIBUTES,
+            min(offset, ZIP32_LIMIT),
+        ) + self.name + extra
+
+
+def _end_records(count, directory_size, directory_offset):
+    """End of central directory record, preceded by its ZIP64 form when needed"""
+    records = b''
+    if count >= ZIP32_COUNT_LIMIT or directory_size >= ZIP32_LIMIT or directory_offset >= ZIP32_LIMIT:
+        end64_offset = directory_offset + directory_size
+        records += _END64.pack(
+            _END64_SIGNATURE, _END64.size - 12, MADE_BY_UNIX | VERSION_ZIP64, VERSION_ZIP64,
+            0, 0, count, count, directory_size, directory_offset,
+        )
+        records += _END64_LOCATOR.pack(_END64_LOCATOR_SIGNATURE, 0, end64_offset, 1)
+    count = min(count, ZIP32_COUNT_LIMIT)
+    return records + _END.pack(
+        _END_SIGNATURE, 0, 0, count, count,
+        min(directory_size, ZIP32_LIMIT), min(directory_offset, ZIP32_LIMIT), 0,
+    )
+
+
+class ZipStream:
+    """
+    A ZIP archive of ``entries``, produced block by block by iterating
+    over it. ``level`` is the zlib level of entries deflated on the fly.
+    """
+
+    def __init__(self, entries, level=6):
+        self.entries = list(entries)
+        self.level = level
+
+    @cached_property
+    def size(self):
+        """Length of the archive in bytes, or None when an entry is deflated while it is sent"""
+        if any(entry.streamed for entry in self.entries):
+            return None
+        offset = 0
+        directory_size = 0
+        for entry in self.entries:
+            directory_size += len(entry.central_header(entry.crc32, entry.compressed_size, offset))
+            offset += len(entry.local_header()) + entry.compressed_size
+        return offset + directory_size + len(_end_records(len(self.entries), directory_size, offset))
+
+    def __iter__(self):
+        offset = 0
+        written_entries = []
+        for entry in self.entries:
+            entry_offset = offset
+            header = entry.local_header()
+            yield header
+            offset += len(header)
+
+            crc32 = entry.crc32
+            compressed_size = 0
+            if entry.streamed:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+                crc32 = 0
+                size = 0
+                for block in entry.read():
+                    crc32 = zlib.crc32(block, crc32)
+                    size += len(block)
+                    block = compressor.compress(block)
+                    if block:
+                        compressed_size += len(block)
+                        yield block
+                block = compressor.flush()
+                compressed_size += len(block)
+                yield block
+                if size != entry.size:
+                    raise ValueError(f'{entry.name.decode()} is {size} bytes, expected {entry.size}')
+                descriptor = entry.data_descriptor(crc32, compressed_size)
+                yield descriptor
+                offset += len(descriptor)
+            else:
+                for block in entry.read():
+                    compressed_size += len(block)
+                    yield block
+                if compressed_size != entry.compressed_size:
+                    raise ValueError(
+                        f'{entry.name.decode()} is {compressed_size} bytes, expected {entry.compressed_size}'
+                    )
+            offset += compressed_size
+            written_entries.append((entry, entry_offset, crc32, compressed_size))
+
+        directory_offset = offset
+        directory_size = 0
+        for entry, entry_offset, crc32, compressed_size in written_entries:
+            header = entry.central_header(crc32, compressed_size, entry_offset)
+            directory_size += len(header)
+            yield header
+        yield _end_records(len(written_entries), directory_size, directory_offset)
+
+
+async def aiter_archive(archive):
+    """Async iteration over a ZipStream; reading and deflating run in a worker thread"""
+    blocks = iter(archive)
+    next_block = sync_to_async(lambda: next(blocks, None), thread_sensitive=False)
+    try:
+        while True:
+            block = await next_block()
+            if block is None:
+                break
+            yield block
+    finally:
+        blocks.close()
@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fileshare_backend.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# Same as get_asgi_application(), but downloads can be sent with
+# os.sendfile on servers that support the http.response.pathsend extension.
+from fileservice.delivery import SendfileASGIHandler  # noqa: E402
+
+application = SendfileASGIHandler()
@@ -1,7 +1,7 @@
 
 from pathlib import Path
 import os
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -13,6 +13,9 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = config('SECRET_KEY', default='django-insecure-u7**ysd-!80j4!sfr3tt=9re_n1t6l_y$_4z@s2*tq!qf3o%au')
 
+# Previous secret keys, still accepted for signatures while rotating keys
+SECRET_KEY_FALLBACKS = config('SECRET_KEY_FALLBACKS', default='', cast=Csv())
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = config('DEBUG', default=True, cast=bool)
 
@@ -34,14 +37,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'fileservice.middleware.RequestProfilingMiddleware',  # Only loaded when REQUEST_PROFILING is on
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'fileservice.middleware.AdmissionControlMiddleware',  # Only loaded when an admission limit is set
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'fileservice.middleware.FileCleanupMiddleware',
+    'fileservice.middleware.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'fileshare_backend.urls'
@@ -68,9 +74,13 @@ WSGI_APPLICATION = 'fileshare_backend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Connections: persistent by default; with DB_POOL_SIZE > 0 each process
+# keeps a bounded pool instead and connections go back to it after every request
+DB_POOL_SIZE = config('DB_POOL_SIZE', default=0, cast=int)
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        'ENGINE': config('DB_ENGINE', default='fileservice.db.mysql'),  # MySQL with optional pooling
         'NAME': config('DB_NAME', default='fileshare_db'),
         'USER': config('DB_USER', default='root'),
         'PASSWORD': config('DB_PASSWORD', default=''),
@@ -79,6 +89,14 @@ DATABASES = {
         'OPTIONS': {
             'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
         },
+        'CONN_MAX_AGE': 0 if DB_POOL_SIZE else config('DB_CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': True,
+        'POOL': {
+            'MAX_SIZE': DB_POOL_SIZE,
+            'TIMEOUT': config('DB_POOL_TIMEOUT', default=5.0, cast=float),  # Seconds to wait for a free connection
+            'RECYCLE': config('DB_POOL_RECYCLE', default=3600, cast=int),  # Replace connections older than this
+            'PING_AFTER': 30,  # Health-check connections idle longer than this
+        } if DB_POOL_SIZE else None,
     }
 }
 
@@ -145,6 +163,9 @@ CORS_EXPOSE_HEADERS = [
     'Content-Disposition',
     'Content-Type',
     'Content-Length',
+    'Content-Range',
+    'Accept-Ranges',
+    'ETag',
 ]
 
 CORS_ALLOW_METHODS = [
@@ -171,11 +192,34 @@ REST_FRAMEWORK = {
 # File upload settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50 MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50 MB
+FILE_UPLOAD_MAX_SIZE = config('FILE_UPLOAD_MAX_SIZE', default=52428800, cast=int)  # 50 MB, uploads stream to disk
+BUNDLE_MAX_SIZE = config('BUNDLE_MAX_SIZE', default=FILE_UPLOAD_MAX_SIZE, cast=int)  # All files of one bundle upload together
+DATA_UPLOAD_MAX_NUMBER_FILES = config('DATA_UPLOAD_MAX_NUMBER_FILES', default=100, cast=int)  # Files per request, so per bundle
+CHUNKED_UPLOAD_MAX_SIZE = config('CHUNKED_UPLOAD_MAX_SIZE', default=1073741824, cast=int)  # 1 GB via resumable uploads
+CHUNKED_UPLOAD_CHUNK_SIZE = config('CHUNKED_UPLOAD_CHUNK_SIZE', default=5242880, cast=int)  # 5 MB per chunk
+UPLOAD_SHARD_LEVELS = config('UPLOAD_SHARD_LEVELS', default=2, cast=int)  # Directory levels under uploads/, 0 = flat
+UPLOAD_SHARD_WIDTH = config('UPLOAD_SHARD_WIDTH', default=2, cast=int)  # Hex characters per level (2 = 256 dirs)
+UPLOAD_SESSION_EXPIRE_HOURS = config('UPLOAD_SESSION_EXPIRE_HOURS', default=24, cast=int)
+UPLOAD_DEDUPLICATE = config('UPLOAD_DEDUPLICATE', default=False, cast=bool)  # Store identical content once, shared by reference
+STORAGE_COMPRESSION = config('STORAGE_COMPRESSION', default=False, cast=bool)  # Gzip text-like uploads on disk; sent with Content-Encoding
+STORAGE_COMPRESSION_LEVEL = config('STORAGE_COMPRESSION_LEVEL', default=6, cast=int)  # zlib level, 1 (fastest) to 9 (smallest)
+STORAGE_PACKING = config('STORAGE_PACKING', default=False, cast=bool)  # Append small uploads to shared segment files
+PACK_MAX_FILE_SIZE = config('PACK_MAX_FILE_SIZE', default=64 * 1024, cast=int)  # Largest upload, in bytes, that is packed
+PACK_SEGMENT_SIZE = config('PACK_SEGMENT_SIZE', default=64 * 1024 * 1024, cast=int)  # Bytes per segment before a new one is started
+PACK_SEGMENT_MAX_AGE = config('PACK_SEGMENT_MAX_AGE', default=3600, cast=int)  # Seconds a segment takes appends; also the grace period before deletion
+PACK_COMPACT_THRESHOLD = config('PACK_COMPACT_THRESHOLD', default=0.5, cast=float)  # Rewrite sealed segments with less than this fraction live
 
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Download delivery: 'django' streams files from the worker, 'x-accel-redirect'
+# (nginx) or 'x-sendfile' (Apache/lighttpd) hand the transfer to the proxy.
+# nginx drops the CORS, Content-Encoding and Vary headers of the redirecting
+# response; the internal location has to add them back (see deploy/nginx-offload.conf)
+DOWNLOAD_DELIVERY_MODE = config('DOWNLOAD_DELIVERY_MODE', default='django')
+DOWNLOAD_ACCEL_REDIRECT_PREFIX = config('DOWNLOAD_ACCEL_REDIRECT_PREFIX', default='/protected/')
+
 # Celery settings
 CELERY_BROKER_URL = config('CELERY_BROKER_URL', default='redis://localhost:6379')
 CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default='redis://localhost:6379')
@@ -186,9 +230,26 @@ CELERY_TIMEZONE = 'UTC'
 
 # Custom settings for file sharing
 FILE_EXPIRE_MINUTES = config('FILE_EXPIRE_MINUTES', default=1, cast=int)  # Files expire after download (configurable)
+DOWNLOAD_RANGE_GRACE_MINUTES = config('DOWNLOAD_RANGE_GRACE_MINUTES', default=30, cast=int)  # Window for resuming ranged downloads
+DOWNLOAD_TOKEN_MODE = config('DOWNLOAD_TOKEN_MODE', default='database')  # 'database' or 'signed' (HMAC, no DB write)
+DOWNLOAD_TOKEN_MAX_AGE = config('DOWNLOAD_TOKEN_MAX_AGE', default=3600, cast=int)  # Seconds a signed token is valid
+DOWNLOAD_TOKEN_ACCEPT_STORED = config('DOWNLOAD_TOKEN_ACCEPT_STORED', default=True, cast=bool)  # Honour tokens issued before switching to signed
+ASYNC_VIEWS = config('ASYNC_VIEWS', default=False, cast=bool)  # Async upload/info/download views; enable under ASGI only
+ASGI_BODY_SPOOL_SIZE = config('ASGI_BODY_SPOOL_SIZE', default=262144, cast=int)  # Request body bytes kept in memory under ASGI
+FILE_DELETION_SCHEDULER = config('FILE_DELETION_SCHEDULER', default='auto')  # 'auto', 'celery' or 'timer'
+CLEANUP_BATCH_SIZE = config('CLEANUP_BATCH_SIZE', default=500, cast=int)  # Rows per DELETE batch
+CLEANUP_TIME_BUDGET = config('CLEANUP_TIME_BUDGET', default=0, cast=float)  # Seconds per run, 0 = unlimited
+CLEANUP_UNLINK_WORKERS = config('CLEANUP_UNLINK_WORKERS', default=8, cast=int)  # Threads removing files
+CLEANUP_MIDDLEWARE_TIME_BUDGET = 2  # Seconds the request-triggered cleanup may take
+FILE_CLEANUP_INTERVAL = config('FILE_CLEANUP_INTERVAL', default=300, cast=int)  # Seconds between middleware-triggered cleanups cluster-wide
+ORPHAN_SCAN_MAX_FILES = config('ORPHAN_SCAN_MAX_FILES', default=5000, cast=int)  # Files examined per orphan scan run
+ORPHAN_MIN_AGE_SECONDS = config('ORPHAN_MIN_AGE_SECONDS', default=3600, cast=int)  # Never remove files newer than this
+ORPHAN_DB_BATCH_SIZE = 500  # Paths per IN query
+CLEANUP_MIDDLEWARE_ORPHAN_SCAN = 500  # Files examined by the request-triggered cleanup
 CODE_LENGTH = 8  # Length of alphanumeric codes
+FILE_CODE_POOL_SIZE = config('FILE_CODE_POOL_SIZE', default=0, cast=int)  # Codes pre-generated per refill, 0 = generate on demand
 
-# Cache settings for file cleanup middleware
+# Cache settings
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
@@ -200,3 +261,51 @@ CACHES = {
     }
 }
 
+# Share metadata cache; set CACHE_REDIS_URL to share it between workers
+CACHE_REDIS_URL = config('CACHE_REDIS_URL', default='')
+if CACHE_REDIS_URL:
+    CACHES['metadata'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+    }
+else:
+    CACHES['metadata'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'fileshare-metadata',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        }
+    }
+FILE_METADATA_CACHE = 'metadata'
+FILE_METADATA_CACHE_TIMEOUT = config('FILE_METADATA_CACHE_TIMEOUT', default=30, cast=int)  # Seconds; bounds staleness without Redis
+
+# Metrics served at /api/metrics/
+METRICS_DIR = config('METRICS_DIR', default='')  # Directory shared by all processes to aggregate metrics; empty = per process
+METRICS_FLUSH_INTERVAL = 5  # Seconds between writes of a process's metrics to METRICS_DIR
+METRICS_DISK_USAGE_TTL = config('METRICS_DISK_USAGE_TTL', default=60, cast=int)  # Seconds between database queries for the usage gauges
+
+# Per-request profiling (Server-Timing header, phase timings, query budget)
+REQUEST_PROFILING = config('REQUEST_PROFILING', default=False, cast=bool)
+REQUEST_PROFILING_SAMPLE_RATE = config('REQUEST_PROFILING_SAMPLE_RATE', default=0.0, cast=float)  # Fraction of requests profiled
+REQUEST_PROFILING_PROFILER = config('REQUEST_PROFILING_PROFILER', default='cprofile')  # 'cprofile' or 'sample' (stack sampling)
+REQUEST_PROFILING_TOKEN = config('REQUEST_PROFILING_TOKEN', default='')  # X-Profile header value that profiles one request; empty = disabled
+REQUEST_PROFILING_SLOW_MS = config('REQUEST_PROFILING_SLOW_MS', default=500, cast=int)  # Requests at least this slow are written to the file
+REQUEST_PROFILING_FILE = config('REQUEST_PROFILING_FILE', default=os.path.join(BASE_DIR, 'profiles', 'requests.jsonl'))
+REQUEST_PROFILING_MAX_BYTES = 10 * 1024 * 1024  # Size at which the file is rotated
+REQUEST_PROFILING_BACKUP_COUNT = 5  # Rotated files kept
+REQUEST_PROFILING_TOP = 30  # Functions or stacks kept per profile
+REQUEST_PROFILING_SERVER_TIMING = True
+REQUEST_QUERY_BUDGET = config('REQUEST_QUERY_BUDGET', default=0, cast=int)  # Queries per request before a warning, 0 = no budget
+
+# Admission control for transfers; every limit is off at 0. Requests over a
+# limit are rejected with Retry-After before their body is read
+UPLOAD_MAX_IN_FLIGHT = config('UPLOAD_MAX_IN_FLIGHT', default=0, cast=int)  # Uploads at once per process
+UPLOAD_MAX_IN_FLIGHT_BYTES = config('UPLOAD_MAX_IN_FLIGHT_BYTES', default=0, cast=int)  # Declared upload bytes at once per process
+UPLOAD_NODE_MAX_IN_FLIGHT = config('UPLOAD_NODE_MAX_IN_FLIGHT', default=0, cast=int)  # Uploads at once on the node
+UPLOAD_NODE_MAX_IN_FLIGHT_BYTES = config('UPLOAD_NODE_MAX_IN_FLIGHT_BYTES', default=0, cast=int)  # Declared upload bytes at once on the node
+DOWNLOAD_MAX_IN_FLIGHT = config('DOWNLOAD_MAX_IN_FLIGHT', default=0, cast=int)  # Downloads at once per process
+DOWNLOAD_NODE_MAX_IN_FLIGHT = config('DOWNLOAD_NODE_MAX_IN_FLIGHT', default=0, cast=int)  # Downloads at once on the node
+ADMISSION_NODE_DIR = config('ADMISSION_NODE_DIR', default='')  # Directory shared by this node's processes; required for node limits
+ADMISSION_RETRY_AFTER = config('ADMISSION_RETRY_AFTER', default=5, cast=int)  # Seconds rejected clients are asked to wait
+ADMISSION_REJECT_STATUS = config('ADMISSION_REJECT_STATUS', default=503, cast=int)  # 503 or 429
+
@@ -0,0 +1,32 @@
+"""
+Settings used by the benchmark_http command for the servers it starts.
+
+Same application as production, but against SQLite and a scratch
+MEDIA_ROOT, both inside the directory named by FILESHARE_BENCHMARK_DIR.
+"""
+import os
+
+from .settings import *  # noqa: F401,F403
+
+BENCHMARK_DIR = os.environ['FILESHARE_BENCHMARK_DIR']
+
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCHMARK_DIR, 'db.sqlite3'),
+        'OPTIONS': {
+            'timeout': 30,  # Seconds to wait on a write lock held by another worker
+        },
+    }
+}
+
+MEDIA_ROOT = os.path.join(BENCHMARK_DIR, 'media')
+METRICS_DIR = os.path.join(BENCHMARK_DIR, 'metrics')
+METRICS_FLUSH_INTERVAL = 1
+
+# Keep background work out of the measurements
+FILE_DELETION_SCHEDULER = 'timer'
+FILE_CLEANUP_INTERVAL = 24 * 60 * 60
+FILE_EXPIRE_MINUTES = 60